@@ -8,8 +8,10 @@ from selenium.webdriver import Chrome
 from selenium.webdriver.remote.webdriver import WebElement
 from typing import Callable
 from bs4 import BeautifulSoup
+import asyncio
 import logging
 from .selenium_driver_pool import WebDriverPool
+from utils.deadline import crawl_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +25,21 @@ class Crawler(ABC):
         """
         pass
 
+    async def crawl_async(self, url) -> CrawledPage:
+        """
+        async version of crawl. selenium has no async api, so by default the blocking crawl
+        is run in the default executor, the event loop itself is never blocked.
+        implements that can fetch pages natively async (aiohttp etc.) should override this method.
+        """
+        return await asyncio.to_thread(self.crawl, url)
+
+    def get_resource_class(self) -> str:
+        """
+        the scheduler resource class this crawler consumes, see utils.scheduler.
+        crawlers that need no scarce resource (reading local files, for example) can return None.
+        """
+        return "browser"
+
     @abstractmethod
     def get_pattern_prefix(self) -> str:
         """
@@ -52,7 +69,7 @@ class SeleniumCrawler(Crawler):
             logger.info(f"crawling {url} using selenium")
 
             driver.get(url)
-            WebDriverWait(driver, 20).until(
+            WebDriverWait(driver, self._get_wait_timeout()).until(
                 self._get_page_waiting_condition()
             )
             page_source = self._get_page_source(driver=driver)
@@ -75,6 +92,15 @@ class SeleniumCrawler(Crawler):
             self.driver_pool.release_driver(driver)
 
 
+    def _get_wait_timeout(self) -> float:
+        """
+        seconds to wait for the page, 20 seconds unless the task deadline is closer
+        """
+        timeout = crawl_timeout.get()
+        if timeout is None:
+            return 20
+        return max(min(20, timeout), 1)
+
     def _get_page_source(self, driver: Chrome) -> str:
         """
         get the page source, this method can be overrided to change the behavior
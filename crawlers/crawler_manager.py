@@ -1,4 +1,5 @@
 from crawlers.crawler import Crawler, CrawledPage
+from crawlers.page_store import PageStore
 from utils.singleton import Singleton
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.config_center import Config
@@ -7,6 +8,8 @@ import logging
 from typing import Generator
 from utils.cache_manager import cache_result
 from utils.time_usage_record import time_usage
+from utils.scheduler import Scheduler
+from utils.deadline import seconds_left, crawl_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +30,9 @@ class CrawlerManager(metaclass=Singleton):
         crawlers.sort(key=lambda crawler: len(
             crawler.get_pattern_prefix()), reverse=True)
         self.crawlers: list[Crawler] = crawlers
-        self.default_executor = ThreadPoolExecutor(max_workers=20)
+        self.scheduler = Scheduler()
+        self.page_store = PageStore()
+        self.default_executor = ThreadPoolExecutor(max_workers=self.scheduler.get_concurrency("browser", 20))
 
     def batch_crawl(self, task_id: str, urls: list[str], executor: ThreadPoolExecutor = None) -> Generator[CrawledPage, None, None]:
         """
@@ -59,14 +64,56 @@ class CrawlerManager(metaclass=Singleton):
         """
         crawl a single url, return a CrawledPage object
         """
+        page = self.page_store.get(url)
+        if page is not None:
+            return page
         clawer = self.get_crawler(url)
+        timeout = seconds_left(task_id)
+        if timeout is not None and timeout <= 0:
+            logger.warning(f"skip crawl {url}, deadline of task {task_id} reached")
+            return None
         logger.info(f"crawl {url} with {clawer.__class__.__name__}")
+        token = crawl_timeout.set(timeout)
         try:
-            return clawer.crawl(url)
+            with self.scheduler.acquire(clawer.get_resource_class()):
+                page = clawer.crawl(url)
+            self.page_store.put(url, page)
+            return page
         except Exception as e:
             logger.exception(
                 f"error when crawl {url} with {clawer.__class__.__name__}: {e}")
             return None
+        finally:
+            crawl_timeout.reset(token)
+
+    @cache_result("crawled_pages", cache_class=CrawledPage, key_gen=lambda *args, **kwargs: kwargs.get("url") if kwargs.get("url") else args[2])
+    @time_usage
+    async def crawl_async(self, task_id: str, url: str) -> CrawledPage:
+        """
+        async version of crawl, shares the same cache with crawl
+        """
+        page = self.page_store.get(url)
+        if page is not None:
+            return page
+        clawer = self.get_crawler(url)
+        timeout = seconds_left(task_id)
+        if timeout is not None and timeout <= 0:
+            logger.warning(f"skip crawl {url}, deadline of task {task_id} reached")
+            return None
+        logger.info(f"async crawl {url} with {clawer.__class__.__name__}")
+        # asyncio.to_thread copies the context, so the crawler thread sees the timeout too
+        token = crawl_timeout.set(timeout)
+        try:
+            async with self.scheduler.acquire_async(clawer.get_resource_class()):
+                page = await clawer.crawl_async(url)
+            self.page_store.put(url, page)
+            return page
+        except Exception as e:
+            logger.exception(
+                f"error when async crawl {url} with {clawer.__class__.__name__}: {e}")
+            return None
+        finally:
+            crawl_timeout.reset(token)
 
     def get_crawler(self, url: str) -> Crawler:
         """
@@ -0,0 +1,116 @@
+"""
+a page store shared by all tasks, so a page crawled for one topic is not rendered again for the next one.
+
+pages are keyed by their normalized url and kept with the time they were fetched and the hash of their content,
+a page younger than the freshness ttl of its domain is served without crawling. failed crawls are not stored.
+"""
+
+from components import CrawledPage
+from utils.singleton import Singleton
+from utils.config_center import Config
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from typing import Optional
+import utils.cache_manager as cache_manager
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    the same page under one key: scheme and host lower cased, default port, fragment, tracking parameters
+    and trailing slash dropped, query parameters sorted
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(sorted([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                              if not k.lower().startswith("utm_")]))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class PageStore(metaclass=Singleton):
+
+    def __init__(self) -> None:
+        config = Config().get_config("crawlers").get("page_store", {})
+        self.enabled = config.get("enabled", True)
+        self.path = config.get("path") or os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "output", "page_store.sqlite")
+        self.default_ttl = config.get("default_ttl", 86400)
+        # domain -> seconds, a domain also covers its sub domains
+        self.domain_ttl: dict[str, float] = config.get("domain_ttl", {})
+        self.local = threading.local()
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+    def get(self, url: str) -> Optional[CrawledPage]:
+        """
+        the stored page of the url if it is still fresh
+        """
+        if not self.__active():
+            return None
+        ttl = self.get_ttl(url)
+        if ttl <= 0:
+            return None
+        row = self.__conn().execute("SELECT fetched_at, page FROM pages WHERE url = ?", (normalize_url(url),)).fetchone()
+        if row is None or time.time() - row[0] > ttl:
+            return None
+        logger.info(f"serve {url} from the page store, fetched {int(time.time() - row[0])}s ago")
+        page = CrawledPage.deserialize(CrawledPage, json.loads(row[1]))
+        # the page may have been stored under another form of the url
+        page.url = url
+        return page
+
+    def put(self, url: str, page: CrawledPage) -> None:
+        if not self.__active() or page is None:
+            return
+        content_hash = hashlib.sha256((page.content or "").encode("utf-8")).hexdigest()
+        key = normalize_url(url)
+        conn = self.__conn()
+        row = conn.execute("SELECT content_hash FROM pages WHERE url = ?", (key,)).fetchone()
+        if row is not None and row[0] == content_hash:
+            # unchanged since the last crawl, it is fresh again
+            conn.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), key))
+            return
+        conn.execute("INSERT OR REPLACE INTO pages (url, fetched_at, content_hash, page) VALUES (?, ?, ?, ?)",
+                     (key, time.time(), content_hash, json.dumps(page.serialize(), ensure_ascii=False)))
+
+    def get_ttl(self, url: str) -> float:
+        """
+        freshness ttl of the domain of the url, the most specific configured domain wins
+        """
+        host = (urlsplit(url).hostname or "").lower()
+        matched = [d for d in self.domain_ttl if host == d or host.endswith("." + d)]
+        if not matched:
+            return self.default_ttl
+        return self.domain_ttl[max(matched, key=len)]
+
+    def __active(self) -> bool:
+        # switched off with the result caches, a recorded run has to crawl for real
+        return self.enabled and cache_manager.enabled
+
+    def __conn(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if not hasattr(self.local, "conn"):
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    fetched_at REAL NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    page TEXT NOT NULL
+                )""")
+            self.local.conn = conn
+        return self.local.conn
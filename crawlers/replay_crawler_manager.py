@@ -0,0 +1,84 @@
+"""
+record and replay of crawls, see utils.fixtures.
+
+a crawl keeps the page (None for a failed crawl, that is part of the run too), how long it took and the scheduler
+resource of the crawler that did it. replay starts no browser.
+"""
+
+from components import CrawledPage
+from utils.fixtures import FixtureBundle
+from utils.scheduler import Scheduler
+from utils.deadline import seconds_left
+from typing import Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingCrawlerManager:
+
+    def __init__(self, crawler_manager, bundle: FixtureBundle) -> None:
+        """
+        Args:
+            crawler_manager (CrawlerManager): crawls the pages
+            bundle (FixtureBundle): where the crawls are recorded
+        """
+        self.crawler_manager = crawler_manager
+        self.bundle = bundle
+
+    def crawl(self, task_id: str, url: str) -> Optional[CrawledPage]:
+        start = time.time()
+        page = self.crawler_manager.crawl(task_id, url)
+        self.__record(task_id, url, page, time.time() - start)
+        return page
+
+    async def crawl_async(self, task_id: str, url: str) -> Optional[CrawledPage]:
+        start = time.time()
+        page = await self.crawler_manager.crawl_async(task_id, url)
+        self.__record(task_id, url, page, time.time() - start)
+        return page
+
+    def __record(self, task_id: str, url: str, page: Optional[CrawledPage], latency: float) -> None:
+        timeout = seconds_left(task_id)
+        if page is None and timeout is not None and timeout <= 0:
+            # skipped because of the deadline, says nothing about the url
+            return
+        self.bundle.put("crawl", FixtureBundle.key(url), {
+            "page": page.serialize() if page else None,
+            "latency": latency,
+            "resource": self.crawler_manager.get_crawler(url).get_resource_class()
+        })
+
+
+class ReplayCrawlerManager:
+
+    def __init__(self, bundle: FixtureBundle) -> None:
+        self.bundle = bundle
+        self.scheduler = Scheduler()
+
+    def crawl(self, task_id: str, url: str) -> Optional[CrawledPage]:
+        recorded = self.__recorded(task_id, url)
+        if recorded is None:
+            return None
+        with self.scheduler.acquire(recorded.get("resource")):
+            self.bundle.sleep("crawl", recorded["latency"])
+        return CrawledPage.deserialize(CrawledPage, recorded["page"]) if recorded["page"] else None
+
+    async def crawl_async(self, task_id: str, url: str) -> Optional[CrawledPage]:
+        recorded = self.__recorded(task_id, url)
+        if recorded is None:
+            return None
+        async with self.scheduler.acquire_async(recorded.get("resource")):
+            await self.bundle.sleep_async("crawl", recorded["latency"])
+        return CrawledPage.deserialize(CrawledPage, recorded["page"]) if recorded["page"] else None
+
+    def __recorded(self, task_id: str, url: str) -> Optional[dict]:
+        timeout = seconds_left(task_id)
+        if timeout is not None and timeout <= 0:
+            logger.warning(f"skip crawl {url}, deadline of task {task_id} reached")
+            return None
+        recorded = self.bundle.get("crawl", FixtureBundle.key(url))
+        if recorded is None:
+            logger.warning(f"no recorded crawl for {url}, replay a failed crawl")
+        return recorded
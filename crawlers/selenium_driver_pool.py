@@ -8,6 +8,7 @@ import threading
 from utils.web_proxy import WebProxy
 from utils.singleton import Singleton
 from utils.config_center import Config
+from utils.scheduler import Scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +16,8 @@ class WebDriverPool(metaclass=Singleton):
 
     def __init__(self):
         config = Config().get_config("crawlers").get("selenium", {}).get("pool", {})
-        self.size = config.get("size", 8)
+        # the browser concurrency of the scheduler decides how many drivers we need
+        self.size = Scheduler().get_concurrency("browser", config.get("size", 8))
         self.created_proxy_driver_num = 0
         self.created_no_proxy_driver_num = 0
         self.lock = threading.Lock()
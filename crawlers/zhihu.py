@@ -98,7 +98,7 @@ class ZhihuCrawler(SeleniumCrawler):
                     driver.add_cookie(
                         {"name": c['name'], "value": c['value'], "domain": c['domain']})
             driver.get(url)
-            WebDriverWait(driver, 20).until(
+            WebDriverWait(driver, self._get_wait_timeout()).until(
                 self._get_page_waiting_condition()
             )
             driver.delete_all_cookies()
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Generator
+from typing import Generator, AsyncGenerator
 from components import LLMTokenBill
+import asyncio
 
 
 class LLMUtil(ABC):
@@ -33,6 +34,32 @@ class LLMUtil(ABC):
         """
         pass
 
+    async def get_fast_result_async(self, messages, temperature: int = 0.2, max_tokens: int = None, **kwargs) -> str:
+        """
+        async version of get_fast_result, runs get_fast_result in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.get_fast_result, messages, temperature, max_tokens, **kwargs)
+
+    async def get_fast_stream_result_async(self, messages, temperature: int = 0.2, max_tokens: int = None, **kwargs) -> AsyncGenerator[str, None]:
+        """
+        async version of get_fast_stream_result, every chunk is pulled in the default executor unless overrided
+        """
+        async for chunk in self.__stream_in_thread(self.get_fast_stream_result(messages, temperature, max_tokens, **kwargs)):
+            yield chunk
+
+    async def get_smart_result_async(self, messages, temperature: int = 0.2, max_tokens: int = None, **kwargs) -> str:
+        """
+        async version of get_smart_result, runs get_smart_result in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.get_smart_result, messages, temperature, max_tokens, **kwargs)
+
+    async def get_smart_stream_result_async(self, messages, temperature: int = 0.2, max_tokens: int = None, **kwargs) -> AsyncGenerator[str, None]:
+        """
+        async version of get_smart_stream_result, every chunk is pulled in the default executor unless overrided
+        """
+        async for chunk in self.__stream_in_thread(self.get_smart_stream_result(messages, temperature, max_tokens, **kwargs)):
+            yield chunk
+
     @abstractmethod
     def split_for_fast(self, content: str, **kwargs) -> list[str]:
         """
@@ -52,4 +79,26 @@ class LLMUtil(ABC):
         """
         get the bill from the model
         """
-        pass
\ No newline at end of file
+        pass
+
+    def flush_token_use(self, task_id: str) -> None:
+        """
+        write the token use of the task to disk, called when the task ends
+        """
+        pass
+
+    def get_stats(self) -> dict[str, dict]:
+        """
+        runtime stats of this llm util in this process, empty if it keeps none
+        """
+        return {}
+
+    async def __stream_in_thread(self, stream: Generator[str, None, None]) -> AsyncGenerator[str, None]:
+        # a generator does nothing until its first next, so all of its work runs in the executor
+        chunks = iter(stream)
+        sentinel = object()
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, sentinel)
+            if chunk is sentinel:
+                return
+            yield chunk
@@ -0,0 +1,130 @@
+"""
+token counting and structure-aware chunking for llm prompts.
+
+tokens are counted with tiktoken when it is installed, otherwise with a calibrated estimate
+(about 4 ascii characters per token, one token per other character, which is what CJK text costs).
+"""
+
+from typing import Optional
+import logging
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+
+    def __init__(self, encoding_name: str = "cl100k_base") -> None:
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                # tiktoken downloads the encoding on first use, fall back if that is not possible
+                logger.warning(f"failed to load tiktoken encoding {encoding_name}, use estimated token count: {e}")
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        ascii_num = len(text.encode("ascii", errors="ignore"))
+        return math.ceil(ascii_num / 4) + len(text) - ascii_num
+
+    def count_messages(self, messages: list[dict[str, str]]) -> int:
+        """
+        tokens of a chat completion prompt, every message costs a few tokens more than its content
+        """
+        return sum([self.count(m.get("content", "")) + 4 for m in messages]) + 3
+
+    def truncate(self, text: str, max_tokens: int) -> tuple[str, str]:
+        """
+        split text into a head of at most max_tokens and the rest
+        """
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            return self.encoding.decode(tokens[:max_tokens]), self.encoding.decode(tokens[max_tokens:])
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        end = max(low, 1)
+        return text[:end], text[end:]
+
+
+class Chunker:
+    """
+    cuts text into chunks of at most max_tokens in a single pass, at paragraph boundaries when possible,
+    then at sentence boundaries, and only cuts inside a sentence that alone is too long.
+    the last overlap tokens of a chunk (whole sentences or paragraphs) are repeated at the start of the next one.
+    """
+
+    SENTENCE_END = re.compile(r"(?<=[.!?;。！？；])\s+|(?<=[。！？；])")
+
+    def __init__(self, token_counter: TokenCounter, max_tokens: int, overlap: int = 0) -> None:
+        self.token_counter = token_counter
+        self.max_tokens = max_tokens
+        self.overlap = min(overlap, max_tokens // 2)
+
+    def split(self, text: str, max_tokens: Optional[int] = None) -> list[str]:
+        max_tokens = max_tokens or self.max_tokens
+        if self.token_counter.count(text) <= max_tokens:
+            return [text]
+        chunks = []
+        # (piece, separator before it, tokens)
+        current: list[tuple[str, str, int]] = []
+        current_tokens = 0
+        for piece, separator in self.__pieces(text, max_tokens):
+            tokens = self.token_counter.count(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(self.__join(current))
+                current = self.__overlap_tail(current, max_tokens - tokens)
+                current_tokens = sum([t for _, _, t in current])
+            current.append((piece, separator, tokens))
+            current_tokens += tokens
+        if current:
+            chunks.append(self.__join(current))
+        return chunks
+
+    def __pieces(self, text: str, max_tokens: int):
+        """
+        yield (piece, separator) where every piece fits max_tokens
+        """
+        for paragraph in re.split(r"\n\s*\n", text):
+            if not paragraph.strip():
+                continue
+            if self.token_counter.count(paragraph) <= max_tokens:
+                yield paragraph, "\n\n"
+                continue
+            separator = "\n\n"
+            for sentence in self.SENTENCE_END.split(paragraph):
+                if not sentence:
+                    continue
+                while self.token_counter.count(sentence) > max_tokens:
+                    head, sentence = self.token_counter.truncate(sentence, max_tokens)
+                    yield head, separator
+                    separator = ""
+                yield sentence, separator
+                separator = " " if sentence.isascii() else ""
+
+    def __overlap_tail(self, pieces: list[tuple[str, str, int]], room: int) -> list[tuple[str, str, int]]:
+        tail = []
+        tokens = 0
+        for piece in reversed(pieces):
+            if tokens + piece[2] > min(self.overlap, room):
+                break
+            tail.insert(0, piece)
+            tokens += piece[2]
+        return tail
+
+    def __join(self, pieces: list[tuple[str, str, int]]) -> str:
+        return "".join([(separator if i > 0 else "") + piece for i, (piece, separator, _) in enumerate(pieces)])
@@ -0,0 +1,227 @@
+"""
+latency and error aware routing of llm calls.
+
+a route is a model at an api endpoint. the router keeps the latency and the outcome of the calls of every route within
+the last window_seconds, and routes a call to the first route of its preference list that is not degraded:
+
+    - more than max_error_rate of its calls failed, or
+    - its p50 latency is more than slow_factor times the best p50 of the other routes of the call
+
+a degraded route gets no traffic until its samples expire, then it is tried again.
+the p95 latency of a route is also the point where a hedged call fires its duplicate request.
+
+latencies are kept per stage of the calls, a long report call is only compared with other report calls.
+"""
+
+from collections import deque
+from typing import Optional
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Route:
+
+    def __init__(self, model: str, api_base: str, api_key: str = None) -> None:
+        """
+        Args:
+            model (str): the model
+            api_base (str): the endpoint
+            api_key (str): key of the endpoint, None to use the global one
+        """
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+
+    def params(self) -> dict:
+        """
+        the per request endpoint arguments of the openai client
+        """
+        params = {"model": self.model, "api_base": self.api_base}
+        if self.api_key:
+            params["api_key"] = self.api_key
+        return params
+
+    def __str__(self) -> str:
+        return f"{self.model}@{self.api_base}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Route) and str(self) == str(other)
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+
+def stage_of(stage: Optional[str]) -> str:
+    return stage or "unknown"
+
+
+class RouteStats:
+
+    def __init__(self) -> None:
+        # (stream, stage) -> (finished_at, latency) of successful calls, streamed and complete calls apart,
+        # the latency of a stream is the time to its first byte
+        self.latencies: dict[tuple[bool, str], deque[tuple[float, float]]] = {}
+        # (finished_at, failed) of all calls
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def expire(self, before: float) -> None:
+        for samples in list(self.latencies.values()) + [self.outcomes]:
+            while samples and samples[0][0] < before:
+                samples.popleft()
+
+    def samples(self, stream: bool, stage: str = None) -> list[float]:
+        """
+        latencies of the stage, of all stages if None
+        """
+        return [latency for (s, st), samples in self.latencies.items()
+                if s == stream and (stage is None or st == stage) for _, latency in samples]
+
+    def percentile(self, stream: bool, q: float, stage: str = None) -> Optional[float]:
+        latencies = sorted(self.samples(stream, stage))
+        if not latencies:
+            return None
+        return latencies[int(q * (len(latencies) - 1))]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0
+        return len([o for o in self.outcomes if o[1]]) / len(self.outcomes)
+
+
+class ModelRouter:
+
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): the llms.openai.router config
+        """
+        self.window_seconds = config.get("window_seconds", 300)
+        self.min_samples = config.get("min_samples", 5)
+        self.max_error_rate = config.get("max_error_rate", 0.3)
+        self.slow_factor = config.get("slow_factor", 2)
+        hedge = config.get("hedge", {})
+        self.hedge_stages = hedge.get("stages", [])
+        self.hedge_delay_factor = hedge.get("delay_factor", 1.0)
+        self.hedge_min_delay = hedge.get("min_delay", 2)
+        self.stats: dict[Route, RouteStats] = {}
+        self.lock = threading.Lock()
+
+    def choose(self, routes: list[Route], stream: bool, stage: str = None) -> Route:
+        """
+        the first route that is not degraded, the least failing one if all are
+        """
+        with self.lock:
+            for route in routes:
+                if not self.__degraded(route, routes, stream, stage_of(stage)):
+                    if route != routes[0]:
+                        logger.info(f"route {routes[0]} is degraded, fall back to {route}")
+                    return route
+            route = min(routes, key=lambda r: self.__stats(r).error_rate())
+        logger.warning(f"all routes {routes} are degraded, use {route}")
+        return route
+
+    def backup(self, routes: list[Route], route: Route, stream: bool, stage: str = None) -> Route:
+        """
+        the route for the duplicate of a hedged call, another healthy route if there is one
+        """
+        with self.lock:
+            for other in routes:
+                if other != route and not self.__degraded(other, routes, stream, stage_of(stage)):
+                    return other
+        return route
+
+    def record(self, route: Route, stream: bool, latency: Optional[float], stage: str = None) -> None:
+        """
+        latency of a successful call, None for a failed one
+        """
+        now = time.time()
+        with self.lock:
+            stats = self.__stats(route)
+            stats.outcomes.append((now, latency is None))
+            if latency is not None:
+                stats.latencies.setdefault((stream, stage_of(stage)), deque()).append((now, latency))
+
+    def should_hedge(self, stage: Optional[str]) -> bool:
+        return stage is not None and stage in self.hedge_stages
+
+    def hedge_delay(self, route: Route, stream: bool, stage: str = None) -> Optional[float]:
+        """
+        seconds to wait before firing the duplicate, None until the route has enough samples of the stage to know
+        its p95
+        """
+        with self.lock:
+            stats = self.__stats(route)
+            if len(stats.samples(stream, stage_of(stage))) < self.min_samples:
+                return None
+            return max(stats.percentile(stream, 0.95, stage_of(stage)) * self.hedge_delay_factor, self.hedge_min_delay)
+
+    def record_hedge(self, route: Route, won: bool) -> None:
+        """
+        a duplicate was fired on route, won if it answered first
+        """
+        with self.lock:
+            stats = self.__stats(route)
+            stats.hedged += 1
+            if won:
+                stats.hedge_wins += 1
+
+    def get_stats(self) -> dict[str, dict]:
+        """
+        per route latency percentiles, error rate and hedges within the window
+        """
+        with self.lock:
+            result = {}
+            for route in list(self.stats.keys()):
+                stats = self.__stats(route)
+                if not stats.outcomes and not stats.hedged:
+                    continue
+                result[str(route)] = {
+                    "calls": len(stats.outcomes),
+                    "error_rate": round(stats.error_rate(), 3),
+                    "p50": stats.percentile(False, 0.5),
+                    "p95": stats.percentile(False, 0.95),
+                    "stream_p50": stats.percentile(True, 0.5),
+                    "stream_p95": stats.percentile(True, 0.95),
+                    "hedged": stats.hedged,
+                    "hedge_wins": stats.hedge_wins,
+                    "stages": {f"{stage}{' (stream)' if stream else ''}": {
+                        "p50": stats.percentile(stream, 0.5, stage),
+                        "p95": stats.percentile(stream, 0.95, stage)
+                    } for stream, stage in stats.latencies.keys() if stats.samples(stream, stage)}
+                }
+            return result
+
+    def __stats(self, route: Route) -> RouteStats:
+        """
+        stats of the route with expired samples dropped, the caller holds the lock
+        """
+        if route not in self.stats:
+            self.stats[route] = RouteStats()
+        stats = self.stats[route]
+        stats.expire(time.time() - self.window_seconds)
+        return stats
+
+    def __failing(self, route: Route) -> bool:
+        stats = self.__stats(route)
+        return len(stats.outcomes) >= self.min_samples and stats.error_rate() > self.max_error_rate
+
+    def __degraded(self, route: Route, routes: list[Route], stream: bool, stage: str) -> bool:
+        if self.__failing(route):
+            return True
+        stats = self.__stats(route)
+        if len(stats.samples(stream, stage)) < self.min_samples:
+            return False
+        p50 = stats.percentile(stream, 0.5, stage)
+        # a failing route answers fast too, it is no measure of how fast a route can be
+        others = [self.__stats(r) for r in routes if r != route and not self.__failing(r)]
+        best = min([s.percentile(stream, 0.5, stage) for s in others if len(s.samples(stream, stage)) >= self.min_samples],
+                   default=None)
+        return best is not None and p50 > best * self.slow_factor
@@ -1,19 +1,37 @@
 from llms.base_llm_util import LLMUtil
 from utils.config_center import Config
-from typing import Generator
+from typing import Generator, AsyncGenerator
 from utils.web_proxy import WebProxy
-import json
+from utils.scheduler import Scheduler
+from utils.events import EventBus, EventType
+from utils.budget import BudgetLevel, add_cost, budget_level, spent
+import utils.cache_manager as cache_manager
+from llms.chunker import TokenCounter, Chunker
+from llms.response_cache import ResponseCache
+from llms.rate_limiter import RateLimiter
+from llms.model_router import ModelRouter, Route
+from llms.token_accountant import TokenAccountant
+from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError
+import asyncio
 import logging
 import os
+import random
+import time
 from components import LLMTokenBill, TokenType, TokenUsage, TokenPrice
 try:
     import openai
-    # import tiktoken
+    from openai import error as openai_error
 except ImportError:
     raise ImportError(
         "OpenAI is not installed. Please install it by running `pip install openai`")
 logger = logging.getLogger(__name__)
 
+# errors worth another try, the request may succeed later
+RETRYABLE_ERRORS = tuple([getattr(openai_error, name) for name in
+                          ["RateLimitError", "APIError", "Timeout", "ServiceUnavailableError", "APIConnectionError", "TryAgain"]
+                          if hasattr(openai_error, name)])
+
 
 class DefaultLLMUtil(LLMUtil):
 
@@ -32,44 +50,157 @@ class DefaultLLMUtil(LLMUtil):
             self.price = [TokenPrice.deserialize(TokenPrice, p) for p in self.config['price']]
         else:
             self.price = []
+        # dollars per token of (model, token type)
+        self.token_price = {(p.model, p.token_type): p.price / 1000 for p in self.price}
+        self.scheduler = Scheduler()
+        self.accountant = TokenAccountant()
+        self.token_counter = TokenCounter()
+        # context window of every model, models of a tier are tried from the smallest
+        self.models = self.config.get("models", {
+            "fast": {"gpt-3.5-turbo-0613": 4096, "gpt-3.5-turbo-16k-0613": 16384},
+            "smart": {"gpt-4-0613": 8192, "gpt-4-32k": 32768}
+        })
+        # tokens left for the completion when choosing a model
+        self.completion_reserve = self.config.get("completion_reserve", {"fast": 1000, "smart": 2000})
+        response_cache = self.config.get("response_cache", {})
+        self.response_cache = ResponseCache(
+            response_cache.get("path") or os.path.join(os.path.dirname(os.path.dirname(__file__)), "output", "llm_cache.sqlite"),
+            response_cache.get("max_mb", 512)) if response_cache.get("enabled", True) else None
+        self.rate_limiter = RateLimiter(self.config.get("rate_limits", {}))
+        self.retry = self.config.get("retry", {})
+        router = self.config.get("router", {})
+        self.router = ModelRouter(router)
+        # the configured endpoint first, then the fallback ones
+        self.endpoints = [(openai.api_base, None)] + [(e["api_base"], e.get("api_key"))
+                                                      for e in router.get("endpoints", [])]
+        # runs the calls of hedged requests, the caller waits for whichever answers first
+        self.hedge_executor = ThreadPoolExecutor(max_workers=router.get("hedge", {}).get("workers", 8),
+                                                 thread_name_prefix="llm-hedge")
+        chunk = self.config.get("chunk", {})
+        self.chunker = Chunker(self.token_counter, chunk.get("tokens", 2500), chunk.get("overlap", 100))
 
     def get_smart_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
-        model = self.__get_model_for_smart(messages)
-        return self.__get_result(model, messages, temperature, max_tokens, **kwargs)
+        model, resource = self.__get_model_for_smart(messages, max_tokens, kwargs.get("task_id"))
+        key, cached = self.__get_cached(model, messages, temperature, max_tokens)
+        if cached is not None:
+            return cached
+        with self.scheduler.acquire(resource):
+            result = self.__get_result(model, messages, temperature, max_tokens, **kwargs)
+        self.__put_cached(key, model, result)
+        return result
 
     def get_smart_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
-        model = self.__get_model_for_smart(messages)
-        for r in self.__get_stream_result(model, messages, temperature, max_tokens, **kwargs):
-            yield r
+        model, resource = self.__get_model_for_smart(messages, max_tokens, kwargs.get("task_id"))
+        key, cached = self.__get_cached(model, messages, temperature, max_tokens)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        with self.scheduler.acquire(resource):
+            for r in self.__get_stream_result(model, messages, temperature, max_tokens, **kwargs):
+                chunks.append(r)
+                yield r
+        self.__put_cached(key, model, "".join(chunks))
 
     def get_fast_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
-        model = self.__get_model_for_fast(messages)
-        return self.__get_result(model, messages, temperature, max_tokens, **kwargs)
+        model = self.__get_model_for_fast(messages, max_tokens)
+        key, cached = self.__get_cached(model, messages, temperature, max_tokens)
+        if cached is not None:
+            return cached
+        with self.scheduler.acquire("fast_llm"):
+            result = self.__get_result(model, messages, temperature, max_tokens, **kwargs)
+        self.__put_cached(key, model, result)
+        return result
 
     def get_fast_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
-        model = self.__get_model_for_fast(messages)
-        for r in self.__get_stream_result(model, messages, temperature, max_tokens, **kwargs):
-            yield r
+        model = self.__get_model_for_fast(messages, max_tokens)
+        key, cached = self.__get_cached(model, messages, temperature, max_tokens)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        with self.scheduler.acquire("fast_llm"):
+            for r in self.__get_stream_result(model, messages, temperature, max_tokens, **kwargs):
+                chunks.append(r)
+                yield r
+        self.__put_cached(key, model, "".join(chunks))
+
+    async def get_smart_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        model, resource = self.__get_model_for_smart(messages, max_tokens, kwargs.get("task_id"))
+        key, cached = await asyncio.to_thread(self.__get_cached, model, messages, temperature, max_tokens)
+        if cached is not None:
+            return cached
+        async with self.scheduler.acquire_async(resource):
+            result = await self.__get_result_async(model, messages, temperature, max_tokens, **kwargs)
+        await asyncio.to_thread(self.__put_cached, key, model, result)
+        return result
+
+    async def get_smart_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        model, resource = self.__get_model_for_smart(messages, max_tokens, kwargs.get("task_id"))
+        key, cached = await asyncio.to_thread(self.__get_cached, model, messages, temperature, max_tokens)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        async with self.scheduler.acquire_async(resource):
+            async for r in self.__get_stream_result_async(model, messages, temperature, max_tokens, **kwargs):
+                chunks.append(r)
+                yield r
+        await asyncio.to_thread(self.__put_cached, key, model, "".join(chunks))
+
+    async def get_fast_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        model = self.__get_model_for_fast(messages, max_tokens)
+        key, cached = await asyncio.to_thread(self.__get_cached, model, messages, temperature, max_tokens)
+        if cached is not None:
+            return cached
+        async with self.scheduler.acquire_async("fast_llm"):
+            result = await self.__get_result_async(model, messages, temperature, max_tokens, **kwargs)
+        await asyncio.to_thread(self.__put_cached, key, model, result)
+        return result
+
+    async def get_fast_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        model = self.__get_model_for_fast(messages, max_tokens)
+        key, cached = await asyncio.to_thread(self.__get_cached, model, messages, temperature, max_tokens)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        async with self.scheduler.acquire_async("fast_llm"):
+            async for r in self.__get_stream_result_async(model, messages, temperature, max_tokens, **kwargs):
+                chunks.append(r)
+                yield r
+        await asyncio.to_thread(self.__put_cached, key, model, "".join(chunks))
+
+    def get_rate_limit_stats(self) -> dict[str, dict]:
+        """
+        per model rate limit queue-wait metrics and retries in this process
+        """
+        return self.rate_limiter.stats()
+
+    def get_router_stats(self) -> dict[str, dict]:
+        """
+        per route (model@endpoint) latency percentiles, error rate and hedged requests of the recent calls
+        """
+        return self.router.get_stats()
+
+    def get_cache_stats(self) -> dict[str, int]:
+        """
+        hits, misses and writes of the response cache in this process, empty if the cache is disabled
+        """
+        return self.response_cache.stats() if self.response_cache else {}
+
+    def get_stats(self) -> dict[str, dict]:
+        return {
+            "rate_limits": self.get_rate_limit_stats(),
+            "router": self.get_router_stats(),
+            "response_cache": self.get_cache_stats()
+        }
 
     def split_for_fast(self, content: str) -> list[str]:
-        this_level = [content]
-        next_level = []
-        while True:
-            all_ok = True
-            for c in this_level:
-                token_num = self.__num_tokens_from_string(c, "cl100k_base")
-                if token_num > 12000:
-                    # 二分文本
-                    all_ok = False
-                    half_num = len(c)//2
-                    next_level.extend([c[:half_num], c[half_num:]])
-                else:
-                    next_level.append(c)
-            this_level = next_level
-            next_level = []
-            if all_ok:
-                break
-        return this_level
+        """
+        chunks of at most chunk.tokens tokens, cut at paragraph and sentence boundaries
+        """
+        return self.chunker.split(content)
 
     def split_for_smart(self, content: str) -> list[str]:
         """
@@ -78,37 +209,31 @@ class DefaultLLMUtil(LLMUtil):
         return [content]
     
     def get_bill(self, task_id: str) -> LLMTokenBill:
-        path = os.path.join(os.path.dirname(
-            os.path.dirname(__file__)), 'output', task_id, 'token_use.json')
-        if not os.path.exists(path):
-            return None
-        with open(path, 'r') as f:
-            token_use = json.load(f)
+        token_use = self.accountant.get_usage(task_id)
         usage: list[TokenUsage] = []
-        for model_key in ["gpt-4-32k", "gpt-4-0613", "gpt-3.5-turbo-16k-0613", "gpt-3.5-turbo-0613"]:
-            if model_key in token_use:
-                usage.append(TokenUsage(
-                    model_key, TokenType.Completion, token_use[model_key]['completion_tokens']))
-                usage.append(TokenUsage(
-                    model_key, TokenType.Prompt, token_use[model_key]['prompt_tokens']))
+        for model_key, model_usage in token_use.items():
+            if model_key == "bill" or not isinstance(model_usage, dict):
+                continue
+            usage.append(TokenUsage(
+                model_key, TokenType.Completion, model_usage['completion_tokens']))
+            usage.append(TokenUsage(
+                model_key, TokenType.Prompt, model_usage['prompt_tokens']))
+        if not usage:
+            return None
         bill = LLMTokenBill(usage, self.price)
-        token_use['bill'] = bill.serialize()
-        with open(path, 'w') as f:
-            json.dump(token_use, f, ensure_ascii=False, indent=4)
+        self.accountant.set_bill(task_id, bill.serialize())
         return bill
 
+    def flush_token_use(self, task_id: str) -> None:
+        self.accountant.flush(task_id)
+
     def __get_result(self, model, messages, temperature=0, max_tokens=None, **kwargs) -> str:
         logger.debug(
             f"getting result from model: {model}, messages: {str(messages)[:200]}, max_tokens: {max_tokens}, temperature: {temperature}")
 
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            stream=False,
-            temperature=temperature
-        )
-        self.__record_token_use(kwargs.get("task_id"), model, response)
+        response, estimated, model = self.__create(model, messages, temperature, max_tokens, False, **kwargs)
+        self.__record_token_use(kwargs.get("task_id"), model, response, kwargs.get("stage"))
+        self.rate_limiter.correct(model, estimated, response['usage']['total_tokens'])
         logger.debug(f"response: {response}")
         # will work fine with non ascii characters
         return f"""{response['choices'][0].message["content"]}"""
@@ -117,74 +242,310 @@ class DefaultLLMUtil(LLMUtil):
         logger.debug(
             f"getting stream result from model: {model}, messages: {str(messages)[:200]}, max_tokens: {max_tokens}, temperature: {temperature}")
 
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            stream=True,
-            temperature=temperature
-        )
+        response, estimated, model = self.__create(model, messages, temperature, max_tokens, True, **kwargs)
+        completion = []
         for chunk in response:
             if chunk["choices"][0].delta.get("content"):
+                completion.append(chunk["choices"][0].delta.content)
                 yield f"""{chunk["choices"][0].delta.content}"""
-        self.__record_token_use(kwargs.get("task_id"), model, response)
+        usage = self.__stream_usage(messages, completion)
+        self.__record_token_use(kwargs.get("task_id"), model, usage, kwargs.get("stage"))
+        self.rate_limiter.correct(model, estimated, usage['usage']['total_tokens'])
 
-    def __record_token_use(self, task_id: str, model: str, response: dict):
-        if task_id is None:
+    async def __get_result_async(self, model, messages, temperature=0, max_tokens=None, **kwargs) -> str:
+        logger.debug(
+            f"getting async result from model: {model}, messages: {str(messages)[:200]}, max_tokens: {max_tokens}, temperature: {temperature}")
+
+        response, estimated, model = await self.__create_async(model, messages, temperature, max_tokens, False, **kwargs)
+        self.__record_token_use(kwargs.get("task_id"), model, response, kwargs.get("stage"))
+        self.rate_limiter.correct(model, estimated, response['usage']['total_tokens'])
+        logger.debug(f"response: {response}")
+        return f"""{response['choices'][0].message["content"]}"""
+
+    async def __get_stream_result_async(self, model, messages, temperature=0, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        logger.debug(
+            f"getting async stream result from model: {model}, messages: {str(messages)[:200]}, max_tokens: {max_tokens}, temperature: {temperature}")
+
+        response, estimated, model = await self.__create_async(model, messages, temperature, max_tokens, True, **kwargs)
+        completion = []
+        async for chunk in response:
+            if chunk["choices"][0].delta.get("content"):
+                completion.append(chunk["choices"][0].delta.content)
+                yield f"""{chunk["choices"][0].delta.content}"""
+        usage = self.__stream_usage(messages, completion)
+        self.__record_token_use(kwargs.get("task_id"), model, usage, kwargs.get("stage"))
+        self.rate_limiter.correct(model, estimated, usage['usage']['total_tokens'])
+
+    def __create(self, model, messages, temperature, max_tokens, stream, **kwargs):
+        """
+        call the api on the healthiest route of the model, within the rate limits of the route model, retry transient
+        errors with jittered backoff, a retry may go to another route. calls of the hedge stages are hedged.
+        return the response, the estimated tokens taken from the rate limits and the model that answered.
+        """
+        routes = self.__routes(model, messages, max_tokens)
+        attempt = 0
+        while True:
+            route = self.router.choose(routes, stream, kwargs.get("stage"))
+            try:
+                if self.router.should_hedge(kwargs.get("stage")):
+                    route, response, estimated = self.__hedged_call(routes, route, messages, temperature, max_tokens,
+                                                                    stream, **kwargs)
+                else:
+                    response, estimated = self.__call(route, messages, temperature, max_tokens, stream,
+                                                      kwargs.get("stage"))
+                return response, estimated, route.model
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                delay = self.__retry_delay(route.model, e, attempt)
+                time.sleep(delay)
+
+    async def __create_async(self, model, messages, temperature, max_tokens, stream, **kwargs):
+        routes = self.__routes(model, messages, max_tokens)
+        attempt = 0
+        while True:
+            route = self.router.choose(routes, stream, kwargs.get("stage"))
+            try:
+                if self.router.should_hedge(kwargs.get("stage")):
+                    route, response, estimated = await self.__hedged_call_async(routes, route, messages, temperature,
+                                                                                max_tokens, stream, kwargs.get("stage"))
+                else:
+                    response, estimated = await self.__call_async(route, messages, temperature, max_tokens, stream,
+                                                                  kwargs.get("stage"))
+                return response, estimated, route.model
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                delay = self.__retry_delay(route.model, e, attempt)
+                await asyncio.sleep(delay)
+
+    def __call(self, route: Route, messages, temperature, max_tokens, stream, stage=None):
+        """
+        a single call on the route, the time spent waiting for the rate limits is not part of its latency
+        """
+        estimated = self.__estimate_tokens(route.model, messages, max_tokens)
+        self.rate_limiter.acquire(route.model, estimated)
+        start = time.time()
+        try:
+            response = openai.ChatCompletion.create(
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=stream,
+                temperature=temperature,
+                **route.params()
+            )
+        except RETRYABLE_ERRORS:
+            self.router.record(route, stream, None, stage)
+            raise
+        self.router.record(route, stream, time.time() - start, stage)
+        return response, estimated
+
+    async def __call_async(self, route: Route, messages, temperature, max_tokens, stream, stage=None):
+        estimated = self.__estimate_tokens(route.model, messages, max_tokens)
+        await self.rate_limiter.acquire_async(route.model, estimated)
+        start = time.time()
+        try:
+            response = await openai.ChatCompletion.acreate(
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=stream,
+                temperature=temperature,
+                **route.params()
+            )
+        except RETRYABLE_ERRORS:
+            self.router.record(route, stream, None, stage)
+            raise
+        self.router.record(route, stream, time.time() - start, stage)
+        return response, estimated
+
+    def __hedged_call(self, routes: list[Route], route: Route, messages, temperature, max_tokens, stream, **kwargs):
+        """
+        call the route, and fire a duplicate on the backup route once the p95 latency of the route is exceeded.
+        return (route, response, estimated) of the call answering first. the loser can not be interrupted,
+        its tokens are recorded when it is back.
+        """
+        stage = kwargs.get("stage")
+        delay = self.router.hedge_delay(route, stream, stage)
+        if delay is None:
+            return (route,) + self.__call(route, messages, temperature, max_tokens, stream, stage)
+        first = self.hedge_executor.submit(self.__call, route, messages, temperature, max_tokens, stream, stage)
+        try:
+            return (route,) + first.result(timeout=delay)
+        except TimeoutError:
+            pass
+        backup = self.router.backup(routes, route, stream, stage)
+        logger.info(f"no response from {route} in {delay:.1f}s, hedge on {backup}")
+        second = self.hedge_executor.submit(self.__call, backup, messages, temperature, max_tokens, stream, stage)
+        calls = {first: route, second: backup}
+        error = None
+        for future in as_completed(calls):
+            try:
+                response, estimated = future.result()
+            except RETRYABLE_ERRORS as e:
+                error = e
+                continue
+            self.router.record_hedge(backup, future is second)
+            loser = second if future is first else first
+            loser.add_done_callback(lambda f: self.__discard_hedge(f, calls[f], stream, **kwargs))
+            return calls[future], response, estimated
+        raise error
+
+    async def __hedged_call_async(self, routes: list[Route], route: Route, messages, temperature, max_tokens, stream,
+                                  stage=None):
+        """
+        async version of __hedged_call, the loser is cancelled
+        """
+        delay = self.router.hedge_delay(route, stream, stage)
+        if delay is None:
+            return (route,) + await self.__call_async(route, messages, temperature, max_tokens, stream, stage)
+        first = asyncio.create_task(self.__call_async(route, messages, temperature, max_tokens, stream, stage))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return (route,) + first.result()
+        backup = self.router.backup(routes, route, stream, stage)
+        logger.info(f"no response from {route} in {delay:.1f}s, hedge on {backup}")
+        second = asyncio.create_task(self.__call_async(backup, messages, temperature, max_tokens, stream, stage))
+        calls = {first: route, second: backup}
+        pending = set(calls.keys())
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        response, estimated = task.result()
+                    except RETRYABLE_ERRORS as e:
+                        error = e
+                        continue
+                    self.router.record_hedge(backup, task is second)
+                    return calls[task], response, estimated
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def __discard_hedge(self, future: Future, route: Route, stream: bool, **kwargs) -> None:
+        """
+        the losing call of a hedged request is paid for too
+        """
+        if future.cancelled() or future.exception() is not None:
             return
-        path = os.path.join(os.path.dirname(
-            os.path.dirname(__file__)), 'output', task_id, 'token_use.json')
-        if not os.path.exists(path):
-            token_use = {}
-        else:
-            with open(path, 'r') as f:
-                token_use = json.load(f)
-        old_num_for_model = token_use.get(model, {})
-        completion_tokens = old_num_for_model.get(
-            'completion_tokens', 0) + response['usage']['completion_tokens']
-        prompt_tokens = old_num_for_model.get(
-            'prompt_tokens', 0) + response['usage']['prompt_tokens']
-        total_tokens = old_num_for_model.get(
-            'total_tokens', 0) + response['usage']['total_tokens']
-        this_time = {
-            'completion_tokens': response['usage']['completion_tokens'],
-            'prompt_tokens': response['usage']['prompt_tokens'],
-            'total_tokens': response['usage']['total_tokens']
-        }
-        details = old_num_for_model.get('details', [])
-        details.append(this_time)
-        token_use[model] = {
-            'completion_tokens': completion_tokens,
+        response, estimated = future.result()
+        if stream:
+            # nobody reads the stream, stop it
+            if hasattr(response, "close"):
+                response.close()
+            return
+        self.__record_token_use(kwargs.get("task_id"), route.model, response, kwargs.get("stage"))
+        self.rate_limiter.correct(route.model, estimated, response['usage']['total_tokens'])
+
+    def __routes(self, model, messages, max_tokens) -> list[Route]:
+        """
+        the model on every endpoint, then the larger models of its tier that hold the prompt as fallbacks
+        """
+        tier = "smart" if model in self.models.get("smart", {}) else "fast"
+        needed = self.token_counter.count_messages(messages) + (max_tokens or self.completion_reserve.get(tier, 1000))
+        models = [model] + [m for m, context in sorted(self.models[tier].items(), key=lambda m: m[1])
+                            if m != model and needed <= context and context >= self.models[tier].get(model, 0)]
+        return [Route(m, api_base, api_key) for m in models for api_base, api_key in self.endpoints]
+
+    def __estimate_tokens(self, model, messages, max_tokens) -> int:
+        tier = "smart" if model in self.models.get("smart", {}) else "fast"
+        return self.token_counter.count_messages(messages) + (max_tokens or self.completion_reserve.get(tier, 1000))
+
+    def __retry_delay(self, model: str, e: Exception, attempt: int) -> float:
+        """
+        seconds to wait before the next attempt, raise e if there should be no more attempt.
+        exponential backoff with jitter, never shorter than the Retry-After the api asked for.
+        """
+        if attempt >= self.retry.get("max_attempts", 5):
+            raise e
+        backoff = min(self.retry.get("max_delay", 60), self.retry.get("base_delay", 1) * 2 ** (attempt - 1))
+        delay = backoff * random.uniform(0.5, 1)
+        headers = getattr(e, "headers", None) or {}
+        try:
+            delay = max(delay, float(headers.get("retry-after", 0)))
+        except (TypeError, ValueError):
+            pass
+        self.rate_limiter.record_retry(model)
+        logger.warning(f"{e.__class__.__name__} from {model}, attempt {attempt}, retry in {delay:.1f}s: {e}")
+        return delay
+
+    def __get_cached(self, model, messages, temperature, max_tokens) -> tuple[Optional[str], Optional[str]]:
+        """
+        return (key, cached response), both None if the cache is disabled
+        """
+        # switched off with the result caches, a recorded run has to call the model for real
+        if self.response_cache is None or not cache_manager.enabled:
+            return None, None
+        key = self.response_cache.key(model, messages, temperature, max_tokens)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            logger.debug(f"llm response cache hit for model: {model}, messages: {str(messages)[:200]}")
+        return key, cached
+
+    def __put_cached(self, key: Optional[str], model: str, response: str) -> None:
+        if key is not None and response:
+            self.response_cache.put(key, model, response)
+
+    def __stream_usage(self, messages, completion: list[str]) -> dict:
+        """
+        streamed responses come without usage, count it the same way the model is chosen
+        """
+        prompt_tokens = self.token_counter.count_messages(messages)
+        completion_tokens = self.__num_tokens_from_string("".join(completion), "cl100k_base")
+        return {'usage': {
             'prompt_tokens': prompt_tokens,
-            'total_tokens': total_tokens,
-            'details': details
-        }
-        with open(path, 'w') as f:
-            json.dump(token_use, f, ensure_ascii=False, indent=4)
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }}
+
+    def __record_token_use(self, task_id: str, model: str, response: dict, stage: str = None):
+        if task_id is None:
+            return
+        EventBus().record_tokens(task_id, response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
+        self.accountant.record(task_id, model, response['usage']['prompt_tokens'],
+                               response['usage']['completion_tokens'], stage)
+        changed = add_cost(task_id, response['usage']['prompt_tokens'] * self.token_price.get((model, TokenType.Prompt), 0)
+                           + response['usage']['completion_tokens'] * self.token_price.get((model, TokenType.Completion), 0))
+        if changed:
+            cost, max_cost = spent(task_id)
+            logger.warning(f"task {task_id} spent ${cost:.4f} of ${max_cost:.4f}, budget level {changed[0].name} -> {changed[1].name}")
+            EventBus().emit(task_id, EventType.BudgetChanged, level=changed[1].name, spent=cost, max_cost=max_cost)
 
     def __num_tokens_from_string(self, string: str, encoding_name: str) -> int:
-        """Returns the number of tokens in a text string. it seems that openai just check token number as text length"""
-        return len(string)
-        # encoding = tiktoken.get_encoding(encoding_name)
-        # num_tokens = len(encoding.encode(string))
-        # return num_tokens
-
-    def __get_model_for_smart(self, messages):
-        token_num = self.__num_tokens_from_string(
-            json.dumps(messages), "cl100k_base")
-        if token_num > 3000:
-            model = "gpt-4-32k"
-        else:
-            model = "gpt-4-0613"
-        return model
-
-    def __get_model_for_fast(self, messages):
-        token_num = self.__num_tokens_from_string(
-            json.dumps(messages), "cl100k_base")
-        if token_num > 5000:
-            model = "gpt-3.5-turbo-16k-0613"
-        else:
-            model = "gpt-3.5-turbo-0613"
-        return model
+        """Returns the number of tokens in a text string."""
+        return self.token_counter.count(string)
+
+    def __get_model_for_smart(self, messages, max_tokens=None, task_id: str = None) -> tuple[str, str]:
+        """
+        the model and the scheduler resource of a smart call.
+        a task past the downgrade level of its cost budget gets a fast model, if one holds the prompt
+        """
+        if budget_level(task_id) >= BudgetLevel.Downgrade:
+            model = self.__fitting_model("fast", messages, max_tokens)
+            if model:
+                logger.debug(f"task {task_id} is close to its cost budget, use {model} for a smart call")
+                return model, "fast_llm"
+        return self.__get_model("smart", messages, max_tokens), "smart_llm"
+
+    def __get_model_for_fast(self, messages, max_tokens=None):
+        return self.__get_model("fast", messages, max_tokens)
+
+    def __get_model(self, tier: str, messages, max_tokens=None) -> str:
+        """
+        the smallest model of the tier whose context holds the prompt and the completion
+        """
+        model = self.__fitting_model(tier, messages, max_tokens)
+        if model:
+            return model
+        largest = max(self.models[tier].items(), key=lambda m: m[1])[0]
+        logger.warning(f"prompt does not fit any {tier} model, use {largest}")
+        return largest
+
+    def __fitting_model(self, tier: str, messages, max_tokens=None) -> Optional[str]:
+        needed = self.token_counter.count_messages(messages) + (max_tokens or self.completion_reserve.get(tier, 1000))
+        for model, context in sorted(self.models[tier].items(), key=lambda m: m[1]):
+            if needed <= context:
+                return model
+        return None
     
     
\ No newline at end of file
@@ -73,6 +73,26 @@ class PromptProvider(ABC):
         """
         pass
 
+    @abstractmethod
+    def section_prompt(self, topic: str, sub_topic: SubTopic, summary: str) -> str:
+        """
+        use to write one section of the report from the materials of its sub topic only.
+
+        Returns:
+            str: the section prompt
+        """
+        pass
+
+    @abstractmethod
+    def stitch_prompt(self, topic: str, outline: ReportOutline, sections: str) -> str:
+        """
+        use to write the introduction and the conclusion of a report whose sections are already written.
+
+        Returns:
+            str: the stitch prompt
+        """
+        pass
+
 class DefaultPromptProvider(PromptProvider):
 
     def auto_agent_prompt(self) -> str:
@@ -176,4 +196,28 @@ To generate a comprehensive research report on the movie 'The Wandering Earth 2'
             f'here is some materials we obtained: """{summary}"""'\
             f'you should generate the report focusing on the following topics: """{sub_topics}"""'\
             f'remember to remove all inrelevant, repeated, or contradictory content.'\
-            'make sure the report is well structured, informative, in depth, with facts and numbers if available.'
\ No newline at end of file
+            'make sure the report is well structured, informative, in depth, with facts and numbers if available.'
+
+    def section_prompt(self, topic: str, sub_topic: SubTopic, summary: str) -> str:
+        summary = summary.replace('"""', '"')
+        summary = summary.replace('""', '"')
+        length = f'it should be about {sub_topic.word_suggestion} words long. ' if sub_topic.word_suggestion else ''
+        return f'here is a task, about generating a research report for the following topic: "{topic}"'\
+            f'the report is written section by section, you need to write the section: "{sub_topic.sub_topic}", '\
+            f'it aims to: "{sub_topic.describe}". {length}'\
+            f'here is the materials we obtained for this section: """{summary}"""'\
+            'remember to remove all inrelevant, repeated, or contradictory content. '\
+            'make sure the section is informative, in depth, with facts and numbers if available. '\
+            'only write the content of the section, DO NOT write the section heading, '\
+            "AND YOU SHOULD ALWAYS ANSWER IN THE LANGUAGE OF THE TOPIC."
+
+    def stitch_prompt(self, topic: str, outline: ReportOutline, sections: str) -> str:
+        sections = sections.replace('"""', '"')
+        sections = sections.replace('""', '"')
+        return f'here is a task, about generating a research report for the following topic: "{topic}"'\
+            f'the sections of the report are already written: """{sections}"""'\
+            'you need to write the introduction and the conclusion of the report. '\
+            f'the conclusion aims to: "{outline.conclusion.describe}". '\
+            'first write the introduction, without any heading, then a line with exactly "===CONCLUSION===", '\
+            'then the conclusion, without any heading. DO NOT repeat the sections, '\
+            "AND YOU SHOULD ALWAYS ANSWER IN THE LANGUAGE OF THE TOPIC."
@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from llms.prompt_provider import PromptProvider
 from llms.base_llm_util import LLMUtil
 from llms.report_outline_generator import SubTopic
+import asyncio
 import logging
 from components import ExpandedQuestion
 from utils.cache_manager import cache_result
@@ -24,6 +25,12 @@ class QuestionExpander(ABC):
         """
         pass
 
+    async def expand_async(self, task_id: str, role_prompt: str, sub_topic: SubTopic) -> ExpandedQuestion:
+        """
+        async version of expand, runs expand in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.expand, task_id, role_prompt, sub_topic)
+
 
 def key_gen(*args, **kwargs) -> str:
     sub_topic: SubTopic = kwargs.get("sub_topic") if kwargs.get(
@@ -57,9 +64,35 @@ class DefaultQuestionExpander(QuestionExpander):
         logger.info(
             f"expanding sub_topic: {sub_topic} using role prompt: {role_prompt}, expander: {self}")
 
-        prompt = self.prompt_provider.search_queries_prompt(sub_topic)
+        response = self.llm_util.get_smart_result(
+            messages=self.__build_messages(role_prompt, sub_topic),
+            task_id=task_id,
+            stage="expand"
+        )
+        logger.debug(
+            f"expanded sub_topic: {sub_topic} using role prompt: {role_prompt}, expander: {self}, expanded raw question: {response}")
+
+        return self.__extract_expanded_question(role_prompt, sub_topic, response)
+
+    @cache_result("expanded_questions", cache_class=ExpandedQuestion, key_gen=key_gen)
+    @time_usage
+    async def expand_async(self, task_id: str, role_prompt: str, sub_topic: SubTopic) -> ExpandedQuestion:
+        logger.info(
+            f"async expanding sub_topic: {sub_topic} using role prompt: {role_prompt}, expander: {self}")
 
-        messages = [
+        response = await self.llm_util.get_smart_result_async(
+            messages=self.__build_messages(role_prompt, sub_topic),
+            task_id=task_id,
+            stage="expand"
+        )
+        logger.debug(
+            f"expanded sub_topic: {sub_topic} using role prompt: {role_prompt}, expander: {self}, expanded raw question: {response}")
+
+        return self.__extract_expanded_question(role_prompt, sub_topic, response)
+
+    def __build_messages(self, role_prompt: str, sub_topic: SubTopic) -> list[dict[str, str]]:
+        prompt = self.prompt_provider.search_queries_prompt(sub_topic)
+        return [
             {
                 "role": "system",
                 "content": role_prompt
@@ -69,11 +102,3 @@ class DefaultQuestionExpander(QuestionExpander):
                 "content": prompt
             }
         ]
-        response = self.llm_util.get_smart_result(
-            messages=messages,
-            task_id=task_id
-        )
-        logger.debug(
-            f"expanded sub_topic: {sub_topic} using role prompt: {role_prompt}, expander: {self}, expanded raw question: {response}")
-
-        return self.__extract_expanded_question(role_prompt, sub_topic, response)
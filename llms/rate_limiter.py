@@ -0,0 +1,152 @@
+"""
+per model requests-per-minute and tokens-per-minute limits of the llm api.
+
+every call takes one request and its estimated tokens from the token buckets of its model, and waits in line when
+a bucket is empty, so bursts are spread out instead of being answered with 429s. the estimate is corrected with the
+real usage once the response is back.
+"""
+
+from typing import Optional
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.time()
+
+    def wait_for(self, amount: float) -> float:
+        """
+        seconds until amount is available, 0 if it is available now.
+        not thread safe, the caller holds the lock.
+        """
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        # a single request larger than the bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float) -> None:
+        """
+        correct a previous estimate, negative amount takes more
+        """
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelLimit:
+
+    def __init__(self, model: str, rpm: Optional[int], tpm: Optional[int]) -> None:
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.requested = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.retries = 0
+
+    def try_take(self, tokens: int) -> float:
+        """
+        take one request and tokens, return 0. or return the seconds worth waiting, taking nothing,
+        so a waiting request never holds half of its budget.
+        """
+        wait_seconds = max(self.requests.wait_for(1) if self.requests else 0,
+                           self.tokens.wait_for(tokens) if self.tokens else 0)
+        if wait_seconds > 0:
+            return wait_seconds
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+        return 0
+
+
+class RateLimiter:
+
+    def __init__(self, limits: dict[str, dict]) -> None:
+        """
+        Args:
+            limits (dict[str, dict]): model -> {"rpm": requests per minute, "tpm": tokens per minute}, null means no limit
+        """
+        self.limits = {model: ModelLimit(model, limit.get("rpm"), limit.get("tpm")) for model, limit in limits.items()}
+        self.lock = threading.Lock()
+
+    def acquire(self, model: str, tokens: int) -> None:
+        limit = self.limits.get(model)
+        if limit is None:
+            return
+        start = time.time()
+        while True:
+            with self.lock:
+                wait_seconds = limit.try_take(tokens)
+            if wait_seconds == 0:
+                break
+            time.sleep(min(wait_seconds, 1))
+        self.__record_wait(limit, time.time() - start)
+
+    async def acquire_async(self, model: str, tokens: int) -> None:
+        limit = self.limits.get(model)
+        if limit is None:
+            return
+        start = time.time()
+        while True:
+            with self.lock:
+                wait_seconds = limit.try_take(tokens)
+            if wait_seconds == 0:
+                break
+            await asyncio.sleep(min(wait_seconds, 1))
+        self.__record_wait(limit, time.time() - start)
+
+    def correct(self, model: str, estimated_tokens: int, used_tokens: int) -> None:
+        """
+        give back, or take more of, the tokens of a call once its real usage is known
+        """
+        limit = self.limits.get(model)
+        if limit is None or limit.tokens is None:
+            return
+        with self.lock:
+            limit.tokens.give_back(estimated_tokens - used_tokens)
+
+    def record_retry(self, model: str) -> None:
+        limit = self.limits.get(model)
+        if limit is None:
+            return
+        with self.lock:
+            limit.retries += 1
+
+    def stats(self) -> dict[str, dict]:
+        """
+        per model queue-wait metrics
+        """
+        with self.lock:
+            return {model: {
+                "requests": limit.requested,
+                "waited_requests": limit.waited,
+                "wait_seconds": round(limit.wait_seconds, 3),
+                "max_wait_seconds": round(limit.max_wait_seconds, 3),
+                "retries": limit.retries
+            } for model, limit in self.limits.items()}
+
+    def __record_wait(self, limit: ModelLimit, waited: float) -> None:
+        with self.lock:
+            limit.requested += 1
+            if waited > 0.01:
+                limit.waited += 1
+                limit.wait_seconds += waited
+                limit.max_wait_seconds = max(limit.max_wait_seconds, waited)
+        if waited > 1:
+            logger.debug(f"waited {waited:.1f}s for rate limit of {limit.model}")
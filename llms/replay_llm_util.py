@@ -0,0 +1,237 @@
+"""
+record and replay of llm calls, see utils.fixtures.
+
+a call is keyed by its tier, messages, temperature and max_tokens. a streamed call keeps its chunks and the delay before
+each of them, and is replayed chunk by chunk. a streamed call without a streamed fixture is served from the complete
+one, and the other way round, so switching the report between streaming and not does not need a new recording.
+"""
+
+from llms.base_llm_util import LLMUtil
+from llms.chunker import TokenCounter
+from llms.token_accountant import TokenAccountant
+from utils.fixtures import FixtureBundle, FixtureMissing
+from utils.scheduler import Scheduler
+from utils.events import EventBus
+from components import LLMTokenBill, TokenType, TokenUsage
+from typing import Generator, AsyncGenerator, Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def llm_key(tier: str, stream: bool, messages, temperature, max_tokens) -> str:
+    return FixtureBundle.key("stream" if stream else "complete", tier, messages, temperature, max_tokens)
+
+
+class RecordingLLMUtil(LLMUtil):
+    """
+    answers with the wrapped llm util, and writes every answer to the bundle
+    """
+
+    def __init__(self, llm_util: LLMUtil, bundle: FixtureBundle) -> None:
+        self.llm_util = llm_util
+        self.bundle = bundle
+
+    def get_fast_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        start = time.time()
+        result = self.llm_util.get_fast_result(messages, temperature, max_tokens, **kwargs)
+        self.__record("fast", messages, temperature, max_tokens, result, time.time() - start)
+        return result
+
+    def get_fast_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
+        return self.__record_stream("fast", self.llm_util.get_fast_stream_result(messages, temperature, max_tokens, **kwargs),
+                                    messages, temperature, max_tokens)
+
+    def get_smart_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        start = time.time()
+        result = self.llm_util.get_smart_result(messages, temperature, max_tokens, **kwargs)
+        self.__record("smart", messages, temperature, max_tokens, result, time.time() - start)
+        return result
+
+    def get_smart_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
+        return self.__record_stream("smart", self.llm_util.get_smart_stream_result(messages, temperature, max_tokens, **kwargs),
+                                    messages, temperature, max_tokens)
+
+    async def get_fast_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        start = time.time()
+        result = await self.llm_util.get_fast_result_async(messages, temperature, max_tokens, **kwargs)
+        self.__record("fast", messages, temperature, max_tokens, result, time.time() - start)
+        return result
+
+    async def get_fast_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        async for chunk in self.__record_stream_async(
+                "fast", self.llm_util.get_fast_stream_result_async(messages, temperature, max_tokens, **kwargs),
+                messages, temperature, max_tokens):
+            yield chunk
+
+    async def get_smart_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        start = time.time()
+        result = await self.llm_util.get_smart_result_async(messages, temperature, max_tokens, **kwargs)
+        self.__record("smart", messages, temperature, max_tokens, result, time.time() - start)
+        return result
+
+    async def get_smart_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        async for chunk in self.__record_stream_async(
+                "smart", self.llm_util.get_smart_stream_result_async(messages, temperature, max_tokens, **kwargs),
+                messages, temperature, max_tokens):
+            yield chunk
+
+    def split_for_fast(self, content: str, **kwargs) -> list[str]:
+        # chunking depends on the token counter installed, keep the chunks so replay sends the same prompts
+        chunks = self.llm_util.split_for_fast(content, **kwargs)
+        self.bundle.put("llm", FixtureBundle.key("split", "fast", content), {"chunks": chunks})
+        return chunks
+
+    def split_for_smart(self, content: str, **kwargs) -> list[str]:
+        chunks = self.llm_util.split_for_smart(content, **kwargs)
+        self.bundle.put("llm", FixtureBundle.key("split", "smart", content), {"chunks": chunks})
+        return chunks
+
+    def get_bill(self, task_id: str) -> LLMTokenBill:
+        return self.llm_util.get_bill(task_id)
+
+    def flush_token_use(self, task_id: str) -> None:
+        self.llm_util.flush_token_use(task_id)
+
+    def get_stats(self) -> dict[str, dict]:
+        return self.llm_util.get_stats()
+
+    def __record(self, tier: str, messages, temperature, max_tokens, result: str, latency: float) -> None:
+        self.bundle.put("llm", llm_key(tier, False, messages, temperature, max_tokens),
+                        {"result": result, "latency": latency})
+
+    def __record_stream(self, tier: str, stream: Generator[str, None, None], messages, temperature, max_tokens) -> Generator[str, None, None]:
+        chunks, delays = [], []
+        start = time.time()
+        for chunk in stream:
+            delays.append(time.time() - start)
+            chunks.append(chunk)
+            yield chunk
+            start = time.time()
+        # a stream given up half way is not recorded
+        self.bundle.put("llm", llm_key(tier, True, messages, temperature, max_tokens), {"chunks": chunks, "delays": delays})
+
+    async def __record_stream_async(self, tier: str, stream: AsyncGenerator[str, None], messages, temperature, max_tokens) -> AsyncGenerator[str, None]:
+        chunks, delays = [], []
+        start = time.time()
+        async for chunk in stream:
+            delays.append(time.time() - start)
+            chunks.append(chunk)
+            yield chunk
+            start = time.time()
+        self.bundle.put("llm", llm_key(tier, True, messages, temperature, max_tokens), {"chunks": chunks, "delays": delays})
+
+
+class ReplayLLMUtil(LLMUtil):
+    """
+    answers from the bundle, raises FixtureMissing for a call that was never recorded.
+    tokens are counted from the prompts and answers, the bill has no price, offline runs cost nothing.
+    """
+
+    def __init__(self, bundle: FixtureBundle) -> None:
+        self.bundle = bundle
+        self.scheduler = Scheduler()
+        self.token_counter = TokenCounter()
+        self.accountant = TokenAccountant()
+
+    def get_fast_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return self.__replay("fast", messages, temperature, max_tokens, **kwargs)
+
+    def get_fast_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
+        return self.__replay_stream("fast", messages, temperature, max_tokens, **kwargs)
+
+    def get_smart_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return self.__replay("smart", messages, temperature, max_tokens, **kwargs)
+
+    def get_smart_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> Generator[str, None, None]:
+        return self.__replay_stream("smart", messages, temperature, max_tokens, **kwargs)
+
+    async def get_fast_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return await self.__replay_async("fast", messages, temperature, max_tokens, **kwargs)
+
+    async def get_fast_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        async for chunk in self.__replay_stream_async("fast", messages, temperature, max_tokens, **kwargs):
+            yield chunk
+
+    async def get_smart_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return await self.__replay_async("smart", messages, temperature, max_tokens, **kwargs)
+
+    async def get_smart_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> AsyncGenerator[str, None]:
+        async for chunk in self.__replay_stream_async("smart", messages, temperature, max_tokens, **kwargs):
+            yield chunk
+
+    def split_for_fast(self, content: str, **kwargs) -> list[str]:
+        fixture = self.bundle.get("llm", FixtureBundle.key("split", "fast", content))
+        return fixture["chunks"] if fixture else [content]
+
+    def split_for_smart(self, content: str, **kwargs) -> list[str]:
+        fixture = self.bundle.get("llm", FixtureBundle.key("split", "smart", content))
+        return fixture["chunks"] if fixture else [content]
+
+    def get_bill(self, task_id: str) -> LLMTokenBill:
+        usage: list[TokenUsage] = []
+        for model, model_usage in self.accountant.get_usage(task_id).items():
+            if model == "bill" or not isinstance(model_usage, dict):
+                continue
+            usage.append(TokenUsage(model, TokenType.Completion, model_usage['completion_tokens']))
+            usage.append(TokenUsage(model, TokenType.Prompt, model_usage['prompt_tokens']))
+        if not usage:
+            return None
+        return LLMTokenBill(usage, [])
+
+    def flush_token_use(self, task_id: str) -> None:
+        self.accountant.flush(task_id)
+
+    def __replay(self, tier: str, messages, temperature, max_tokens, **kwargs) -> str:
+        fixture = self.__fixture(tier, False, messages, temperature, max_tokens)
+        with self.scheduler.acquire(tier + "_llm"):
+            self.bundle.sleep("llm", fixture.get("latency", sum(fixture.get("delays", []))))
+        result = fixture["result"] if "result" in fixture else "".join(fixture["chunks"])
+        self.__record_token_use(tier, messages, result, **kwargs)
+        return result
+
+    async def __replay_async(self, tier: str, messages, temperature, max_tokens, **kwargs) -> str:
+        fixture = self.__fixture(tier, False, messages, temperature, max_tokens)
+        async with self.scheduler.acquire_async(tier + "_llm"):
+            await self.bundle.sleep_async("llm", fixture.get("latency", sum(fixture.get("delays", []))))
+        result = fixture["result"] if "result" in fixture else "".join(fixture["chunks"])
+        self.__record_token_use(tier, messages, result, **kwargs)
+        return result
+
+    def __replay_stream(self, tier: str, messages, temperature, max_tokens, **kwargs) -> Generator[str, None, None]:
+        fixture = self.__fixture(tier, True, messages, temperature, max_tokens)
+        with self.scheduler.acquire(tier + "_llm"):
+            for chunk, delay in self.__chunks(fixture):
+                self.bundle.sleep("llm", delay)
+                yield chunk
+        self.__record_token_use(tier, messages, "".join([c for c, _ in self.__chunks(fixture)]), **kwargs)
+
+    async def __replay_stream_async(self, tier: str, messages, temperature, max_tokens, **kwargs) -> AsyncGenerator[str, None]:
+        fixture = self.__fixture(tier, True, messages, temperature, max_tokens)
+        async with self.scheduler.acquire_async(tier + "_llm"):
+            for chunk, delay in self.__chunks(fixture):
+                await self.bundle.sleep_async("llm", delay)
+                yield chunk
+        self.__record_token_use(tier, messages, "".join([c for c, _ in self.__chunks(fixture)]), **kwargs)
+
+    def __fixture(self, tier: str, stream: bool, messages, temperature, max_tokens) -> dict:
+        fixture = self.bundle.get("llm", llm_key(tier, stream, messages, temperature, max_tokens)) \
+            or self.bundle.get("llm", llm_key(tier, not stream, messages, temperature, max_tokens))
+        if fixture is None:
+            raise FixtureMissing(f"no recorded {tier} llm call for messages: {str(messages)[:200]}")
+        return fixture
+
+    def __chunks(self, fixture: dict) -> list[tuple[str, float]]:
+        if "chunks" in fixture:
+            return list(zip(fixture["chunks"], fixture["delays"]))
+        return [(fixture["result"], fixture["latency"])]
+
+    def __record_token_use(self, tier: str, messages, result: str, **kwargs) -> None:
+        task_id: Optional[str] = kwargs.get("task_id")
+        if task_id is None:
+            return
+        prompt_tokens = self.token_counter.count_messages(messages)
+        completion_tokens = self.token_counter.count(result)
+        EventBus().record_tokens(task_id, prompt_tokens, completion_tokens)
+        self.accountant.record(task_id, "replay-" + tier, prompt_tokens, completion_tokens, kwargs.get("stage"))
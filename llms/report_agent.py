@@ -1,11 +1,18 @@
 from abc import ABC, abstractmethod
 from components import CrawledPage, Summary, FinalReport
 from llms.base_llm_util import LLMUtil
+from llms.chunker import TokenCounter
 from llms.prompt_provider import PromptProvider
 from llms.report_outline_generator import ReportOutline, SubTopic
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, AsyncGenerator
+import asyncio
+import hashlib
 import logging
-from utils.cache_manager import cache_result
+import re
+from utils.cache_manager import cache_result, get_or_create_cache, update_and_save_cache
 from utils.time_usage_record import time_usage
+from utils.config_center import Config
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +23,12 @@ class SummaryGenerator(ABC):
     def generate(self, task_id: str, role_prompt: str, page: CrawledPage, sub_topic: SubTopic) -> Summary:
         pass
 
+    async def generate_async(self, task_id: str, role_prompt: str, page: CrawledPage, sub_topic: SubTopic) -> Summary:
+        """
+        async version of generate, runs generate in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.generate, task_id, role_prompt, page, sub_topic)
+
 
 def key_gen(*args, **kwargs) -> str:
     page: CrawledPage = kwargs.get("page") if kwargs.get("page") else args[3]
@@ -34,6 +47,9 @@ class DefaultSummaryGenerator(SummaryGenerator):
         """
         self.llm_util = llm_util
         self.prompt_provider = prompt_provider
+        # summaries are packed up to the size of the chunks of split_for_fast
+        self.token_counter = TokenCounter()
+        self.max_tokens = Config().get_config("llms").get("openai", {}).get("chunk", {}).get("tokens", 2500)
 
     @cache_result("summaries", cache_class=Summary, key_gen=key_gen)
     @time_usage
@@ -41,34 +57,85 @@ class DefaultSummaryGenerator(SummaryGenerator):
         logger.info(
             f"generate summary use page {page.url} for sub topic {sub_topic}")
         chunks = self.llm_util.split_for_fast(page.content)
-        chunk_dict = {}
-        for chunk in chunks:
-            prompt = self.prompt_provider.summary_prompt(
-                content=chunk, sub_topic=sub_topic)
-            chunk_summary = self.llm_util.get_fast_result(messages=[
-                {
-                    "role": "system",
-                    "content": role_prompt
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }], task_id=task_id)
-            chunk_dict[chunk] = chunk_summary
-        if len(chunk_dict) == 1:
-            return Summary(sub_topic=sub_topic, page=page, chunks=chunk_dict, summary=list(chunk_dict.values())[0])
-        else:
-            summary = self.llm_util.get_fast_result(messages=[
-                {
-                    "role": "system",
-                    "content": role_prompt
-                },
-                {
-                    "role": "user",
-                    "content": self.prompt_provider.summary_prompt(
-                        content="\n\n".join(chunk_dict.values()), sub_topic=sub_topic)
-                }], task_id=task_id)
-            return Summary(sub_topic=sub_topic, page=page, chunks=chunk_dict, summary=summary)
+        chunk_dict = dict(zip(chunks, self.__summarize_all(task_id, role_prompt, chunks, sub_topic)))
+        level = list(chunk_dict.values())
+        # tree reduce, every level packs as many summaries into one call as fits
+        while len(level) > 1:
+            groups = self.__pack(level)
+            level = self.__summarize_all(task_id, role_prompt, ["\n\n".join(group) for group in groups], sub_topic,
+                                         skip=[len(group) == 1 for group in groups])
+        return Summary(sub_topic=sub_topic, page=page, chunks=chunk_dict, summary=level[0])
+
+    @cache_result("summaries", cache_class=Summary, key_gen=key_gen)
+    @time_usage
+    async def generate_async(self, task_id: str, role_prompt: str, page: CrawledPage, sub_topic: SubTopic) -> Summary:
+        logger.info(
+            f"async generate summary use page {page.url} for sub topic {sub_topic}")
+        chunks = self.llm_util.split_for_fast(page.content)
+        chunk_dict = dict(zip(chunks, await self.__summarize_all_async(task_id, role_prompt, chunks, sub_topic)))
+        level = list(chunk_dict.values())
+        while len(level) > 1:
+            groups = self.__pack(level)
+            level = await self.__summarize_all_async(task_id, role_prompt, ["\n\n".join(group) for group in groups],
+                                                     sub_topic, skip=[len(group) == 1 for group in groups])
+        return Summary(sub_topic=sub_topic, page=page, chunks=chunk_dict, summary=level[0])
+
+    def __summarize_all(self, task_id: str, role_prompt: str, contents: list[str], sub_topic: SubTopic,
+                        skip: list[bool] = None) -> list[str]:
+        """
+        summarize the contents concurrently, in order. contents marked in skip are returned as they are
+        """
+        skip = skip or [False] * len(contents)
+        with ThreadPoolExecutor(max_workers=len(contents)) as executor:
+            futures = [None if s else executor.submit(self.llm_util.get_fast_result,
+                                                      messages=self.__build_messages(role_prompt, c, sub_topic),
+                                                      task_id=task_id, stage="summary")
+                       for c, s in zip(contents, skip)]
+            return [c if f is None else f.result() for c, f in zip(contents, futures)]
+
+    async def __summarize_all_async(self, task_id: str, role_prompt: str, contents: list[str], sub_topic: SubTopic,
+                                    skip: list[bool] = None) -> list[str]:
+        skip = skip or [False] * len(contents)
+
+        async def summarize(content: str, skipped: bool) -> str:
+            if skipped:
+                return content
+            return await self.llm_util.get_fast_result_async(
+                messages=self.__build_messages(role_prompt, content, sub_topic), task_id=task_id, stage="summary")
+        return list(await asyncio.gather(*[summarize(c, s) for c, s in zip(contents, skip)]))
+
+    def __pack(self, summaries: list[str]) -> list[list[str]]:
+        """
+        group consecutive summaries so that each group fits one fast call.
+        a group always takes at least two summaries (the last may be left alone), so every level shrinks.
+        """
+        separator_tokens = self.token_counter.count("\n\n")
+        groups = []
+        group = []
+        group_tokens = 0
+        for summary in summaries:
+            tokens = self.token_counter.count(summary)
+            if len(group) >= 2 and group_tokens + separator_tokens + tokens > self.max_tokens:
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group_tokens += (separator_tokens if group else 0) + tokens
+            group.append(summary)
+        if group:
+            groups.append(group)
+        return groups
+
+    def __build_messages(self, role_prompt: str, content: str, sub_topic: SubTopic) -> list[dict[str, str]]:
+        return [
+            {
+                "role": "system",
+                "content": role_prompt
+            },
+            {
+                "role": "user",
+                "content": self.prompt_provider.summary_prompt(
+                    content=content, sub_topic=sub_topic)
+            }]
 
 
 class ReportAgent(ABC):
@@ -80,6 +147,42 @@ class ReportAgent(ABC):
         """
         pass
 
+    async def generate_async(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> FinalReport:
+        """
+        async version of generate, runs generate in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.generate, task_id, role_prompt, summaries, topic, outline)
+
+    def generate_stream(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> Generator[str, None, None]:
+        """
+        yield the report as it is written, the whole report in one piece unless overrided
+        """
+        yield self.generate(task_id, role_prompt, summaries, topic, outline).report
+
+    async def generate_stream_async(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> AsyncGenerator[str, None]:
+        """
+        async version of generate_stream
+        """
+        yield (await self.generate_async(task_id, role_prompt, summaries, topic, outline)).report
+
+
+def order_summaries(summaries: list[Summary], outline: ReportOutline = None) -> list[Summary]:
+    """
+    summaries come in the order they were done, which depends on timing. the same summaries make the same prompt
+    in this order: sub topics as in the outline, then by page url (the query for a merged page)
+    """
+    rank = {s.sub_topic: i for i, s in enumerate(outline.sub_topics)} if outline else {}
+    return sorted(summaries, key=lambda s: (rank.get(s.sub_topic.sub_topic, len(rank)), s.sub_topic.sub_topic,
+                                            s.page.url if s.page else "", s.summary))
+
+
+def report_key_gen(*args, **kwargs) -> str:
+    # a report written from fewer summaries (a deadline was hit, for example) must not be reused for the full one
+    topic = kwargs.get("topic") if kwargs.get("topic") else args[4]
+    summaries = kwargs.get("summaries") if kwargs.get("summaries") is not None else args[3]
+    digest = hashlib.md5("\n\n".join([s.summary for s in order_summaries(summaries)]).encode("utf-8")).hexdigest()
+    return f"{topic}:::{digest}"
+
 
 class DefaultReportAgent(ReportAgent):
 
@@ -92,16 +195,66 @@ class DefaultReportAgent(ReportAgent):
         self.llm_util = llm_util
         self.prompt_provider = prompt_provider
 
-    @cache_result("final_reports", cache_class=FinalReport, key_gen=lambda *args, **kwargs: kwargs.get("topic") if kwargs.get("topic") else args[4])
+    @cache_result("final_reports", cache_class=FinalReport, key_gen=report_key_gen)
     @time_usage
     def generate(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> FinalReport:
         logger.info(
             f"call get report for topic {topic} and summaries {summaries}")
+        report = self.llm_util.get_smart_result(
+            messages=self.__build_messages(role_prompt, summaries, topic, outline), task_id=task_id, stage="report")
+        logger.debug(f"{topic} has report {report[:100]}")
+
+        return FinalReport(report=report)
+
+    @cache_result("final_reports", cache_class=FinalReport, key_gen=report_key_gen)
+    @time_usage
+    async def generate_async(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> FinalReport:
+        logger.info(
+            f"async call get report for topic {topic} and summaries {summaries}")
+        report = await self.llm_util.get_smart_result_async(
+            messages=self.__build_messages(role_prompt, summaries, topic, outline), task_id=task_id, stage="report")
+        logger.debug(f"{topic} has report {report[:100]}")
+
+        return FinalReport(report=report)
+
+    def generate_stream(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> Generator[str, None, None]:
+        """
+        the FinalReport is cached only when the stream completes, a cached report is yielded in one piece
+        """
+        key = report_key_gen(self, task_id, role_prompt, summaries, topic, outline)
+        cached = get_or_create_cache(task_id, "final_reports", key)
+        if cached:
+            yield FinalReport.deserialize(FinalReport, cached).report
+            return
+        logger.info(
+            f"call stream report for topic {topic} and summaries {summaries}")
+        chunks = []
+        for chunk in self.llm_util.get_smart_stream_result(
+                messages=self.__build_messages(role_prompt, summaries, topic, outline), task_id=task_id, stage="report"):
+            chunks.append(chunk)
+            yield chunk
+        update_and_save_cache(task_id, "final_reports", key, FinalReport(report="".join(chunks)).serialize())
+
+    async def generate_stream_async(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> AsyncGenerator[str, None]:
+        key = report_key_gen(self, task_id, role_prompt, summaries, topic, outline)
+        cached = get_or_create_cache(task_id, "final_reports", key)
+        if cached:
+            yield FinalReport.deserialize(FinalReport, cached).report
+            return
+        logger.info(
+            f"async call stream report for topic {topic} and summaries {summaries}")
+        chunks = []
+        async for chunk in self.llm_util.get_smart_stream_result_async(
+                messages=self.__build_messages(role_prompt, summaries, topic, outline), task_id=task_id, stage="report"):
+            chunks.append(chunk)
+            yield chunk
+        update_and_save_cache(task_id, "final_reports", key, FinalReport(report="".join(chunks)).serialize())
+
+    def __build_messages(self, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> list[dict[str, str]]:
         prompt = self.prompt_provider.final_report_prompt(topic=topic,
                                                           outline=outline,
-                                                          summary="\n\n".join([summary.summary for summary in summaries]))
-
-        report = self.llm_util.get_smart_result(messages=[
+                                                          summary="\n\n".join([summary.summary for summary in order_summaries(summaries, outline)]))
+        return [
             {
                 "role": "system",
                 "content": role_prompt
@@ -109,7 +262,127 @@ class DefaultReportAgent(ReportAgent):
             {
                 "role": "user",
                 "content": prompt
-            }], task_id=task_id)
-        logger.debug(f"{topic} has report {report[:100]}")
+            }]
 
-        return FinalReport(report=report)
+
+def section_report_key_gen(*args, **kwargs) -> str:
+    return "sections:::" + report_key_gen(*args, **kwargs)
+
+
+class SectionReportAgent(ReportAgent):
+    """
+    writes every section of the outline concurrently, each from the summaries of its own sub topic only,
+    then a short stitching pass writes the introduction and the conclusion.
+    wall time is about one section plus the stitch, and every prompt stays small.
+    """
+
+    def __init__(self, prompt_provider: PromptProvider, llm_util: LLMUtil, section_llm: str = "fast") -> None:
+        """
+        Args:
+            llm_util (LLMUtil): LLMUtil object
+            prompt_provider (PromptProvider): PromptProvider object
+            section_llm (str): "fast" or "smart", the model used for the sections, the stitch always uses smart
+        """
+        self.llm_util = llm_util
+        self.prompt_provider = prompt_provider
+        self.section_llm = section_llm
+
+    @cache_result("final_reports", cache_class=FinalReport, key_gen=section_report_key_gen)
+    @time_usage
+    def generate(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> FinalReport:
+        logger.info(
+            f"call get section report for topic {topic} and {len(summaries)} summaries")
+        with ThreadPoolExecutor(max_workers=max(len(outline.sub_topics), 1)) as executor:
+            sections = list(executor.map(
+                lambda sub_topic: self.__write_section(task_id, role_prompt, topic, sub_topic, summaries),
+                outline.sub_topics))
+        stitch = self.llm_util.get_smart_result(
+            messages=self.__build_stitch_messages(role_prompt, topic, outline, sections), task_id=task_id, stage="report")
+        return FinalReport(report=self.__assemble(outline, sections, stitch))
+
+    @cache_result("final_reports", cache_class=FinalReport, key_gen=section_report_key_gen)
+    @time_usage
+    async def generate_async(self, task_id: str, role_prompt: str, summaries: list[Summary], topic: str, outline: ReportOutline) -> FinalReport:
+        logger.info(
+            f"async call get section report for topic {topic} and {len(summaries)} summaries")
+        sections = await asyncio.gather(*[self.__write_section_async(task_id, role_prompt, topic, sub_topic, summaries)
+                                          for sub_topic in outline.sub_topics])
+        stitch = await self.llm_util.get_smart_result_async(
+            messages=self.__build_stitch_messages(role_prompt, topic, outline, sections), task_id=task_id, stage="report")
+        return FinalReport(report=self.__assemble(outline, list(sections), stitch))
+
+    def __write_section(self, task_id: str, role_prompt: str, topic: str, sub_topic: SubTopic, summaries: list[Summary]) -> str:
+        messages = self.__build_section_messages(role_prompt, topic, sub_topic, summaries)
+        if messages is None:
+            return ""
+        if self.section_llm == "smart":
+            return self.llm_util.get_smart_result(messages=messages, task_id=task_id, stage="report")
+        return self.llm_util.get_fast_result(messages=messages, task_id=task_id, stage="report")
+
+    async def __write_section_async(self, task_id: str, role_prompt: str, topic: str, sub_topic: SubTopic, summaries: list[Summary]) -> str:
+        messages = self.__build_section_messages(role_prompt, topic, sub_topic, summaries)
+        if messages is None:
+            return ""
+        if self.section_llm == "smart":
+            return await self.llm_util.get_smart_result_async(messages=messages, task_id=task_id, stage="report")
+        return await self.llm_util.get_fast_result_async(messages=messages, task_id=task_id, stage="report")
+
+    def __build_section_messages(self, role_prompt: str, topic: str, sub_topic: SubTopic, summaries: list[Summary]) -> list[dict[str, str]]:
+        """
+        None if there is no material for the section, nothing worth an llm call
+        """
+        section_summaries = [s.summary for s in order_summaries(summaries) if s.sub_topic.sub_topic == sub_topic.sub_topic]
+        if not section_summaries:
+            logger.warning(f"no summaries for section {sub_topic.sub_topic}")
+            return None
+        return [
+            {
+                "role": "system",
+                "content": role_prompt
+            },
+            {
+                "role": "user",
+                "content": self.prompt_provider.section_prompt(topic=topic, sub_topic=sub_topic,
+                                                               summary="\n\n".join(section_summaries))
+            }]
+
+    def __build_stitch_messages(self, role_prompt: str, topic: str, outline: ReportOutline, sections: list[str]) -> list[dict[str, str]]:
+        return [
+            {
+                "role": "system",
+                "content": role_prompt
+            },
+            {
+                "role": "user",
+                "content": self.prompt_provider.stitch_prompt(topic=topic, outline=outline,
+                                                              sections=self.__join_sections(outline, sections))
+            }]
+
+    def __assemble(self, outline: ReportOutline, sections: list[str], stitch: str) -> str:
+        introduction, separator, conclusion = stitch.partition("===CONCLUSION===")
+        if not separator:
+            logger.warning(f"no conclusion separator in stitch response, use it as the conclusion: {stitch[:100]}")
+            introduction, conclusion = "", stitch
+        title = outline.top_heading.split("\n")[0].strip()
+        if not title.startswith("#"):
+            title = f"# {outline.topic}"
+        return f"{title}\n\n{introduction.strip()}\n\n{self.__join_sections(outline, sections)}\n\n" \
+            f"## {self.__heading(outline.conclusion)}\n\n{conclusion.strip()}\n"
+
+    def __join_sections(self, outline: ReportOutline, sections: list[str]) -> str:
+        return "\n\n".join([f"## {self.__heading(sub_topic)}\n\n{self.__strip_heading(section)}"
+                             for sub_topic, section in zip(outline.sub_topics, sections)])
+
+    def __heading(self, sub_topic: SubTopic) -> str:
+        """
+        the outline heading without the markdown marks and the suggested length, "## Box office (200 words)" -> "Box office"
+        """
+        heading = sub_topic.sub_topic.lstrip("#").strip()
+        return re.sub(r"\s*[(（][^()（）]*\d+[^()（）]*[)）]\s*$", "", heading)
+
+    def __strip_heading(self, section: str) -> str:
+        # the model is asked not to, but sometimes repeats the heading anyway
+        section = section.strip()
+        if section.startswith("#"):
+            section = section.partition("\n")[2].strip()
+        return section
@@ -9,6 +9,7 @@ from llms.base_llm_util import LLMUtil
 from components import ReportOutline, SubTopic
 from utils.cache_manager import cache_result
 from utils.time_usage_record import time_usage
+import asyncio
 
 class ReportOutlineGenerator(ABC):
 
@@ -23,6 +24,16 @@ class ReportOutlineGenerator(ABC):
         """
         pass
 
+    async def generate_async(self, task_id: str, role_prompt: str, topic: str) -> ReportOutline:
+        """
+        async version of generate, runs generate in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.generate, task_id, role_prompt, topic)
+
+
+def key_gen(*args, **kwargs) -> str:
+    return kwargs.get("topic") if kwargs.get("topic") else args[3]
+
 
 class DefaultOutlineGenerator(ReportOutlineGenerator):
 
@@ -30,11 +41,25 @@ class DefaultOutlineGenerator(ReportOutlineGenerator):
         self.prompt_provider = prompt_provider
         self.llm_util = llmutil
 
-    @cache_result("report_outlines", cache_class=ReportOutline, key_gen=lambda *args, **kwargs: kwargs.get("topic") if kwargs.get("topic") else args[3])
+    @cache_result("report_outlines", cache_class=ReportOutline, key_gen=key_gen)
     @time_usage
     def generate(self, task_id: str, role_prompt: str, topic: str) -> ReportOutline:
+        response = self.llm_util.get_smart_result(
+            self.__build_messages(role_prompt, topic), task_id=task_id, stage="outline")
+
+        return self.parse_response(topic, response)
+
+    @cache_result("report_outlines", cache_class=ReportOutline, key_gen=key_gen)
+    @time_usage
+    async def generate_async(self, task_id: str, role_prompt: str, topic: str) -> ReportOutline:
+        response = await self.llm_util.get_smart_result_async(
+            self.__build_messages(role_prompt, topic), task_id=task_id, stage="outline")
+
+        return self.parse_response(topic, response)
+
+    def __build_messages(self, role_prompt: str, topic: str) -> list[dict[str, str]]:
         prompt = self.prompt_provider.outline_prompt(topic)
-        response = self.llm_util.get_smart_result([
+        return [
             {
                 "role": "system",
                 "content": role_prompt
@@ -42,9 +67,7 @@ class DefaultOutlineGenerator(ReportOutlineGenerator):
             {
                 "role": "user",
                 "content": prompt
-            }], task_id=task_id)
-
-        return self.parse_response(topic, response)
+            }]
 
     def parse_response(self, topic: str, response: str) -> ReportOutline:
         import re
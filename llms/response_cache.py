@@ -0,0 +1,149 @@
+"""
+content-addressed cache of llm responses, shared by all tasks and processes.
+
+the key is a hash of (model, messages, temperature, max_tokens), so the same page summarized for two topics, or a
+topic researched again under another name, is paid for only once. entries are kept in a sqlite file, the least
+recently used ones are evicted when the file grows past max_mb. a hit is only a read, the access times of hits are
+kept in memory and written in batches.
+"""
+
+from typing import Optional
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+
+    def __init__(self, path: str, max_mb: int = 512, evict_every: int = 100, touch_every: int = 100) -> None:
+        """
+        Args:
+            path (str): the sqlite file
+            max_mb (int): evict least recently used entries when the responses take more than this
+            evict_every (int): check the size every evict_every writes
+            touch_every (int): write the access times of hits every touch_every hits
+        """
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.evict_every = evict_every
+        self.touch_every = touch_every
+        # key -> access time of hits not written yet
+        self.touched: dict[str, float] = {}
+        self.untouched_hits = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        conn = self.__conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses(accessed_at)")
+
+    def __conn(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self.local.conn
+
+    def key(self, model: str, messages: list[dict[str, str]], temperature: float, max_tokens: Optional[int]) -> str:
+        return hashlib.sha256(json.dumps({
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            conn = self.__conn()
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"error when reading llm response cache: {e}")
+            row = None
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.touched[key] = time.time()
+                self.untouched_hits += 1
+            touch = self.untouched_hits >= self.touch_every
+        if touch:
+            self.flush_touched()
+        return row[0] if row else None
+
+    def flush_touched(self) -> None:
+        """
+        write the access times of the hits so far
+        """
+        with self.lock:
+            touched, self.touched = self.touched, {}
+            self.untouched_hits = 0
+        if not touched:
+            return
+        try:
+            self.__conn().executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                                      [(accessed_at, key) for key, accessed_at in touched.items()])
+        except sqlite3.Error as e:
+            logger.warning(f"error when writing llm response cache access times: {e}")
+
+    def put(self, key: str, model: str, response: str) -> None:
+        now = time.time()
+        try:
+            self.__conn().execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now))
+        except sqlite3.Error as e:
+            logger.warning(f"error when writing llm response cache: {e}")
+            return
+        with self.lock:
+            self.writes += 1
+            evict = self.writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        drop least recently used entries until the responses take at most 90% of max_mb
+        """
+        self.flush_touched()
+        conn = self.__conn()
+        try:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            to_free = total - int(self.max_bytes * 0.9)
+            freed = 0
+            keys = []
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                keys.append(key)
+                freed += size
+                if freed >= to_free:
+                    break
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                conn.execute(f"DELETE FROM responses WHERE key IN ({','.join(['?'] * len(batch))})", batch)
+            logger.info(f"evicted {len(keys)} llm responses, {freed} bytes")
+        except sqlite3.Error as e:
+            logger.warning(f"error when evicting llm response cache: {e}")
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
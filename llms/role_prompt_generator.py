@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from llms.prompt_provider import PromptProvider
 from llms.base_llm_util import LLMUtil
 from components import RolePrompt
+import asyncio
 import logging
 from utils.cache_manager import cache_result
 from utils.time_usage_record import time_usage
@@ -28,6 +29,16 @@ class RolePromptGenerator(ABC):
         """
         pass
 
+    async def generate_async(self, task_id: str, topic: str) -> RolePrompt:
+        """
+        async version of generate, runs generate in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.generate, task_id, topic)
+
+
+def key_gen(*args, **kwargs) -> str:
+    return kwargs.get("topic") if kwargs.get("topic") else args[2]
+
 
 class DefaultRolePromptGenerator(RolePromptGenerator):
 
@@ -35,12 +46,32 @@ class DefaultRolePromptGenerator(RolePromptGenerator):
         self.prompt_provider = prompt_provider
         self.llm_util = llm_util
 
-    @cache_result("role_prompts", cache_class=RolePrompt, key_gen=lambda *args, **kwargs: kwargs.get("topic") if kwargs.get("topic") else args[2])
+    @cache_result("role_prompts", cache_class=RolePrompt, key_gen=key_gen)
     @time_usage
     def generate(self, task_id: str, topic: str) -> RolePrompt:
         logger.info(
             f"generating role prompt for topic: {topic}, generator: {self.__class__.__name__}")
-        messages = [
+        response = self.llm_util.get_smart_result(
+            messages=self.__build_messages(topic),
+            task_id=task_id,
+            stage="role_prompt"
+        )
+        return self.__parse_response(topic, response)
+
+    @cache_result("role_prompts", cache_class=RolePrompt, key_gen=key_gen)
+    @time_usage
+    async def generate_async(self, task_id: str, topic: str) -> RolePrompt:
+        logger.info(
+            f"async generating role prompt for topic: {topic}, generator: {self.__class__.__name__}")
+        response = await self.llm_util.get_smart_result_async(
+            messages=self.__build_messages(topic),
+            task_id=task_id,
+            stage="role_prompt"
+        )
+        return self.__parse_response(topic, response)
+
+    def __build_messages(self, topic: str) -> list[dict[str, str]]:
+        return [
             {
                 "role": "system",
                 "content": self.prompt_provider.auto_agent_prompt()
@@ -50,10 +81,8 @@ class DefaultRolePromptGenerator(RolePromptGenerator):
                 "content": topic
             }
         ]
-        response = self.llm_util.get_smart_result(
-            messages=messages,
-            task_id=task_id
-        )
+
+    def __parse_response(self, topic: str, response: str) -> RolePrompt:
         logger.info(
             f"generated role prompt for topic: {topic}, generator: GPT4RolePromptGenerator, role prompt: {response}")
 
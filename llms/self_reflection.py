@@ -11,6 +11,7 @@ from components import SubTopic, DeterminResult
 from utils.cache_manager import cache_result
 from utils.time_usage_record import time_usage
 import hashlib
+import asyncio
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +33,12 @@ class SelfReflecter(ABC):
         """
         pass
 
+    async def determin_relavance_async(self, task_id: str, role_prompt: str, sub_topic: SubTopic, content: str) -> DeterminResult:
+        """
+        async version of determin_relavance, runs determin_relavance in the default executor unless overrided
+        """
+        return await asyncio.to_thread(self.determin_relavance, task_id, role_prompt, sub_topic, content)
+
 def key_gen(*args, **kwargs) -> str:
     sub_topic: SubTopic = kwargs.get("sub_topic") if kwargs.get(
         "sub_topic") else args[3]
@@ -49,9 +56,21 @@ class DefaultSelfReflecter(SelfReflecter):
     @time_usage
     def determin_relavance(self, task_id: str, role_prompt: str, sub_topic: SubTopic, content: str) -> DeterminResult:
         # I'm not sure if gpt-3.5 will be able to handle this... well, it just do well...
+        response = self.llm_util.get_fast_result(
+            self.__build_messages(role_prompt, sub_topic, content), task_id=task_id, stage="reflect")
+        return self.__parse_response(content, response)
+
+    @cache_result("determin_results", cache_class=DeterminResult, key_gen=key_gen)
+    @time_usage
+    async def determin_relavance_async(self, task_id: str, role_prompt: str, sub_topic: SubTopic, content: str) -> DeterminResult:
+        response = await self.llm_util.get_fast_result_async(
+            self.__build_messages(role_prompt, sub_topic, content), task_id=task_id, stage="reflect")
+        return self.__parse_response(content, response)
+
+    def __build_messages(self, role_prompt: str, sub_topic: SubTopic, content: str) -> list[dict[str, str]]:
         prompt = self.prompt_provider.self_reflection_prompt(
             sub_topic, content)
-        response = self.llm_util.get_fast_result([
+        return [
             {
                 "role": "system",
                 "content": role_prompt
@@ -60,7 +79,9 @@ class DefaultSelfReflecter(SelfReflecter):
                 "role": "user",
                 "content": prompt
             }
-        ], task_id=task_id)
+        ]
+
+    def __parse_response(self, content: str, response: str) -> DeterminResult:
         # try to extract a boolean value from the response
         if response.lower() == 'yes' or response.lower().find('yes') != -1:
             return DeterminResult(content, True)
@@ -0,0 +1,167 @@
+"""
+in-memory token accounting of llm calls, per task, per model and per stage.
+
+counters are updated under a lock on every call and written to output/<task_id>/token_use.json by a background
+thread every flush_interval seconds, and when a task is flushed explicitly at its end.
+
+several processes may count the same task (distributed workers and their coordinator), so a flush adds only the counts
+of this process since its last flush to what is in the file, under a file lock.
+"""
+
+from utils.singleton import Singleton
+from utils.config_center import Config
+from typing import Optional
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on windows, a single process per task is safe anyway
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class TokenAccountant(metaclass=Singleton):
+
+    def __init__(self) -> None:
+        self.flush_interval = Config().get_config("llms").get("token_use", {}).get("flush_interval", 10)
+        # task_id -> model -> counters, with a "stages" dict of the same counters per stage,
+        # the file as of the last flush plus what this process counted since
+        self.usage: dict[str, dict[str, dict]] = {}
+        # task_id -> the counters of this process not flushed yet, same layout
+        self.pending: dict[str, dict[str, dict]] = {}
+        self.dirty: set[str] = set()
+        self.lock = threading.Lock()
+        self.flusher = threading.Thread(target=self.__flush_periodically, name="token-use-flusher", daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def record(self, task_id: str, model: str, prompt_tokens: int, completion_tokens: int, stage: str = None) -> None:
+        if task_id is None:
+            return
+        with self.lock:
+            for task_usage in [self.__task_usage(task_id), self.pending.setdefault(task_id, {})]:
+                model_usage = task_usage.setdefault(model, self.__counters())
+                self.__add(model_usage, prompt_tokens, completion_tokens)
+                self.__add(model_usage.setdefault("stages", {}).setdefault(stage or "unknown", self.__counters()),
+                           prompt_tokens, completion_tokens)
+            self.dirty.add(task_id)
+
+    def get_usage(self, task_id: str) -> dict[str, dict]:
+        """
+        a copy of the in-memory counters of the task, model -> counters. what other processes have flushed is picked
+        up by the periodic flush, so this never touches the file
+        """
+        with self.lock:
+            return json.loads(json.dumps(self.__task_usage(task_id)))
+
+    def set_bill(self, task_id: str, bill: Optional[dict]) -> None:
+        """
+        the bill is kept next to the counters in token_use.json
+        """
+        with self.lock:
+            self.__task_usage(task_id)["bill"] = bill
+            self.pending.setdefault(task_id, {})["bill"] = bill
+            self.dirty.add(task_id)
+
+    def flush(self, task_id: str = None) -> None:
+        """
+        add the counts of the task, or of every changed task, to token_use.json and reload it
+        """
+        with self.lock:
+            task_ids = [task_id] if task_id else list(self.dirty)
+            deltas = {t: self.pending.pop(t, {}) for t in task_ids}
+            self.dirty.difference_update(task_ids)
+        for t, delta in deltas.items():
+            try:
+                merged = self.__merge_into_file(t, delta)
+            except Exception as e:
+                logger.exception(f"error when flushing token use of task {t}: {e}")
+                with self.lock:
+                    # counted again in the next flush
+                    self.__merge(self.pending.setdefault(t, {}), delta)
+                    self.dirty.add(t)
+                continue
+            with self.lock:
+                # the file plus what was counted while it was written
+                self.__merge(merged, self.pending.get(t, {}))
+                self.usage[t] = merged
+
+    def __merge_into_file(self, task_id: str, delta: dict) -> dict:
+        path = self.__path(task_id)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            task_usage = self.__load(task_id)
+            if delta:
+                self.__merge(task_usage, delta)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(json.dumps(task_usage, ensure_ascii=False, indent=4))
+                os.replace(tmp_path, path)
+            return task_usage
+
+    def __flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def __task_usage(self, task_id: str) -> dict[str, dict]:
+        """
+        counters of the task, loaded from token_use.json the first time, so a restarted process keeps counting
+        """
+        if task_id not in self.usage:
+            self.usage[task_id] = self.__load(task_id)
+        return self.usage[task_id]
+
+    def __load(self, task_id: str) -> dict[str, dict]:
+        task_usage = {}
+        path = self.__path(task_id)
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    task_usage = json.load(f)
+            except Exception as e:
+                logger.warning(f"error when loading token use of task {task_id}, start from zero: {e}")
+        for model_usage in task_usage.values():
+            if isinstance(model_usage, dict):
+                # per call details of older versions are not kept
+                model_usage.pop("details", None)
+        return task_usage
+
+    def __merge(self, target: dict, delta: dict) -> None:
+        """
+        add the counters of delta to target, the bill of delta replaces the one of target
+        """
+        for model, model_delta in delta.items():
+            if model == "bill" or not isinstance(model_delta, dict):
+                target[model] = model_delta
+                continue
+            model_usage = target.setdefault(model, self.__counters())
+            for name in self.__counters().keys():
+                model_usage[name] = model_usage.get(name, 0) + model_delta.get(name, 0)
+            stages = model_usage.setdefault("stages", {})
+            for stage, stage_delta in model_delta.get("stages", {}).items():
+                stage_usage = stages.setdefault(stage, self.__counters())
+                for name in self.__counters().keys():
+                    stage_usage[name] = stage_usage.get(name, 0) + stage_delta.get(name, 0)
+
+    def __path(self, task_id: str) -> str:
+        return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'output', task_id, 'token_use.json')
+
+    def __counters(self) -> dict[str, int]:
+        return {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0, "calls": 0}
+
+    def __add(self, counters: dict, prompt_tokens: int, completion_tokens: int) -> None:
+        counters["completion_tokens"] = counters.get("completion_tokens", 0) + completion_tokens
+        counters["prompt_tokens"] = counters.get("prompt_tokens", 0) + prompt_tokens
+        counters["total_tokens"] = counters.get("total_tokens", 0) + prompt_tokens + completion_tokens
+        counters["calls"] = counters.get("calls", 0) + 1
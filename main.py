@@ -3,13 +3,16 @@ import logging
 from pipeline.pipeline import generate_task_id
 import os
 import argparse
+import asyncio
+import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from utils.config_center import Config
+from pipeline.distributed import run_worker, create_work_queue
 
-def search(topic):
-    # setup logging
-    task_id = generate_task_id(topic)
-    log_file_path = os.path.join(os.path.dirname(
-        __file__), "output", task_id, "search.log")
+
+def setup_logging(log_file_path):
     if not os.path.exists(os.path.dirname(log_file_path)):
         os.makedirs(os.path.dirname(log_file_path))
     logging.basicConfig(
@@ -20,10 +23,118 @@ def search(topic):
             logging.FileHandler(log_file_path, encoding="utf-8")
         ]
     )
+
+
+def search(topic, use_async=False, deadline=None, budget=None):
+    # setup logging
+    task_id = generate_task_id(topic)
+    setup_logging(os.path.join(os.path.dirname(
+        __file__), "output", task_id, "search.log"))
     p = create_pipeline()
-    pdf, md = p.do_research(topic)
+    if use_async:
+        pdf, md = asyncio.run(p.do_research_async(topic, deadline, budget))
+    else:
+        pdf, md = p.do_research(topic, deadline, budget)
     return pdf, md, p.get_bill(topic)
 
+
+def load_topics(path):
+    """
+    one topic per line. a line can be a json object with a "topic" field, a json string, or just plain text.
+    topics leading to the same task id are researched only once.
+    """
+    topics = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                topic = json.loads(line)
+            except json.JSONDecodeError:
+                topic = line
+            if isinstance(topic, dict):
+                topic = topic.get("topic")
+            if not isinstance(topic, str) or not topic.strip():
+                print(f"skip line without topic: {line[:100]}")
+                continue
+            topics.setdefault(generate_task_id(topic), topic.strip())
+    return list(topics.values())
+
+
+def batch_search(topics, output_dir, max_inflight_topics, use_async=False, deadline=None, budget=None):
+    """
+    research all topics in one process, at most max_inflight_topics at the same time, deadline and budget apply to each topic.
+    the pipeline, and with it the llm util, crawler manager and selenium drivers, is shared by all topics.
+    per topic md and pdf files and a batch_summary.json are written to output_dir.
+    """
+    batch_id = time.strftime("batch_%Y%m%d_%H%M%S", time.localtime())
+    setup_logging(os.path.join(os.path.dirname(
+        __file__), "output", batch_id, "batch.log"))
+    logger = logging.getLogger("batch")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    p = create_pipeline()
+
+    def collect(topic, start, pdf_path=None, md_path=None, error=None):
+        name = generate_task_id(topic)
+        result = {"topic": topic, "task_id": name, "seconds": round(time.time() - start, 1)}
+        if error:
+            logger.error(f"topic {topic} failed: {error}", exc_info=error)
+            result.update({"status": "failed", "error": str(error)})
+            return result
+        shutil.copy(pdf_path, os.path.join(output_dir, name + ".pdf"))
+        shutil.copy(md_path, os.path.join(output_dir, name + ".md"))
+        bill = p.get_bill(topic)
+        result.update({"status": "done", "bill": bill.total_bill if bill else 0})
+        logger.info(f"topic {topic} done in {result['seconds']}s")
+        return result
+
+    def research(topic):
+        start = time.time()
+        try:
+            pdf_path, md_path = p.do_research(topic, deadline, budget)
+            return collect(topic, start, pdf_path, md_path)
+        except Exception as e:
+            return collect(topic, start, error=e)
+
+    async def research_async(topic, semaphore):
+        async with semaphore:
+            start = time.time()
+            try:
+                pdf_path, md_path = await p.do_research_async(topic, deadline, budget)
+                return collect(topic, start, pdf_path, md_path)
+            except Exception as e:
+                return collect(topic, start, error=e)
+
+    async def run_async():
+        semaphore = asyncio.Semaphore(max_inflight_topics)
+        return await asyncio.gather(*[research_async(topic, semaphore) for topic in topics])
+
+    start = time.time()
+    logger.info(f"start batch {batch_id} with {len(topics)} topics, at most {max_inflight_topics} in flight")
+    if use_async:
+        results = asyncio.run(run_async())
+    else:
+        with ThreadPoolExecutor(max_workers=max_inflight_topics) as executor:
+            results = list(executor.map(research, topics))
+    seconds = time.time() - start
+
+    done = [r for r in results if r["status"] == "done"]
+    summary = {
+        "batch_id": batch_id,
+        "topics": len(results),
+        "done": len(done),
+        "failed": len(results) - len(done),
+        "seconds": round(seconds, 1),
+        "topics_per_hour": round(len(done) * 3600 / seconds, 2) if seconds else 0,
+        "total_bill": sum([r["bill"] for r in done]),
+        "results": results
+    }
+    with open(os.path.join(output_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+    return summary
+
 DONE_LOGO = """
                  ,----..            ,--.           
     ,---,       /   /   \         ,--.'|    ,---,. 
@@ -45,16 +156,39 @@ DONE_LOGO = """
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='tool')
     parser.add_argument('-t', '--topic', type=str, help='topic to research')
+    parser.add_argument('-b', '--batch', type=str, help='file with one topic per line (jsonl with a "topic" field, or plain text), research them all in one process')
+    parser.add_argument('--max-inflight-topics', type=int, default=4, help='max topics researched at the same time in batch mode')
+    parser.add_argument('--worker', action='store_true', help='run as a distributed worker, pull sub topic units from the work queue configured in pipeline.distributed')
+    parser.add_argument('--worker-threads', type=int, default=4, help='max units a worker runs at the same time')
     parser.add_argument('-o', '--output-dir', type=str, default=os.getcwd(), help='output dir to save md and pdf file')
     parser.add_argument('--disable-headless', action='store_true', help='disable headless mode for selenium, useful for debug')
+    parser.add_argument('--use-async', action='store_true', help='run the whole research task on a single asyncio event loop')
+    parser.add_argument('--deadline', type=float, help='wall clock budget of a topic in seconds, the report is written from whatever is found in time')
+    parser.add_argument('--record', type=str, metavar='DIR', help='record every llm call, search and crawl to a fixture bundle in DIR')
+    parser.add_argument('--replay', type=str, metavar='DIR', help='serve llm calls, searches and crawls from the fixture bundle in DIR, no network needed')
+    parser.add_argument('--budget', type=float, help='max dollars a topic may spend on LLM calls, overrides pipeline.budget.max_cost')
     args = parser.parse_args()
     topic = args.topic
     Config().set_global_config("disable_headless", args.disable_headless)
+    if args.record or args.replay:
+        Config().set_global_config("replay", {"mode": "record" if args.record else "replay",
+                                              "path": args.record or args.replay})
+    if args.worker:
+        setup_logging(os.path.join(os.path.dirname(
+            __file__), "output", "worker.log"))
+        distributed = Config().get_config("pipeline").get("distributed", {})
+        run_worker(create_pipeline(), create_work_queue(distributed), args.worker_threads, distributed.get("poll_interval", 2))
+        exit(0)
+    if args.batch:
+        summary = batch_search(load_topics(args.batch), args.output_dir, args.max_inflight_topics, args.use_async, args.deadline, args.budget)
+        print(DONE_LOGO)
+        print(f"batch finished, {summary['done']}/{summary['topics']} topics done in {summary['seconds']} seconds "
+              f"({summary['topics_per_hour']} topics per hour), report LLM charges a total of {summary['total_bill']} dollars.")
+        exit(0 if summary['failed'] == 0 else 1)
     try:
-        pdf_path, md_path, bill = search(topic)
+        pdf_path, md_path, bill = search(topic, args.use_async, args.deadline, args.budget)
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
-        import shutil
         name = generate_task_id(topic)
         shutil.copy(pdf_path, os.path.join(args.output_dir, generate_task_id(topic) + ".pdf"))
         shutil.copy(md_path, os.path.join(args.output_dir, generate_task_id(topic) + ".md"))
@@ -0,0 +1,283 @@
+"""
+coordinator/worker mode for (sub_topic, query) units.
+
+the coordinator pushes every unit that summary_for_sub_topic would handle into a shared work queue, any number of
+worker processes, on any number of machines, pull units, do the search/crawl/summary work and write the Summary back.
+the coordinator then collects the summaries for the report agent as usual.
+
+the reference backend is a sqlite file, put it on a shared file system for multiple machines.
+a unit leased by a worker that does not finish in lease_seconds is handed out again.
+"""
+
+from abc import ABC, abstractmethod
+from components import Summary, SubTopic, RolePrompt
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class WorkUnit:
+
+    def __init__(self, unit_id: str, task_id: str, payload: dict, attempts: int = 0) -> None:
+        self.unit_id = unit_id
+        self.task_id = task_id
+        self.payload = payload
+        self.attempts = attempts
+
+    def __str__(self) -> str:
+        return f"unit_id: {self.unit_id}, task_id: {self.task_id}, attempts: {self.attempts}, payload: {str(self.payload)[:100]}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class WorkQueue(ABC):
+
+    @abstractmethod
+    def push(self, task_id: str, payload: dict) -> str:
+        """
+        push a unit, return the unit id
+        """
+        pass
+
+    @abstractmethod
+    def pull(self, worker_id: str) -> Optional[WorkUnit]:
+        """
+        lease the oldest available unit, return None if there is nothing to do
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, unit_id: str, result: Optional[dict]) -> None:
+        """
+        mark the unit done with its result
+        """
+        pass
+
+    @abstractmethod
+    def fail(self, unit_id: str, error: str) -> None:
+        """
+        give the unit back to the queue, or mark it failed if it has been tried too many times
+        """
+        pass
+
+    @abstractmethod
+    def cancel(self, unit_ids: list[str]) -> None:
+        """
+        drop the units in the list that no worker has leased yet
+        """
+        pass
+
+    @abstractmethod
+    def finished(self, unit_ids: list[str]) -> dict[str, tuple[str, Optional[dict], Optional[str]]]:
+        """
+        return (status, result, error) of the units in the list that are done or failed
+        """
+        pass
+
+
+class SqliteWorkQueue(WorkQueue):
+
+    def __init__(self, path: str, lease_seconds: int = 600, max_attempts: int = 3) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        conn = self.__conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS work_units (
+                unit_id TEXT PRIMARY KEY,
+                task_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                leased_at REAL,
+                finished_at REAL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_work_units_status ON work_units(status, created_at)")
+
+    def __conn(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self.local.conn
+
+    def push(self, task_id: str, payload: dict) -> str:
+        unit_id = uuid.uuid4().hex
+        self.__conn().execute(
+            "INSERT INTO work_units (unit_id, task_id, payload, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+            (unit_id, task_id, json.dumps(payload, ensure_ascii=False), time.time()))
+        return unit_id
+
+    def pull(self, worker_id: str) -> Optional[WorkUnit]:
+        conn = self.__conn()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, so two workers never lease the same unit
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT unit_id, task_id, payload, attempts FROM work_units "
+                "WHERE status = 'queued' OR (status = 'running' AND leased_at < ?) "
+                "ORDER BY created_at LIMIT 1", (now - self.lease_seconds,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE work_units SET status = 'running', worker = ?, leased_at = ?, attempts = attempts + 1 WHERE unit_id = ?",
+                (worker_id, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return WorkUnit(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def complete(self, unit_id: str, result: Optional[dict]) -> None:
+        # the first worker finishing a unit wins, a late worker with an expired lease does not overwrite it
+        self.__conn().execute(
+            "UPDATE work_units SET status = 'done', result = ?, finished_at = ? WHERE unit_id = ? AND status != 'done'",
+            (json.dumps(result, ensure_ascii=False) if result is not None else None, time.time(), unit_id))
+
+    def fail(self, unit_id: str, error: str) -> None:
+        self.__conn().execute(
+            "UPDATE work_units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = ?, finished_at = ? WHERE unit_id = ? AND status = 'running'",
+            (self.max_attempts, error, time.time(), unit_id))
+
+    def cancel(self, unit_ids: list[str]) -> None:
+        for i in range(0, len(unit_ids), 500):
+            batch = unit_ids[i:i + 500]
+            self.__conn().execute(
+                f"UPDATE work_units SET status = 'cancelled', finished_at = ? "
+                f"WHERE status = 'queued' AND unit_id IN ({','.join(['?'] * len(batch))})", [time.time()] + batch)
+
+    def finished(self, unit_ids: list[str]) -> dict[str, tuple[str, Optional[dict], Optional[str]]]:
+        finished = {}
+        # stay below the sqlite limit of host parameters
+        for i in range(0, len(unit_ids), 500):
+            batch = unit_ids[i:i + 500]
+            rows = self.__conn().execute(
+                f"SELECT unit_id, status, result, error FROM work_units "
+                f"WHERE status IN ('done', 'failed') AND unit_id IN ({','.join(['?'] * len(batch))})", batch).fetchall()
+            for unit_id, status, result, error in rows:
+                finished[unit_id] = (status, json.loads(result) if result else None, error)
+        return finished
+
+
+def create_work_queue(config: dict) -> WorkQueue:
+    path = config.get("queue_path") or os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "output", "work_queue.sqlite")
+    return SqliteWorkQueue(path, config.get("lease_seconds", 600), config.get("max_attempts", 3))
+
+
+class DistributedCoordinator:
+    """
+    pushes units to the work queue, and resolves the returned futures when workers are done with them
+    """
+
+    def __init__(self, work_queue: WorkQueue, poll_interval: float = 2) -> None:
+        self.work_queue = work_queue
+        self.poll_interval = poll_interval
+        self.futures: dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def submit(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str,
+               need_relavance_page_num: int) -> Future:
+        """
+        the returned future resolves to the Summary, or None if the worker found not enough relavant pages.
+        cancel the future to drop the unit if no worker has leased it yet.
+        """
+        unit_id = self.work_queue.push(task_id, {
+            "agent_prompt": agent_prompt.serialize(),
+            "sub_topic": sub_topic.serialize(),
+            "query": query,
+            "need_relavance_page_num": need_relavance_page_num
+        })
+        logger.info(f"unit {unit_id} pushed for query: {query}")
+        future = Future()
+        with self.lock:
+            self.futures[unit_id] = future
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.__poll, name="distributed-poller", daemon=True)
+                self.poller.start()
+        return future
+
+    def __poll(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                cancelled = [unit_id for unit_id, future in self.futures.items() if future.cancelled()]
+                for unit_id in cancelled:
+                    self.futures.pop(unit_id)
+                unit_ids = list(self.futures.keys())
+            if cancelled:
+                try:
+                    self.work_queue.cancel(cancelled)
+                except Exception as e:
+                    logger.exception(f"error when cancelling units: {e}")
+            if not unit_ids:
+                continue
+            try:
+                finished = self.work_queue.finished(unit_ids)
+            except Exception as e:
+                logger.exception(f"error when polling work queue: {e}")
+                continue
+            for unit_id, (status, result, error) in finished.items():
+                with self.lock:
+                    future = self.futures.pop(unit_id, None)
+                if future is None or future.cancelled():
+                    continue
+                if status == "failed":
+                    future.set_exception(Exception(f"unit {unit_id} failed: {error}"))
+                else:
+                    future.set_result(Summary.deserialize(Summary, result) if result else None)
+
+
+def run_worker(pipeline, work_queue: WorkQueue, threads: int = 4, poll_interval: float = 2) -> None:
+    """
+    pull units forever and run them with pipeline.summary_for_sub_topic, at most threads units at the same time
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"worker {worker_id} started with {threads} threads")
+
+    def work() -> None:
+        while True:
+            try:
+                unit = work_queue.pull(worker_id)
+            except Exception as e:
+                logger.exception(f"error when pulling work queue: {e}")
+                unit = None
+            if unit is None:
+                time.sleep(poll_interval)
+                continue
+            logger.info(f"worker {worker_id} got unit {unit}")
+            try:
+                summary = pipeline.summary_for_sub_topic(unit.task_id,
+                                                         RolePrompt.deserialize(RolePrompt, unit.payload["agent_prompt"]),
+                                                         SubTopic.deserialize(SubTopic, unit.payload["sub_topic"]),
+                                                         unit.payload["query"],
+                                                         unit.payload["need_relavance_page_num"])
+                work_queue.complete(unit.unit_id, summary.serialize() if summary else None)
+            except Exception as e:
+                logger.exception(f"unit {unit.unit_id} failed: {e}")
+                work_queue.fail(unit.unit_id, str(e))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(threads):
+            executor.submit(work)
@@ -2,18 +2,28 @@ from llms.role_prompt_generator import RolePromptGenerator
 from llms.question_expander import QuestionExpander
 from search.search_engine import SearchEngine
 from crawlers.crawler_manager import CrawlerManager
-from llms.report_agent import ReportAgent, SummaryGenerator
+from llms.report_agent import ReportAgent, SummaryGenerator, order_summaries
 from llms.report_outline_generator import ReportOutlineGenerator
 from llms.self_reflection import SelfReflecter
-from components import CrawledPage, Summary, SubTopic, RolePrompt, LLMTokenBill
+from components import CrawledPage, Summary, SubTopic, RolePrompt, LLMTokenBill, SearchResult
 from llms.base_llm_util import LLMUtil
+from utils.config_center import Config
+from utils.deadline import set_deadline, clear_deadline
+from utils.budget import BudgetLevel, set_budget, clear_budget, set_priorities, should_stop, budget_level
+from utils.events import EventBus, EventType
+from .stages import StagedRunner
+from .distributed import DistributedCoordinator, create_work_queue
+from .report_writer import ReportWriter
+import asyncio
 import logging
 import os
+import threading
 import time
 from markdown2 import markdown_path
 from weasyprint import HTML, CSS
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError
+from contextlib import contextmanager
+from typing import Tuple, Optional, Iterator, AsyncIterator
 
 logger = logging.getLogger(__name__)
 
@@ -36,118 +46,550 @@ class ResearchPipeline:
         self.summary_generator = summary_generator
         self.outline_generator = outline_generator
         self.self_reflecter = self_reflecter
+        self.config = Config().get_config("pipeline")
+        self.speculative_crawl = self.config.get("speculative_crawl", {})
+        self.budget = self.config.get("budget", {})
+        staged = self.config.get("staged", {})
+        self.staged_runner = StagedRunner(self, staged) if staged.get("enabled", False) else None
+        distributed = self.config.get("distributed", {})
+        self.coordinator = DistributedCoordinator(create_work_queue(distributed), distributed.get("poll_interval", 2)) \
+            if distributed.get("enabled", False) else None
+        self.events = EventBus()
 
-    def do_research(self, topic: str) -> Tuple[str, str]:
+    def do_research(self, topic: str, deadline: float = None, budget: float = None) -> Tuple[str, str]:
+        """
+        deadline is the wall clock budget of the whole task in seconds. when the crawl/summary budget runs out,
+        outstanding work is cancelled and the report is written from whatever summaries exist so far.
+        budget is the max dollars the task may spend on llm calls, see utils.budget for how the task is cut down
+        as it gets close.
+        """
         start_time = time.strftime(
             "%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
         task_id = generate_task_id(topic)
+        research_deadline = self.__research_deadline(task_id, deadline)
 
-        agent_prompt = self.role_prompt_generator.generate(task_id, topic)
-        logger.info(f"agent prompt: {agent_prompt}")
+        with self.events.track(task_id, topic=topic, deadline=deadline, budget=budget), \
+                self.__task_budget(task_id, budget):
+            agent_prompt = self.role_prompt_generator.generate(task_id, topic)
+            logger.info(f"agent prompt: {agent_prompt}")
 
-        outline = self.outline_generator.generate(task_id,
-                                                  agent_prompt.agent_role_prompt, topic)
-        logger.info(f"outline: {outline}")
+            outline = self.outline_generator.generate(task_id,
+                                                      agent_prompt.agent_role_prompt, topic)
+            logger.info(f"outline: {outline}")
+            self.events.emit(task_id, EventType.OutlineReady, sub_topics=[s.sub_topic for s in outline.sub_topics])
 
-        sub_topics = outline.sub_topics
+            sub_topics = outline.sub_topics
+            # the outline lists the most important sub topics first, the later ones stop first on a tight budget
+            set_priorities(task_id, [s.sub_topic for s in sub_topics])
 
-        # crawl really token a long time, lets do it in parallel
-        need_relavance_page_num_for_each_query = 2
-        sub_topic_and_query = []
-        for sub_topic in sub_topics:
-            logger.info(f"doing research for sub topic: {sub_topic}")
-            queriers = self.question_expander.expand(task_id,
-                                                     agent_prompt.agent_role_prompt, sub_topic)
-            sub_topic_and_query.extend([(sub_topic, q)
-                                       for q in queriers.expanded_question])
-
-        parllel_level = len(sub_topic_and_query)
-        executor = ThreadPoolExecutor(max_workers=parllel_level)
-        futures = []
-        summaries = []
-        for sub_topic, query in sub_topic_and_query:
-            futures.append(executor.submit(self.summary_for_sub_topic, task_id,
-                           agent_prompt, sub_topic, query, need_relavance_page_num_for_each_query))
-
-        for future in as_completed(futures):
+            # crawl really token a long time, lets do it in parallel
+            # expansions of different sub topics are independent, so they are done in parallel too,
+            # and the queries of a sub topic are submitted as soon as its expansion is done.
+            need_relavance_page_num_for_each_query = 2
+            expand_executor = ThreadPoolExecutor(max_workers=len(sub_topics))
+            expand_futures = {}
+            for sub_topic in sub_topics:
+                logger.info(f"doing research for sub topic: {sub_topic}")
+                expand_futures[expand_executor.submit(self.question_expander.expand, task_id,
+                                                      agent_prompt.agent_role_prompt, sub_topic)] = sub_topic
+
+            # the expander is asked for 1-2 queries per sub topic
+            parllel_level = len(sub_topics) * 2
+            executor = ThreadPoolExecutor(max_workers=parllel_level)
+            cancel_event = threading.Event()
+            futures = []
+            summaries = []
+            # sub topic -> number of queries planned for it
+            planned_queries: dict[str, int] = {}
+            deadline_reached = False
             try:
-                summary = future.result()
-                summaries.append(summary)
-            except Exception as e:
-                logger.exception(f"error when batch_crawl: {e}")
-                continue
+                for expand_future in as_completed(expand_futures, timeout=self.__seconds_left(research_deadline)):
+                    sub_topic = expand_futures[expand_future]
+                    try:
+                        queriers = expand_future.result()
+                    except Exception as e:
+                        logger.exception(f"error when expand sub topic {sub_topic}: {e}")
+                        continue
+                    if not queriers:
+                        logger.warning(f"no query expanded for sub topic: {sub_topic}")
+                        continue
+                    planned_queries[sub_topic.sub_topic] = len(queriers.expanded_question)
+                    self.events.emit(task_id, EventType.QueriesExpanded, sub_topic=sub_topic.sub_topic,
+                                     queries=queriers.expanded_question)
+                    for query in queriers.expanded_question:
+                        if should_stop(task_id, sub_topic.sub_topic):
+                            logger.info(f"sub topic {sub_topic.sub_topic} stopped by the cost budget, skip query {query}")
+                            continue
+                        need = self.__pages_needed(task_id, need_relavance_page_num_for_each_query)
+                        if self.coordinator:
+                            futures.append(self.coordinator.submit(task_id, agent_prompt, sub_topic, query, need))
+                        elif self.staged_runner:
+                            futures.append(self.staged_runner.submit(task_id, agent_prompt, sub_topic, query, need))
+                        else:
+                            futures.append(executor.submit(self.summary_for_sub_topic, task_id,
+                                           agent_prompt, sub_topic, query, need, cancel_event))
+
+                for future in as_completed(futures, timeout=self.__seconds_left(research_deadline)):
+                    try:
+                        summary = future.result()
+                        if summary is None:
+                            continue
+                        summaries.append(summary)
+                    except Exception as e:
+                        logger.exception(f"error when batch_crawl: {e}")
+                        continue
+            except TimeoutError:
+                deadline_reached = True
+                logger.warning(f"deadline of task {task_id} reached, write report with {len(summaries)} summaries")
+            finally:
+                # running crawls see the deadline and give up waiting, queued work is dropped
+                cancel_event.set()
+                for future in list(expand_futures.keys()) + futures:
+                    future.cancel()
+                expand_executor.shutdown(wait=False)
+                executor.shutdown(wait=False)
+                if self.staged_runner and not self.coordinator:
+                    # staged crawls still running keep the deadline as their time cap until they drained
+                    self.staged_runner.close(task_id)
+                else:
+                    clear_deadline(task_id)
+
+            # the report is written to report.md as it streams in, the pdf is rendered once it is complete
+            budget_reached = budget_level(task_id) >= BudgetLevel.Stop
+            md_file = os.path.join(self.report_dir(task_id), "report.md")
+            with ReportWriter(task_id, md_file, self.events) as writer:
+                for chunk in self.report_agent.generate_stream(task_id,
+                                                               agent_prompt.agent_role_prompt, summaries, topic, outline):
+                    writer.write(chunk)
+                if deadline_reached or budget_reached:
+                    writer.write(self.__under_sourced_note(sub_topics, planned_queries, summaries,
+                                                           deadline_reached, budget_reached))
+            end_time = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
+            logger.info(f'task {task_id} done, start at {start_time}, end at {end_time}')
+            self.llm_util.flush_token_use(task_id)
+
+            self.render_pdf(task_id)
+            out_dir = self.report_dir(task_id)
+            self.events.emit(task_id, EventType.TaskDone, pdf=os.path.join(out_dir, "report.pdf"),
+                             md=os.path.join(out_dir, "report.md"), summaries=len(summaries),
+                             deadline_reached=deadline_reached, budget_reached=budget_reached)
+            return os.path.join(out_dir, "report.pdf"), os.path.join(out_dir, "report.md")
 
-        final_report = self.report_agent.generate(task_id,
-                                                  agent_prompt.agent_role_prompt, summaries, topic, outline)
-        end_time = time.strftime(
+    async def do_research_async(self, topic: str, deadline: float = None, budget: float = None) -> Tuple[str, str]:
+        """
+        same as do_research, but the whole task runs on the current event loop instead of a thread per query.
+        """
+        start_time = time.strftime(
             "%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
-        logger.info(f'task {task_id} done, start at {start_time}, end at {end_time}')
-        
-        self.persist_report(task_id, final_report.report)
-        out_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "output", task_id)
-        return os.path.join(out_dir, "report.pdf"), os.path.join(out_dir, "report.md")
+        task_id = generate_task_id(topic)
+        research_deadline = self.__research_deadline(task_id, deadline)
+
+        with self.events.track(task_id, topic=topic, deadline=deadline, budget=budget), \
+                self.__task_budget(task_id, budget):
+            agent_prompt = await self.role_prompt_generator.generate_async(task_id, topic)
+            logger.info(f"agent prompt: {agent_prompt}")
+
+            outline = await self.outline_generator.generate_async(task_id,
+                                                                  agent_prompt.agent_role_prompt, topic)
+            logger.info(f"outline: {outline}")
+            self.events.emit(task_id, EventType.OutlineReady, sub_topics=[s.sub_topic for s in outline.sub_topics])
+
+            sub_topics = outline.sub_topics
+            # the outline lists the most important sub topics first, the later ones stop first on a tight budget
+            set_priorities(task_id, [s.sub_topic for s in sub_topics])
+
+            need_relavance_page_num_for_each_query = 2
+            # filled in by the sub topic tasks as they go, so a deadline keeps what is already done
+            summaries: list[Summary] = []
+            planned_queries: dict[str, int] = {}
+            tasks = [asyncio.create_task(self.research_sub_topic_async(task_id, agent_prompt, sub_topic,
+                                                                       need_relavance_page_num_for_each_query,
+                                                                       summaries, planned_queries))
+                     for sub_topic in sub_topics]
+            pending = set()
+            try:
+                if tasks:
+                    _, pending = await asyncio.wait(tasks, timeout=self.__seconds_left(research_deadline))
+            finally:
+                clear_deadline(task_id)
+            deadline_reached = len(pending) > 0
+            if deadline_reached:
+                logger.warning(f"deadline of task {task_id} reached, write report with {len(summaries)} summaries")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+            budget_reached = budget_level(task_id) >= BudgetLevel.Stop
+            md_file = os.path.join(self.report_dir(task_id), "report.md")
+            with ReportWriter(task_id, md_file, self.events) as writer:
+                async for chunk in self.report_agent.generate_stream_async(task_id, agent_prompt.agent_role_prompt,
+                                                                           list(summaries), topic, outline):
+                    writer.write(chunk)
+                if deadline_reached or budget_reached:
+                    writer.write(self.__under_sourced_note(sub_topics, planned_queries, summaries,
+                                                           deadline_reached, budget_reached))
+            end_time = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
+            logger.info(f'task {task_id} done, start at {start_time}, end at {end_time}')
+            self.llm_util.flush_token_use(task_id)
+
+            # rendering pdf is cpu bound, keep it away from the event loop
+            await asyncio.to_thread(self.render_pdf, task_id)
+            out_dir = self.report_dir(task_id)
+            self.events.emit(task_id, EventType.TaskDone, pdf=os.path.join(out_dir, "report.pdf"),
+                             md=os.path.join(out_dir, "report.md"), summaries=len(summaries),
+                             deadline_reached=deadline_reached, budget_reached=budget_reached)
+            return os.path.join(out_dir, "report.pdf"), os.path.join(out_dir, "report.md")
 
     def get_bill(self, topic: str) -> LLMTokenBill:
         return self.llm_util.get_bill(generate_task_id(topic))
 
-    def summary_for_sub_topic(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str, need_relavance_page_num_for_each_query: int) -> Summary:
+    def __research_deadline(self, task_id: str, deadline: Optional[float]) -> Optional[float]:
+        """
+        the time crawl/summary work must stop, leaving time for the final report
+        """
+        if not deadline:
+            return None
+        reserve = self.config.get("deadline_report_reserve_seconds", 60)
+        # never spend more than half of the budget waiting for the report
+        research_deadline = time.time() + max(deadline - reserve, deadline / 2)
+        set_deadline(task_id, research_deadline)
+        return research_deadline
+
+    def __seconds_left(self, research_deadline: Optional[float]) -> Optional[float]:
+        if research_deadline is None:
+            return None
+        return max(research_deadline - time.time(), 0)
+
+    @contextmanager
+    def __task_budget(self, task_id: str, budget: Optional[float]):
+        """
+        register the cost budget of the task in dollars, pipeline.budget.max_cost if not given, no budget if neither
+        """
+        budget = budget or self.budget.get("max_cost")
+        if not budget:
+            yield
+            return
+        set_budget(task_id, budget, self.budget.get("downgrade_ratio", 0.6), self.budget.get("stop_ratio", 0.85))
+        try:
+            yield
+        finally:
+            clear_budget(task_id)
+
+    def __pages_needed(self, task_id: str, need_relavance_page_num_for_each_query: int) -> int:
+        """
+        a task close to its cost budget settles for half the relavant pages per query
+        """
+        if budget_level(task_id) >= BudgetLevel.Downgrade:
+            return max(need_relavance_page_num_for_each_query // 2, 1)
+        return need_relavance_page_num_for_each_query
+
+    def __stopped(self, task_id: str, sub_topic: SubTopic, cancel_event: threading.Event = None) -> bool:
+        return (cancel_event is not None and cancel_event.is_set()) or should_stop(task_id, sub_topic.sub_topic)
+
+    def __under_sourced_note(self, sub_topics: list[SubTopic], planned_queries: dict[str, int],
+                             summaries: list[Summary], deadline_reached: bool = True, budget_reached: bool = False) -> str:
+        """
+        a markdown note listing the sections that got fewer summaries than planned because of the deadline or the budget
+        """
+        limit = " and ".join([name for name, reached in [("deadline", deadline_reached), ("cost budget", budget_reached)]
+                              if reached])
+        obtained: dict[str, int] = {}
+        for summary in summaries:
+            obtained[summary.sub_topic.sub_topic] = obtained.get(summary.sub_topic.sub_topic, 0) + 1
+        lines = []
+        for sub_topic in sub_topics:
+            planned = planned_queries.get(sub_topic.sub_topic)
+            got = obtained.get(sub_topic.sub_topic, 0)
+            if planned is None:
+                lines.append(f"- {sub_topic.sub_topic}: no sources, the {limit} was reached before its queries were planned")
+            elif got < planned:
+                lines.append(f"- {sub_topic.sub_topic}: {got} of {planned} planned sources")
+        if not lines:
+            return ""
+        logger.warning(f"under-sourced sections: {lines}")
+        return f"\n\n---\n\n**Note**: this report was written under a {limit}, the following sections are under-sourced:\n\n" \
+            + "\n".join(lines) + "\n"
+
+    def summary_for_sub_topic(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str, need_relavance_page_num_for_each_query: int,
+                              cancel_event: threading.Event = None) -> Summary:
         """
         for each query(at most two) for each sub topic, we do a summary. we do it as following:
             1. search for the query;
             2. crawl the pages one by one;
             3. do summary for the pages, determine if the page is relavant to the sub topic;
             4. repeat until we have enough relavant pages, which is need_relavance_page_num_for_each_query;
+        in speculative mode, step 2 and 3 are done for top_k search results concurrently, and in-flight work
+        is cancelled as soon as enough relavant pages are accepted.
+        once cancel_event is set, or the cost budget stops the sub topic, the query is given up and None is returned.
         """
         logger.info(f"doing summary for query: {query}")
 
         search_results = self.search_engine.search(task_id, query, 0)
-        single_summaries: list[Summary] = []
-        for search_result in search_results:
-            try:
-                logger.info(f"doing crawl for url: {search_result.url}")
-                page = self.crawler_manager.crawl(task_id, search_result.url)
-                if page is None:
-                    logger.warning(
-                        f"crawl failed for url: {search_result.url}")
-                    continue
-                logger.info(
-                    f"crawl success for url: {search_result.url}, page: {page}")
-                summary = self.summary_generator.generate(
-                    task_id, agent_prompt.agent_role_prompt, page, sub_topic)
-                logger.info(f"summary: {summary}")
-                page_relevance = self.self_reflecter.determin_relavance(
-                    task_id, agent_prompt.agent_role_prompt, sub_topic, summary.summary)
-                if page_relevance.relavance:
+        if self.speculative_crawl.get("enabled", False):
+            single_summaries = self.__speculative_summaries(task_id, agent_prompt, sub_topic, search_results,
+                                                            need_relavance_page_num_for_each_query, cancel_event)
+        else:
+            single_summaries: list[Summary] = []
+            for search_result in search_results:
+                if self.__stopped(task_id, sub_topic, cancel_event):
+                    break
+                summary = self.__relavant_summary(task_id, agent_prompt, sub_topic, search_result, cancel_event)
+                if summary:
                     single_summaries.append(summary)
                     if len(single_summaries) >= need_relavance_page_num_for_each_query:
-                        return self.summary_generator.generate(task_id, agent_prompt.agent_role_prompt,
-                                                               CrawledPage(
-                                                                   url=f"summary:{sub_topic.sub_topic}:::{query}",
-                                                                   title=f"summary:{sub_topic.sub_topic}:::{query}",
-                                                                   content="\n\n".join(
-                                                                       [s.summary for s in single_summaries]),
-                                                               ),
-                                                               sub_topic)
-                    logger.info(
-                        f"page {search_result.url} is relavant to sub topic {sub_topic}")
-                else:
-                    logger.info(
-                        f"page {search_result.url} is not relavant to sub topic {sub_topic}")
+                        break
+        if self.__stopped(task_id, sub_topic, cancel_event):
+            return None
+        summary = None
+        if len(single_summaries) >= need_relavance_page_num_for_each_query:
+            summary = self.summary_generator.generate(task_id, agent_prompt.agent_role_prompt,
+                                                      self.merge_summaries(sub_topic, query, single_summaries),
+                                                      sub_topic)
+        self.events.emit(task_id, EventType.QueryDone, sub_topic=sub_topic.sub_topic, query=query,
+                         relavant_pages=len(single_summaries), found=summary is not None)
+        return summary
+
+    def __relavant_summary(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, search_result: SearchResult,
+                           cancel_event: threading.Event = None) -> Optional[Summary]:
+        """
+        crawl and summarize one search result, return the summary if it is relavant to the sub topic, otherwise None.
+        once cancel_event is set, the remaining llm calls are skipped.
+        """
+        try:
+            logger.info(f"doing crawl for url: {search_result.url}")
+            page = self.crawler_manager.crawl(task_id, search_result.url)
+            self.events.emit(task_id, EventType.PageCrawled, url=search_result.url, success=page is not None)
+            if page is None:
+                logger.warning(
+                    f"crawl failed for url: {search_result.url}")
+                return None
+            logger.info(
+                f"crawl success for url: {search_result.url}, page: {page}")
+            if self.__stopped(task_id, sub_topic, cancel_event):
+                return None
+            summary = self.summary_generator.generate(
+                task_id, agent_prompt.agent_role_prompt, page, sub_topic)
+            logger.info(f"summary: {summary}")
+            if self.__stopped(task_id, sub_topic, cancel_event):
+                return None
+            page_relevance = self.self_reflecter.determin_relavance(
+                task_id, agent_prompt.agent_role_prompt, sub_topic, summary.summary)
+            self.events.emit(task_id, EventType.SummaryAccepted if page_relevance.relavance else EventType.SummaryRejected,
+                             url=search_result.url, sub_topic=sub_topic.sub_topic)
+            if page_relevance.relavance:
+                logger.info(
+                    f"page {search_result.url} is relavant to sub topic {sub_topic}")
+                return summary
+            logger.info(
+                f"page {search_result.url} is not relavant to sub topic {sub_topic}")
+        except Exception as e:
+            logger.exception(f"error when batch_crawl: {e}")
+        return None
+
+    def __speculative_summaries(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic,
+                                search_results: Iterator[SearchResult], need_relavance_page_num_for_each_query: int,
+                                stop_event: threading.Event = None) -> list[Summary]:
+        """
+        keep top_k search results in flight, refill from the search results when one finishes,
+        stop and cancel the rest when enough relavant pages are accepted, stop_event is set, or the cost budget
+        stops the sub topic.
+        """
+        top_k = max(self.speculative_crawl.get("top_k", 4), need_relavance_page_num_for_each_query)
+        search_results = iter(search_results)
+        cancel_event = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=top_k)
+        pending = set()
+        single_summaries: list[Summary] = []
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < top_k:
+                    search_result = next(search_results, None)
+                    if search_result is None:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(self.__relavant_summary, task_id, agent_prompt,
+                                                sub_topic, search_result, cancel_event))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                single_summaries.extend([f.result() for f in done if f.result()])
+                if self.__stopped(task_id, sub_topic, stop_event):
+                    break
+                if len(single_summaries) >= need_relavance_page_num_for_each_query:
+                    logger.info(f"got enough relavant pages for sub topic {sub_topic}, cancel {len(pending)} in-flight pages")
+                    break
+        finally:
+            cancel_event.set()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+        return single_summaries[:need_relavance_page_num_for_each_query]
+
+    def merge_summaries(self, sub_topic: SubTopic, query: str, single_summaries: list[Summary]) -> CrawledPage:
+        # in the order of their pages, not the order they were done in, the merged page is the same every run
+        return CrawledPage(
+            url=f"summary:{sub_topic.sub_topic}:::{query}",
+            title=f"summary:{sub_topic.sub_topic}:::{query}",
+            content="\n\n".join(
+                [s.summary for s in order_summaries(single_summaries)]),
+        )
+
+    async def research_sub_topic_async(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, need_relavance_page_num_for_each_query: int,
+                                       summaries: list[Summary], planned_queries: dict[str, int]) -> None:
+        """
+        expand the sub topic, then do summary for all its queries concurrently.
+        the queries of a sub topic start as soon as its own expansion is done, no matter how slow the other sub topics are.
+        every summary is appended to summaries as soon as it is done, the number of queries is recorded in planned_queries.
+        """
+        logger.info(f"doing research for sub topic: {sub_topic}")
+        try:
+            queriers = await self.question_expander.expand_async(task_id,
+                                                                 agent_prompt.agent_role_prompt, sub_topic)
+        except Exception as e:
+            logger.exception(f"error when expand sub topic {sub_topic}: {e}")
+            return
+        if not queriers:
+            logger.warning(f"no query expanded for sub topic: {sub_topic}")
+            return
+        planned_queries[sub_topic.sub_topic] = len(queriers.expanded_question)
+        self.events.emit(task_id, EventType.QueriesExpanded, sub_topic=sub_topic.sub_topic,
+                         queries=queriers.expanded_question)
+
+        async def summary_for_query(query: str) -> None:
+            if should_stop(task_id, sub_topic.sub_topic):
+                logger.info(f"sub topic {sub_topic.sub_topic} stopped by the cost budget, skip query {query}")
+                return
+            try:
+                summary = await self.summary_for_sub_topic_async(
+                    task_id, agent_prompt, sub_topic, query,
+                    self.__pages_needed(task_id, need_relavance_page_num_for_each_query))
             except Exception as e:
                 logger.exception(f"error when batch_crawl: {e}")
-                continue
+                return
+            if summary is not None:
+                summaries.append(summary)
 
-    def persist_report(self, task_id: str, final_report: str) -> None:
-        logging.getLogger("markdown").setLevel(logging.WARNING)
-        logging.getLogger('weasyprint').setLevel(logging.WARNING)
-        logging.getLogger('fontTools').setLevel(logging.WARNING)
+        await asyncio.gather(*[summary_for_query(query) for query in queriers.expanded_question])
+
+    async def summary_for_sub_topic_async(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str, need_relavance_page_num_for_each_query: int) -> Summary:
+        """
+        async version of summary_for_sub_topic, see summary_for_sub_topic for details.
+        """
+        logger.info(f"doing async summary for query: {query}")
+
+        search_results = self.search_engine.search_async(task_id, query, 0)
+        if self.speculative_crawl.get("enabled", False):
+            single_summaries = await self.__speculative_summaries_async(task_id, agent_prompt, sub_topic, search_results,
+                                                                        need_relavance_page_num_for_each_query)
+        else:
+            single_summaries: list[Summary] = []
+            async for search_result in search_results:
+                if self.__stopped(task_id, sub_topic):
+                    break
+                summary = await self.__relavant_summary_async(task_id, agent_prompt, sub_topic, search_result)
+                if summary:
+                    single_summaries.append(summary)
+                    if len(single_summaries) >= need_relavance_page_num_for_each_query:
+                        break
+        if self.__stopped(task_id, sub_topic):
+            return None
+        summary = None
+        if len(single_summaries) >= need_relavance_page_num_for_each_query:
+            summary = await self.summary_generator.generate_async(task_id, agent_prompt.agent_role_prompt,
+                                                                  self.merge_summaries(sub_topic, query, single_summaries),
+                                                                  sub_topic)
+        self.events.emit(task_id, EventType.QueryDone, sub_topic=sub_topic.sub_topic, query=query,
+                         relavant_pages=len(single_summaries), found=summary is not None)
+        return summary
+
+    async def __relavant_summary_async(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, search_result: SearchResult) -> Optional[Summary]:
+        """
+        async version of __relavant_summary, cancellation is done by cancelling the task.
+        """
+        try:
+            logger.info(f"doing crawl for url: {search_result.url}")
+            page = await self.crawler_manager.crawl_async(task_id, search_result.url)
+            self.events.emit(task_id, EventType.PageCrawled, url=search_result.url, success=page is not None)
+            if page is None:
+                logger.warning(
+                    f"crawl failed for url: {search_result.url}")
+                return None
+            logger.info(
+                f"crawl success for url: {search_result.url}, page: {page}")
+            summary = await self.summary_generator.generate_async(
+                task_id, agent_prompt.agent_role_prompt, page, sub_topic)
+            logger.info(f"summary: {summary}")
+            page_relevance = await self.self_reflecter.determin_relavance_async(
+                task_id, agent_prompt.agent_role_prompt, sub_topic, summary.summary)
+            self.events.emit(task_id, EventType.SummaryAccepted if page_relevance.relavance else EventType.SummaryRejected,
+                             url=search_result.url, sub_topic=sub_topic.sub_topic)
+            if page_relevance.relavance:
+                logger.info(
+                    f"page {search_result.url} is relavant to sub topic {sub_topic}")
+                return summary
+            logger.info(
+                f"page {search_result.url} is not relavant to sub topic {sub_topic}")
+        except Exception as e:
+            logger.exception(f"error when batch_crawl: {e}")
+        return None
+
+    async def __speculative_summaries_async(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic,
+                                            search_results: AsyncIterator[SearchResult], need_relavance_page_num_for_each_query: int) -> list[Summary]:
+        """
+        async version of __speculative_summaries
+        """
+        top_k = max(self.speculative_crawl.get("top_k", 4), need_relavance_page_num_for_each_query)
+        pending = set()
+        single_summaries: list[Summary] = []
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < top_k:
+                    search_result = await anext(search_results, None)
+                    if search_result is None:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.create_task(self.__relavant_summary_async(task_id, agent_prompt,
+                                                                                  sub_topic, search_result)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                single_summaries.extend([t.result() for t in done if t.result()])
+                if self.__stopped(task_id, sub_topic):
+                    break
+                if len(single_summaries) >= need_relavance_page_num_for_each_query:
+                    logger.info(f"got enough relavant pages for sub topic {sub_topic}, cancel {len(pending)} in-flight pages")
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return single_summaries[:need_relavance_page_num_for_each_query]
+
+    def report_dir(self, task_id: str) -> str:
         base_dir = os.path.join(os.path.join(
             os.path.dirname(os.path.dirname(__file__)), "output"), task_id)
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
-        md_file = os.path.join(base_dir, "report.md")
+        return base_dir
+
+    def persist_report(self, task_id: str, final_report: str) -> None:
+        md_file = os.path.join(self.report_dir(task_id), "report.md")
         with open(md_file, "w", encoding="utf-8") as f:
             f.write(final_report)
+        self.render_pdf(task_id)
+
+    def render_pdf(self, task_id: str) -> None:
+        """
+        render report.md of the task to report.pdf
+        """
+        logging.getLogger("markdown").setLevel(logging.WARNING)
+        logging.getLogger('weasyprint').setLevel(logging.WARNING)
+        logging.getLogger('fontTools').setLevel(logging.WARNING)
+        base_dir = self.report_dir(task_id)
+        md_file = os.path.join(base_dir, "report.md")
         html = markdown_path(md_file)
         css = CSS(string='''
             @page {
@@ -2,24 +2,50 @@ from .pipeline import ResearchPipeline
 from llms.prompt_provider import DefaultPromptProvider
 from llms.role_prompt_generator import DefaultRolePromptGenerator
 from llms.report_outline_generator import DefaultOutlineGenerator
-from llms.openai_util import DefaultLLMUtil
 from llms.question_expander import DefaultQuestionExpander
-from llms.report_agent import DefaultSummaryGenerator, DefaultReportAgent
+from llms.report_agent import DefaultSummaryGenerator, DefaultReportAgent, SectionReportAgent
 from llms.self_reflection import DefaultSelfReflecter
-from search.duckduckgo_engine import DuckDuckGoEngine
-from crawlers.crawler_manager import CrawlerManager
+from llms.replay_llm_util import RecordingLLMUtil, ReplayLLMUtil
+from search.replay_engine import RecordingSearchEngine, ReplaySearchEngine
+from crawlers.replay_crawler_manager import RecordingCrawlerManager, ReplayCrawlerManager
+from utils.cache_manager import set_cache_enabled
+from utils.config_center import Config
+from utils.fixtures import create_fixture_bundle
 
 def create_pipeline():
 
-    search_engine = DuckDuckGoEngine()
-    crawler_manager = CrawlerManager()
+    # "record" wraps the live llm util, search engine and crawler manager, "replay" stands in for them
+    replay = Config().get_config("replay")
+    replay.update(Config().get_global_config("replay") or {})
+    bundle = create_fixture_bundle(replay)
+    if bundle:
+        set_cache_enabled(False)
+    if bundle and replay["mode"] == "replay":
+        search_engine = ReplaySearchEngine(bundle)
+        crawler_manager = ReplayCrawlerManager(bundle)
+        llm_util = ReplayLLMUtil(bundle)
+    else:
+        # imported here, the live components need an api key, a search client and a browser pool
+        from search.duckduckgo_engine import DuckDuckGoEngine
+        from crawlers.crawler_manager import CrawlerManager
+        from llms.openai_util import DefaultLLMUtil
+        search_engine = DuckDuckGoEngine()
+        crawler_manager = CrawlerManager()
+        llm_util = DefaultLLMUtil()
+        if bundle:
+            search_engine = RecordingSearchEngine(search_engine, bundle)
+            crawler_manager = RecordingCrawlerManager(crawler_manager, bundle)
+            llm_util = RecordingLLMUtil(llm_util, bundle)
     prompt_provider = DefaultPromptProvider()
-    llm_util = DefaultLLMUtil()
     role_prompt_generator = DefaultRolePromptGenerator(prompt_provider, llm_util)
     question_expander = DefaultQuestionExpander(prompt_provider, llm_util)
     outline_generator = DefaultOutlineGenerator(prompt_provider, llm_util)
     summary_generator = DefaultSummaryGenerator(prompt_provider, llm_util)
-    report_agent = DefaultReportAgent(prompt_provider, llm_util)
+    report_config = Config().get_config("pipeline").get("report", {})
+    if report_config.get("mode", "single") == "sections":
+        report_agent = SectionReportAgent(prompt_provider, llm_util, report_config.get("section_llm", "fast"))
+    else:
+        report_agent = DefaultReportAgent(prompt_provider, llm_util)
     self_reflecter = DefaultSelfReflecter(prompt_provider, llm_util)
 
     return ResearchPipeline(
@@ -0,0 +1,66 @@
+"""
+writes a streamed report to report.md as the chunks arrive.
+
+every chunk is flushed to disk and emitted as a ReportChunk event, a ReportSection event is emitted whenever a markdown
+heading section is complete, so callers can render the report long before the model is done with it.
+"""
+
+from utils.events import EventBus, EventType
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ReportWriter:
+
+    def __init__(self, task_id: str, md_file: str, events: EventBus) -> None:
+        self.task_id = task_id
+        self.md_file = md_file
+        self.events = events
+        self.chunks: list[str] = []
+        self.section_index = 0
+        # text of the section being written, and the part of the line not ended yet
+        self.section: list[str] = []
+        self.line = ""
+        self.file = None
+
+    def __enter__(self) -> "ReportWriter":
+        self.file = open(self.md_file, "w", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.file.close()
+        if exc_type is None:
+            self.__end_line(self.line)
+            self.__end_section()
+            self.events.emit(self.task_id, EventType.ReportReady, length=len(self.report))
+
+    @property
+    def report(self) -> str:
+        return "".join(self.chunks)
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self.chunks.append(chunk)
+        self.file.write(chunk)
+        self.file.flush()
+        self.events.emit(self.task_id, EventType.ReportChunk, content=chunk)
+        lines = (self.line + chunk).split("\n")
+        for line in lines[:-1]:
+            self.__end_line(line)
+        self.line = lines[-1]
+
+    def __end_line(self, line: str) -> None:
+        if line.startswith("#") and self.section:
+            self.__end_section()
+        self.section.append(line)
+
+    def __end_section(self) -> None:
+        if not self.section:
+            return
+        heading = self.section[0].lstrip("#").strip() if self.section[0].startswith("#") else ""
+        self.events.emit(self.task_id, EventType.ReportSection, index=self.section_index, heading=heading,
+                         content="\n".join(self.section))
+        self.section_index += 1
+        self.section = []
@@ -0,0 +1,323 @@
+"""
+crawl, summary and self-reflection as decoupled stages.
+
+every stage is a group of worker threads consuming a bounded queue, so a worker holding a browser never waits for openai,
+and a full queue blocks the upstream stage (backpressure) instead of piling pages up in memory.
+
+    search ──> crawl ──> summary ──> reflect
+      ^          │                      │
+      └──────────┴──── refill ──────────┘
+
+the search stage queue is unbounded, it only holds references to queries that need more pages, this keeps the
+refill edges from blocking and the stage graph free of deadlocks.
+"""
+
+from components import CrawledPage, Summary, SubTopic, RolePrompt, SearchResult
+from concurrent.futures import Future, InvalidStateError
+from queue import Queue
+from typing import Any, Callable, Iterator
+from utils.scheduler import Scheduler
+from utils.events import EventType
+from utils.budget import should_stop
+from utils.deadline import clear_deadline
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+
+    def __init__(self, name: str, handler: Callable[[Any], None], on_error: Callable[[Any, Exception], None],
+                 workers: int, queue_size: int = 0) -> None:
+        """
+        Args:
+            name (str): the stage name, used to name the worker threads
+            handler (Callable): called with every item put into the stage
+            on_error (Callable): called with the item and the exception when handler raises
+            workers (int): number of worker threads
+            queue_size (int): max items waiting in the stage, 0 means unbounded
+        """
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size)
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            threading.Thread(target=self.__run, name=f"{self.name}-{i}", daemon=True).start()
+
+    def put(self, item: Any) -> None:
+        """
+        blocks when the stage is full
+        """
+        self.queue.put(item)
+
+    def __run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.exception(f"error in stage {self.name}: {e}")
+                self.on_error(item, e)
+            finally:
+                self.queue.task_done()
+
+
+class QueryWork:
+    """
+    the state of a single (sub_topic, query) unit flowing through the stages
+    """
+
+    def __init__(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str,
+                 search_results: Iterator[SearchResult], need_relavance_page_num: int) -> None:
+        self.task_id = task_id
+        self.agent_prompt = agent_prompt
+        self.sub_topic = sub_topic
+        self.query = query
+        self.search_results = search_results
+        self.need_relavance_page_num = need_relavance_page_num
+        self.accepted: list[Summary] = []
+        self.in_flight = 0
+        self.exhausted = False
+        self.finished = False
+        self.future: Future = Future()
+        self.lock = threading.Lock()
+        self.search_lock = threading.Lock()
+        self.future.add_done_callback(self.__on_done)
+
+    def stopped(self) -> bool:
+        """
+        finished, the caller is no longer interested (the future is cancelled), or the cost budget stops the sub topic
+        """
+        return self.finished or self.future.cancelled() or should_stop(self.task_id, self.sub_topic.sub_topic)
+
+    def drained(self) -> bool:
+        """
+        finished and no page of it left in the stages, the caller holds the lock
+        """
+        return self.finished and self.in_flight <= 0
+
+    def resolve(self, result: Summary = None, exception: Exception = None) -> None:
+        if self.future.cancelled():
+            return
+        try:
+            if exception:
+                self.future.set_exception(exception)
+            else:
+                self.future.set_result(result)
+        except InvalidStateError:
+            # cancelled by the caller in the meantime
+            pass
+
+    def __on_done(self, future: Future) -> None:
+        if future.cancelled():
+            # the caller gave up (the deadline), pages still in the stages are dropped at their next stage
+            with self.lock:
+                self.finished = True
+
+
+class StagedRunner:
+
+    def __init__(self, pipeline, config: dict) -> None:
+        """
+        Args:
+            pipeline (ResearchPipeline): provides search engine, crawler manager, summary generator and self reflecter
+            config (dict): the pipeline.staged config
+        """
+        self.pipeline = pipeline
+        self.window = config.get("window_per_query", 2)
+        queue_size = config.get("queue_size", 16)
+        # unless configured, stages get as many workers as the scheduler lets run at the same time
+        scheduler = Scheduler()
+        self.search_stage = Stage("search", self.__search, self.__on_error,
+                                  config.get("search_workers") or scheduler.get_concurrency("search", 2))
+        self.crawl_stage = Stage("crawl", self.__crawl, self.__on_error,
+                                 config.get("crawl_workers") or scheduler.get_concurrency("browser", 8), queue_size)
+        self.summary_stage = Stage("summary", self.__summary, self.__on_error,
+                                   config.get("summary_workers") or scheduler.get_concurrency("fast_llm", 8), queue_size)
+        self.reflect_stage = Stage("reflect", self.__reflect, self.__on_error,
+                                   config.get("reflect_workers") or scheduler.get_concurrency("fast_llm", 8), queue_size)
+        self.started = False
+        # task_id -> its queries not drained yet
+        self.works: dict[str, set[QueryWork]] = {}
+        # tasks that stopped waiting, their deadline is cleared once their queries drained
+        self.closing: set[str] = set()
+        self.lock = threading.Lock()
+
+    def submit(self, task_id: str, agent_prompt: RolePrompt, sub_topic: SubTopic, query: str,
+               need_relavance_page_num: int) -> Future:
+        """
+        submit a query, the returned future resolves to the merged summary, or None if not enough relavant pages found
+        """
+        with self.lock:
+            if not self.started:
+                for stage in [self.search_stage, self.crawl_stage, self.summary_stage, self.reflect_stage]:
+                    stage.start()
+                self.started = True
+        logger.info(f"doing staged summary for query: {query}")
+        search_results = iter(self.pipeline.search_engine.search(task_id, query, 0) or [])
+        work = QueryWork(task_id, agent_prompt, sub_topic, query, search_results, need_relavance_page_num)
+        with self.lock:
+            self.works.setdefault(task_id, set()).add(work)
+            # the task runs again, the deadline is its new one
+            self.closing.discard(task_id)
+        self.search_stage.put(work)
+        return work.future
+
+    def close(self, task_id: str) -> None:
+        """
+        the task stopped waiting for its queries, cancel the ones not done yet. the deadline of the task is kept as
+        the time cap of the crawls still running, and cleared once all of its queries drained
+        """
+        with self.lock:
+            works = list(self.works.get(task_id, []))
+            self.closing.add(task_id)
+        for work in works:
+            work.future.cancel()
+        for work in works:
+            self.__check_drained(work)
+        with self.lock:
+            if task_id in self.closing and not self.works.get(task_id):
+                self.__clear(task_id)
+
+    def __check_drained(self, work: QueryWork) -> None:
+        with work.lock:
+            if not work.drained():
+                return
+        with self.lock:
+            works = self.works.get(work.task_id)
+            if works is None or work not in works:
+                return
+            works.discard(work)
+            if not works and work.task_id in self.closing:
+                self.__clear(work.task_id)
+
+    def __clear(self, task_id: str) -> None:
+        """
+        the caller holds the lock
+        """
+        self.works.pop(task_id, None)
+        self.closing.discard(task_id)
+        clear_deadline(task_id)
+        logger.info(f"staged work of task {task_id} drained")
+
+    def __search(self, work: QueryWork) -> None:
+        """
+        feed search results of the query to the crawl stage, keep at most window pages in flight
+        """
+        with work.search_lock:
+            while True:
+                with work.lock:
+                    if work.stopped() or work.exhausted or work.in_flight >= self.window \
+                            or len(work.accepted) >= work.need_relavance_page_num:
+                        break
+                search_result = next(work.search_results, None)
+                with work.lock:
+                    if search_result is None:
+                        work.exhausted = True
+                        break
+                    work.in_flight += 1
+                self.crawl_stage.put((work, search_result))
+        self.__finish_if_drained(work)
+
+    def __crawl(self, item: tuple[QueryWork, SearchResult]) -> None:
+        work, search_result = item
+        if work.stopped():
+            return self.__release(work)
+        logger.info(f"doing crawl for url: {search_result.url}")
+        page = self.pipeline.crawler_manager.crawl(work.task_id, search_result.url)
+        self.pipeline.events.emit(work.task_id, EventType.PageCrawled, url=search_result.url, success=page is not None)
+        if page is None:
+            logger.warning(f"crawl failed for url: {search_result.url}")
+            return self.__release(work)
+        logger.info(f"crawl success for url: {search_result.url}, page: {page}")
+        self.summary_stage.put((work, page))
+
+    def __summary(self, item: tuple[QueryWork, CrawledPage]) -> None:
+        work, page = item
+        if work.stopped():
+            return self.__release(work)
+        summary = self.pipeline.summary_generator.generate(
+            work.task_id, work.agent_prompt.agent_role_prompt, page, work.sub_topic)
+        logger.info(f"summary: {summary}")
+        self.reflect_stage.put((work, summary))
+
+    def __reflect(self, item: tuple[QueryWork, Summary]) -> None:
+        work, summary = item
+        if work.stopped():
+            return self.__release(work)
+        page_relevance = self.pipeline.self_reflecter.determin_relavance(
+            work.task_id, work.agent_prompt.agent_role_prompt, work.sub_topic, summary.summary)
+        self.pipeline.events.emit(work.task_id,
+                                  EventType.SummaryAccepted if page_relevance.relavance else EventType.SummaryRejected,
+                                  url=summary.page.url, sub_topic=work.sub_topic.sub_topic)
+        if not page_relevance.relavance:
+            logger.info(f"page {summary.page.url} is not relavant to sub topic {work.sub_topic}")
+            return self.__release(work)
+
+        logger.info(f"page {summary.page.url} is relavant to sub topic {work.sub_topic}")
+        with work.lock:
+            work.in_flight -= 1
+            already_finished = work.finished
+            if not already_finished:
+                work.accepted.append(summary)
+                enough = work.finished = len(work.accepted) >= work.need_relavance_page_num
+        if already_finished:
+            return self.__check_drained(work)
+        if not enough:
+            return self.search_stage.put(work)
+        logger.info(f"got enough relavant pages for query {work.query}")
+        try:
+            merged = self.pipeline.summary_generator.generate(work.task_id, work.agent_prompt.agent_role_prompt,
+                                                              self.pipeline.merge_summaries(work.sub_topic, work.query, work.accepted),
+                                                              work.sub_topic)
+            self.pipeline.events.emit(work.task_id, EventType.QueryDone, sub_topic=work.sub_topic.sub_topic,
+                                      query=work.query, relavant_pages=len(work.accepted), found=True)
+            work.resolve(merged)
+        except Exception as e:
+            work.resolve(exception=e)
+        self.__check_drained(work)
+
+    def __release(self, work: QueryWork) -> None:
+        """
+        a page in flight is dropped, ask the search stage for another one
+        """
+        with work.lock:
+            work.in_flight -= 1
+        self.__check_drained(work)
+        self.search_stage.put(work)
+
+    def __finish_if_drained(self, work: QueryWork) -> None:
+        with work.lock:
+            if work.stopped():
+                # stopped by the cost budget, unlike a finished or cancelled query, its caller is still waiting
+                over_budget = not work.finished and not work.future.cancelled()
+                work.finished = True
+                resolve = over_budget
+            elif not work.exhausted or work.in_flight > 0:
+                return
+            else:
+                over_budget = False
+                resolve = True
+                work.finished = True
+        self.__check_drained(work)
+        if not resolve:
+            return
+        if over_budget:
+            logger.info(f"query {work.query} stopped by the cost budget, {len(work.accepted)} relavant pages found")
+        else:
+            logger.info(f"search results exhausted for query {work.query}, only {len(work.accepted)} relavant pages found")
+        self.pipeline.events.emit(work.task_id, EventType.QueryDone, sub_topic=work.sub_topic.sub_topic,
+                                  query=work.query, relavant_pages=len(work.accepted), found=False)
+        work.resolve(None)
+
+    def __on_error(self, item: Any, e: Exception) -> None:
+        if isinstance(item, QueryWork):
+            # the search itself failed, no more pages will come from it
+            with item.lock:
+                item.exhausted = True
+            return self.__finish_if_drained(item)
+        self.__release(item[0])
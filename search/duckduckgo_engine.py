@@ -5,6 +5,7 @@ import logging
 from typing import Generator
 from utils.cache_manager import cache_result, CacheType
 from utils.time_usage_record import time_usage
+from utils.scheduler import Scheduler
 
 logger = logging.getLogger(__name__)
 try:
@@ -44,23 +45,24 @@ class DuckDuckGoEngine(SearchEngine):
         if not query:
             logger.warning("Empty query for DuckDuckGo")
             return []
-        try:
-            results = ddgs.text(query, region=self.region,
-                                safesearch=self.safesearch)
-            if not results:
-                logger.warning(f"No results for '{query}' on DuckDuckGo")
-                return
-            num_returned = 0
-            for result in results:
-                if result.get('href').endswith('.pdf'):
-                    continue
-                if num_returned < start_num:
-                    num_returned += 1
-                    continue
-                num_returned += 1
-                yield SearchResult(result.get('href'), result.get('title'), result.get('body'), query)
-
-
-        except Exception as e:
-            logger.exception(f"Error searching '{query}' on DuckDuckGo: {e}")
+        # errors are raised, cache_result tells a failed search, tried again later, from one that ran out
+        results = ddgs.text(query, region=self.region,
+                            safesearch=self.safesearch)
+        if not results:
+            logger.warning(f"No results for '{query}' on DuckDuckGo")
             return
+        results = iter(results)
+        num_returned = 0
+        while True:
+            # ddgs fetches the next result page lazily, so the network call happens here
+            with Scheduler().acquire("search"):
+                result = next(results, None)
+            if result is None:
+                break
+            if result.get('href').endswith('.pdf'):
+                continue
+            if num_returned < start_num:
+                num_returned += 1
+                continue
+            num_returned += 1
+            yield SearchResult(result.get('href'), result.get('title'), result.get('body'), query)
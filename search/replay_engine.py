@@ -0,0 +1,66 @@
+"""
+record and replay of searches, see utils.fixtures.
+
+results are pulled lazily, so a search records only as many results as the pipeline pulled, with the delay before
+each of them. the longest recording of a query is kept, a replayed search ends where its recording ends.
+"""
+
+from search.search_engine import SearchEngine
+from components import SearchResult
+from utils.fixtures import FixtureBundle
+from utils.scheduler import Scheduler
+from typing import Generator
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingSearchEngine(SearchEngine):
+
+    def __init__(self, search_engine: SearchEngine, bundle: FixtureBundle) -> None:
+        self.search_engine = search_engine
+        self.bundle = bundle
+
+    def get_name(self) -> str:
+        return self.search_engine.get_name()
+
+    def search(self, task_id: str, query: str, start_num: int = 0) -> Generator[SearchResult, None, None]:
+        results, delays = [], []
+        start = time.time()
+        try:
+            for result in self.search_engine.search(task_id, query, start_num) or []:
+                delays.append(time.time() - start)
+                results.append(result.serialize())
+                yield result
+                start = time.time()
+        finally:
+            key = FixtureBundle.key(self.get_name(), query, start_num)
+            recorded = self.bundle.get("search", key)
+            if recorded is None or len(recorded["results"]) < len(results):
+                self.bundle.put("search", key, {"results": results, "delays": delays})
+
+
+class ReplaySearchEngine(SearchEngine):
+
+    def __init__(self, bundle: FixtureBundle, name: str = "duckduckgo") -> None:
+        """
+        Args:
+            bundle (FixtureBundle): the recorded searches
+            name (str): name of the recorded search engine
+        """
+        self.bundle = bundle
+        self.name = name
+
+    def get_name(self) -> str:
+        return self.name
+
+    def search(self, task_id: str, query: str, start_num: int = 0) -> Generator[SearchResult, None, None]:
+        recorded = self.bundle.get("search", FixtureBundle.key(self.name, query, start_num))
+        if recorded is None:
+            logger.warning(f"no recorded search for '{query}', replay no results")
+            return
+        for result, delay in zip(recorded["results"], recorded["delays"]):
+            with Scheduler().acquire("search"):
+                self.bundle.sleep("search", delay)
+            yield SearchResult.deserialize(SearchResult, result)
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Generator
+from typing import Generator, AsyncGenerator
 from components import SearchResult
+import asyncio
 
 
 class SearchEngine(ABC):
@@ -12,6 +13,23 @@ class SearchEngine(ABC):
         """
         pass
 
+    async def search_async(self, task_id: str, query: str, start_num: int = 0) -> AsyncGenerator[SearchResult, None]:
+        """
+        async version of search. by default every step of the blocking search generator
+        is run in the default executor, so results are still pulled lazily.
+        implements with a native async client should override this method.
+        """
+        results = self.search(task_id, query, start_num)
+        if results is None:
+            return
+        results = iter(results)
+        sentinel = object()
+        while True:
+            result = await asyncio.to_thread(next, results, sentinel)
+            if result is sentinel:
+                return
+            yield result
+
     @abstractmethod
     def get_name(self) -> str:
         """
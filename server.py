@@ -0,0 +1,246 @@
+"""
+a long running http service for research jobs.
+
+jobs are queued and executed by a fixed number of workers, every worker keeps its own pipeline alive across jobs,
+so selenium drivers, config, caches and http clients stay warm between reports.
+
+    POST /jobs                   {"topic": "...", "deadline": seconds, "budget": dollars}, deadline and budget are
+                                 optional, returns the job
+    GET  /jobs                   list all jobs
+    GET  /jobs/<job_id>          status of a job
+    GET  /jobs/<job_id>/report.md
+    GET  /jobs/<job_id>/report.pdf
+    GET  /jobs/<job_id>/events   progress events of the job so far
+    GET  /cache                  cache sizes and hit rates
+    GET  /stats                  rate limit waits, model route latencies and response cache hits of every worker
+    GET  /health
+"""
+
+from pipeline.pipeline_factory import create_pipeline
+from pipeline.pipeline import generate_task_id
+from utils.config_center import Config
+from utils.events import EventBus
+from utils.cache_manager import get_cache_stats
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue
+from typing import Optional
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+
+    def __init__(self, topic: str, deadline: float = None, budget: float = None) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.topic = topic
+        self.deadline = deadline
+        self.budget = budget
+        self.task_id = generate_task_id(topic)
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.bill = None
+        self.pdf_path = None
+        self.md_path = None
+
+    def serialize(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "topic": self.topic,
+            "task_id": self.task_id,
+            "deadline": self.deadline,
+            "budget": self.budget,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "bill": self.bill,
+            "idle_seconds": EventBus().idle_seconds().get(self.task_id) if self.status == "running" else None
+        }
+
+
+class JobQueue:
+
+    def __init__(self, workers: int) -> None:
+        self.queue: Queue[Job] = Queue()
+        self.jobs: dict[str, Job] = {}
+        # the pipeline of every worker, once it is created
+        self.pipelines = []
+        self.lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self.__work, name=f"research-worker-{i}", daemon=True).start()
+
+    def submit(self, topic: str, deadline: float = None, budget: float = None) -> Job:
+        """
+        queue a research job. a topic already queued or running is not queued twice, the existing job is returned.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.task_id == generate_task_id(topic) and job.status in ["queued", "running"]:
+                    return job
+            job = Job(topic, deadline, budget)
+            self.jobs[job.job_id] = job
+        self.queue.put(job)
+        logger.info(f"job {job.job_id} queued for topic: {topic}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def count(self, status: str) -> int:
+        return len([job for job in self.list() if job.status == status])
+
+    def stats(self) -> list[dict]:
+        """
+        stats of the llm util of every worker, each worker has its own rate limiter, router and counters
+        """
+        with self.lock:
+            pipelines = list(self.pipelines)
+        return [pipeline.llm_util.get_stats() for pipeline in pipelines]
+
+    def __work(self) -> None:
+        # one pipeline per worker, created once and reused for every job
+        pipeline = create_pipeline()
+        with self.lock:
+            self.pipelines.append(pipeline)
+        while True:
+            job = self.queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            logger.info(f"job {job.job_id} started, topic: {job.topic}")
+            try:
+                job.pdf_path, job.md_path = pipeline.do_research(job.topic, job.deadline, job.budget)
+                bill = pipeline.get_bill(job.topic)
+                job.bill = bill.total_bill if bill else None
+                job.status = "done"
+            except Exception as e:
+                logger.exception(f"job {job.job_id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                self.queue.task_done()
+            logger.info(f"job {job.job_id} {job.status} in {job.finished_at - job.started_at:.1f}s")
+
+
+class ResearchRequestHandler(BaseHTTPRequestHandler):
+
+    job_queue: JobQueue = None
+
+    def do_GET(self) -> None:
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        if parts == ["health"]:
+            return self.__send_json(200, {"status": "ok",
+                                          "queued": self.job_queue.count("queued"),
+                                          "running": self.job_queue.count("running")})
+        if parts == ["cache"]:
+            return self.__send_json(200, get_cache_stats())
+        if parts == ["stats"]:
+            return self.__send_json(200, {"workers": self.job_queue.stats()})
+        if parts == ["jobs"]:
+            return self.__send_json(200, [job.serialize() for job in self.job_queue.list()])
+        if len(parts) in [2, 3] and parts[0] == "jobs":
+            job = self.job_queue.get(parts[1])
+            if job is None:
+                return self.__send_json(404, {"error": f"job {parts[1]} not found"})
+            if len(parts) == 2:
+                return self.__send_json(200, job.serialize())
+            if parts[2] == "events":
+                if job.status == "queued":
+                    return self.__send_json(200, [])
+                return self.__send_json(200, [event.serialize() for event in EventBus().history(job.task_id)])
+            if parts[2] not in ["report.md", "report.pdf"]:
+                return self.__send_json(404, {"error": f"unknown file {parts[2]}"})
+            if job.status != "done":
+                return self.__send_json(409, {"error": f"job {job.job_id} is {job.status}"})
+            if parts[2] == "report.md":
+                return self.__send_file(job.md_path, "text/markdown; charset=utf-8", job.task_id + ".md")
+            return self.__send_file(job.pdf_path, "application/pdf", job.task_id + ".pdf")
+        self.__send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            return self.__send_json(404, {"error": f"unknown path {self.path}"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            return self.__send_json(400, {"error": "body should be a json object"})
+        topic = body.get("topic") if isinstance(body, dict) else None
+        if not isinstance(topic, str) or not topic.strip():
+            return self.__send_json(400, {"error": "topic is required"})
+        deadline = body.get("deadline")
+        if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0):
+            return self.__send_json(400, {"error": "deadline should be a positive number of seconds"})
+        budget = body.get("budget")
+        if budget is not None and (isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget <= 0):
+            return self.__send_json(400, {"error": "budget should be a positive number of dollars"})
+        job = self.job_queue.submit(topic.strip(), deadline, budget)
+        self.__send_json(202, job.serialize())
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def __send_json(self, code: int, obj) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_file(self, path: str, content_type: str, file_name: str) -> None:
+        if not path or not os.path.exists(path):
+            return self.__send_json(404, {"error": "report file not found"})
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Disposition", f'attachment; filename="{file_name}"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='server')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=2, help='number of research jobs running at the same time')
+    parser.add_argument('--disable-headless', action='store_true', help='disable headless mode for selenium, useful for debug')
+    args = parser.parse_args()
+    Config().set_global_config("disable_headless", args.disable_headless)
+
+    log_file_path = os.path.join(os.path.dirname(__file__), "output", "server.log")
+    if not os.path.exists(os.path.dirname(log_file_path)):
+        os.makedirs(os.path.dirname(log_file_path))
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(log_file_path, encoding="utf-8")
+        ]
+    )
+
+    ResearchRequestHandler.job_queue = JobQueue(args.workers)
+    server = ThreadingHTTPServer((args.host, args.port), ResearchRequestHandler)
+    logger.info(f"research service listening on {args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
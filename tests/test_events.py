@@ -0,0 +1,58 @@
+"""
+the event bus forgets finished tasks, so a long running server does not keep every history
+"""
+
+from utils.events import EventBus, EventType
+import time
+import pytest
+
+
+@pytest.fixture
+def new_bus():
+    # a fresh bus per test instead of the process wide singleton
+    buses = []
+
+    def make(**kwargs) -> EventBus:
+        EventBus._instances.pop(EventBus, None)
+        buses.append(EventBus(**kwargs))
+        return buses[-1]
+    yield make
+    EventBus._instances.pop(EventBus, None)
+
+
+def run_task(bus: EventBus, task_id: str, failed: bool = False) -> None:
+    try:
+        with bus.track(task_id, topic=task_id):
+            bus.emit(task_id, EventType.OutlineReady)
+            if failed:
+                raise RuntimeError("boom")
+        bus.emit(task_id, EventType.TaskDone)
+    except RuntimeError:
+        pass
+
+
+def test_finished_tasks_expire_after_retention(new_bus):
+    bus = new_bus(retention_seconds=0.05, max_finished_tasks=100)
+    run_task(bus, "done")
+    run_task(bus, "failed", failed=True)
+    with bus.track("running"):
+        pass
+    assert [e.event_type for e in bus.history("done")][-1] == EventType.TaskDone
+    assert [e.event_type for e in bus.history("failed")][-1] == EventType.TaskFailed
+
+    time.sleep(0.1)
+    run_task(bus, "next")
+    assert bus.history("done") == []
+    assert bus.history("failed") == []
+    assert set(bus.tasks) == {"running", "next"}
+    assert list(bus.idle_seconds()) == ["running"]
+
+
+def test_only_the_latest_finished_tasks_are_kept(new_bus):
+    bus = new_bus(retention_seconds=3600, max_finished_tasks=2)
+    with bus.track("running"):
+        pass
+    for i in range(5):
+        run_task(bus, f"task-{i}")
+    assert set(bus.tasks) == {"running", "task-3", "task-4"}
+    assert bus.history("task-0") == []
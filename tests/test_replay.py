@@ -0,0 +1,94 @@
+"""
+a replayed report must find its recording whatever order the summaries were done in
+"""
+
+from components import CrawledPage, Summary, SubTopic, ReportOutline, LLMTokenBill
+from llms.base_llm_util import LLMUtil
+from llms.prompt_provider import DefaultPromptProvider
+from llms.replay_llm_util import RecordingLLMUtil, ReplayLLMUtil
+from llms.report_agent import DefaultReportAgent, SectionReportAgent
+from llms.token_accountant import TokenAccountant
+from utils.fixtures import FixtureBundle
+import utils.cache_manager as cache_manager
+import os
+import random
+import shutil
+import pytest
+
+TASK_ID = "test-replay-shuffled-summaries"
+
+
+class EchoLLMUtil(LLMUtil):
+    """
+    answers with the size of the prompt, a live model for recording
+    """
+
+    def get_fast_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return f"answer to {len(str(messages))} chars"
+
+    def get_fast_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs):
+        yield self.get_fast_result(messages)
+
+    def get_smart_result(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return "===CONCLUSION===".join([self.get_fast_result(messages)] * 2)
+
+    def get_smart_stream_result(self, messages, temperature=0.2, max_tokens=None, **kwargs):
+        yield self.get_smart_result(messages)
+
+    async def get_fast_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return self.get_fast_result(messages)
+
+    async def get_fast_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs):
+        yield self.get_fast_result(messages)
+
+    async def get_smart_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs) -> str:
+        return self.get_smart_result(messages)
+
+    async def get_smart_stream_result_async(self, messages, temperature=0.2, max_tokens=None, **kwargs):
+        yield self.get_smart_result(messages)
+
+    def split_for_fast(self, content: str, **kwargs) -> list[str]:
+        return [content]
+
+    def split_for_smart(self, content: str, **kwargs) -> list[str]:
+        return [content]
+
+    def get_bill(self, task_id: str) -> LLMTokenBill:
+        return None
+
+
+@pytest.fixture
+def no_cache():
+    # as in record and replay mode, the report has to come from the llm
+    cache_manager.set_cache_enabled(False)
+    yield
+    cache_manager.set_cache_enabled(True)
+    # time usage and token use of the task are written to output
+    TokenAccountant().flush(TASK_ID)
+    shutil.rmtree(os.path.join(os.path.dirname(os.path.dirname(__file__)), "output", TASK_ID), ignore_errors=True)
+
+
+def make_outline() -> ReportOutline:
+    sub_topics = [SubTopic("topic", f"## section {i}", "describe", 100) for i in range(3)]
+    return ReportOutline("topic", "# topic", "outline", sub_topics)
+
+
+def make_summaries(outline: ReportOutline) -> list[Summary]:
+    return [Summary(sub_topic, CrawledPage(f"summary:{sub_topic.sub_topic}:::query {q}", "title", "content"), {},
+                    f"summary {i} {q}")
+            for i, sub_topic in enumerate(outline.sub_topics) for q in range(3)]
+
+
+@pytest.mark.parametrize("agent_class", [DefaultReportAgent, SectionReportAgent])
+def test_replay_report_with_shuffled_summaries(tmp_path, no_cache, agent_class):
+    outline = make_outline()
+    summaries = make_summaries(outline)
+    bundle = FixtureBundle(str(tmp_path), {"scale": 0})
+    recording = agent_class(DefaultPromptProvider(), RecordingLLMUtil(EchoLLMUtil(), bundle))
+    recorded = recording.generate(TASK_ID, "role", summaries, "topic", outline).report
+
+    replaying = agent_class(DefaultPromptProvider(), ReplayLLMUtil(FixtureBundle(str(tmp_path), {"scale": 0})))
+    for seed in range(5):
+        shuffled = list(summaries)
+        random.Random(seed).shuffle(shuffled)
+        assert replaying.generate(TASK_ID, "role", shuffled, "topic", outline).report == recorded
@@ -0,0 +1,113 @@
+"""
+cost budgets of research tasks.
+
+the pipeline registers the max dollars a task may spend and the order of its sub topics, the llm util adds the cost of
+every call as soon as it is back. the spend decides how the rest of the task runs:
+
+    below downgrade_ratio    normal
+    past downgrade_ratio     smart calls go to the fast models, fewer relavant pages are needed per query
+    past stop_ratio          the lower-priority half of the sub topics (the later ones in the outline) stops researching
+    past the budget          all research stops, the report is written from what exists
+"""
+
+from typing import Optional
+import enum
+import math
+import threading
+
+
+class BudgetLevel(enum.IntEnum):
+    Normal = 0
+    Downgrade = 1
+    Stop = 2
+    Exhausted = 3
+
+
+class TaskBudget:
+
+    def __init__(self, max_cost: float, downgrade_ratio: float, stop_ratio: float) -> None:
+        self.max_cost = max_cost
+        self.downgrade_ratio = downgrade_ratio
+        self.stop_ratio = stop_ratio
+        self.spent = 0.0
+        # sub topic -> its index in the outline, the first ones matter most
+        self.priorities: dict[str, int] = {}
+
+    def level(self) -> BudgetLevel:
+        if self.spent >= self.max_cost:
+            return BudgetLevel.Exhausted
+        if self.spent >= self.max_cost * self.stop_ratio:
+            return BudgetLevel.Stop
+        if self.spent >= self.max_cost * self.downgrade_ratio:
+            return BudgetLevel.Downgrade
+        return BudgetLevel.Normal
+
+
+lock = threading.Lock()
+budgets: dict[str, TaskBudget] = {}
+
+
+def set_budget(task_id: str, max_cost: float, downgrade_ratio: float = 0.6, stop_ratio: float = 0.85) -> None:
+    with lock:
+        budgets[task_id] = TaskBudget(max_cost, downgrade_ratio, stop_ratio)
+
+
+def clear_budget(task_id: str) -> None:
+    with lock:
+        budgets.pop(task_id, None)
+
+
+def set_priorities(task_id: str, sub_topics: list[str]) -> None:
+    with lock:
+        budget = budgets.get(task_id)
+        if budget is not None:
+            budget.priorities = {sub_topic: i for i, sub_topic in enumerate(sub_topics)}
+
+
+def add_cost(task_id: str, cost: float) -> Optional[tuple[BudgetLevel, BudgetLevel]]:
+    """
+    add the cost of a call, return (level before, level after) when the call moved the task to another level
+    """
+    with lock:
+        budget = budgets.get(task_id)
+        if budget is None:
+            return None
+        before = budget.level()
+        budget.spent += cost
+        after = budget.level()
+    return (before, after) if before != after else None
+
+
+def budget_level(task_id: str) -> BudgetLevel:
+    """
+    Normal if the task has no budget
+    """
+    with lock:
+        budget = budgets.get(task_id)
+        return budget.level() if budget else BudgetLevel.Normal
+
+
+def spent(task_id: str) -> Optional[tuple[float, float]]:
+    """
+    (dollars spent, max dollars) of the task, None if the task has no budget
+    """
+    with lock:
+        budget = budgets.get(task_id)
+        return (budget.spent, budget.max_cost) if budget else None
+
+
+def should_stop(task_id: str, sub_topic: str) -> bool:
+    """
+    whether research of the sub topic should stop because of the budget
+    """
+    with lock:
+        budget = budgets.get(task_id)
+        if budget is None:
+            return False
+        level = budget.level()
+        if level == BudgetLevel.Exhausted:
+            return True
+        if level == BudgetLevel.Stop:
+            priority = budget.priorities.get(sub_topic)
+            return priority is not None and priority >= math.ceil(len(budget.priorities) / 2)
+        return False
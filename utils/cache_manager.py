@@ -3,18 +3,29 @@
 import os
 
 
-from typing import Callable, Type
+from abc import ABC, abstractmethod
+from typing import Callable, Type, Iterator, Optional
 from components import CacheAble
+from utils.config_center import Config
+import asyncio
 import logging
 import json
 import enum
 import hashlib
+import inspect
+import sqlite3
+import sys
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
 logger = logging.getLogger(__name__)
 
 lock = threading.Lock()
-cache = {}
+store = None
+# the caches answer before the calls they cache are made, they are switched off while recording or replaying fixtures
+enabled = True
 
 
 class CacheType(enum.Enum):
@@ -29,42 +40,465 @@ def default_key_gen(*args, **kwargs) -> str:
     return hashlib.md5(
         (str(args) + str(kwargs)).encode("utf-8")).hexdigest()
 
-def get_file_path(task_id: str, cache_file: str) -> str:
+def get_task_dir(task_id: str) -> str:
     cache_path = os.path.join(os.path.dirname(
         os.path.dirname(__file__)), "output", task_id)
-    if not os.path.exists(cache_path):
-        os.makedirs(cache_path)
-    file_path = os.path.join(cache_path, cache_file + ".json")
-    return file_path
+    # concurrent first calls of a task race for it
+    os.makedirs(cache_path, exist_ok=True)
+    return cache_path
 
-def get_or_create_cache(task_id: str, cache_file: str, key: str) -> str | list[str] | None:
-    with lock:
-        file_path = get_file_path(task_id, cache_file)
+def get_file_path(task_id: str, cache_file: str) -> str:
+    return os.path.join(get_task_dir(task_id), cache_file + ".json")
+
+
+class CacheStore(ABC):
+    """
+    where the cached results of a task are kept. a value is anything json serializable.
+    """
+
+    @abstractmethod
+    def get(self, task_id: str, cache_file: str, key: str) -> str | list[str] | None:
+        pass
+
+    @abstractmethod
+    def put(self, task_id: str, cache_file: str, key: str, value) -> None:
+        pass
 
-        if task_id not in cache:
-            cache[task_id] = {}
-        if cache_file not in cache[task_id]:
+
+class JsonCacheStore(CacheStore):
+    """
+    one json file per cache file, kept in memory and rewritten on every put.
+    easy to read, but a put costs as much as the whole file and the files stay in memory whatever the memory tier,
+    only for small caches.
+    """
+
+    def __init__(self) -> None:
+        self.cache: dict[tuple[str, str], dict] = {}
+        # one lock per cache file, puts to different files do not wait for each other
+        self.locks: dict[tuple[str, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def get(self, task_id: str, cache_file: str, key: str) -> str | list[str] | None:
+        with self.__lock(task_id, cache_file):
+            return self.__load(task_id, cache_file).get(key, None)
+
+    def put(self, task_id: str, cache_file: str, key: str, value) -> None:
+        with self.__lock(task_id, cache_file):
+            entries = self.__load(task_id, cache_file)
+            entries[key] = value
+            with open(get_file_path(task_id, cache_file), "w") as f:
+                f.write(json.dumps(entries, indent=4, ensure_ascii=False))
+
+    def __lock(self, task_id: str, cache_file: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault((task_id, cache_file), threading.Lock())
+
+    def __load(self, task_id: str, cache_file: str) -> dict:
+        if (task_id, cache_file) not in self.cache:
+            file_path = get_file_path(task_id, cache_file)
+            entries = {}
             if os.path.exists(file_path):
                 with open(file_path, "r") as f:
-                    cache[task_id][cache_file] = json.loads(f.read())
-            else:
-                with open(file_path, "w") as f:
-                    f.write("{}")
-                cache[task_id][cache_file] = {}
-        return cache[task_id][cache_file].get(key, None)
+                    entries = json.loads(f.read())
+            self.cache[(task_id, cache_file)] = entries
+        return self.cache[(task_id, cache_file)]
+
+
+class SqliteCacheStore(CacheStore):
+    """
+    one sqlite database in WAL mode per task, output/<task_id>/cache.sqlite, a put writes only its own row.
+    the json file of a cache file, written by JsonCacheStore or older versions, is imported the first time
+    the cache file is used, and left in place.
+    """
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        # (task_id, cache_file) already checked for a json file to import
+        self.migrated: set[tuple[str, str]] = set()
+        self.lock = threading.Lock()
+
+    def get(self, task_id: str, cache_file: str, key: str) -> str | list[str] | None:
+        row = self.__ready(task_id, cache_file).execute(
+            "SELECT value FROM entries WHERE cache_file = ? AND key = ?", (cache_file, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, task_id: str, cache_file: str, key: str, value) -> None:
+        self.__ready(task_id, cache_file).execute(
+            "INSERT OR REPLACE INTO entries (cache_file, key, value) VALUES (?, ?, ?)",
+            (cache_file, key, json.dumps(value, ensure_ascii=False)))
+
+    def __conn(self, task_id: str) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if not hasattr(self.local, "conns"):
+            self.local.conns = {}
+        if task_id not in self.local.conns:
+            conn = sqlite3.connect(os.path.join(get_task_dir(task_id), "cache.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    cache_file TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (cache_file, key)
+                )""")
+            conn.execute("CREATE TABLE IF NOT EXISTS migrated (cache_file TEXT PRIMARY KEY)")
+            self.local.conns[task_id] = conn
+        return self.local.conns[task_id]
+
+    def __ready(self, task_id: str, cache_file: str) -> sqlite3.Connection:
+        conn = self.__conn(task_id)
+        if (task_id, cache_file) not in self.migrated:
+            with self.lock:
+                if (task_id, cache_file) not in self.migrated:
+                    self.__migrate(conn, task_id, cache_file)
+                    self.migrated.add((task_id, cache_file))
+        return conn
+
+    def __migrate(self, conn: sqlite3.Connection, task_id: str, cache_file: str) -> None:
+        """
+        import the json file of the cache file once, other processes may race for it, hence the transaction
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM migrated WHERE cache_file = ?", (cache_file,)).fetchone():
+                file_path = get_file_path(task_id, cache_file)
+                if os.path.exists(file_path):
+                    try:
+                        with open(file_path, "r") as f:
+                            entries = json.loads(f.read())
+                        conn.executemany("INSERT OR IGNORE INTO entries (cache_file, key, value) VALUES (?, ?, ?)",
+                                         [(cache_file, k, json.dumps(v, ensure_ascii=False)) for k, v in entries.items()])
+                        logger.info(f"imported {len(entries)} entries of {file_path}")
+                    except (ValueError, AttributeError) as e:
+                        logger.warning(f"failed to import {file_path}, start it empty: {e}")
+                conn.execute("INSERT INTO migrated (cache_file) VALUES (?)", (cache_file,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class CacheFileStats:
+
+    def __init__(self) -> None:
+        self.entries = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def serialize(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None
+        }
+
+
+class MemoryTier(CacheStore):
+    """
+    a bounded in-memory tier in front of another store. an entry is kept as its json and sized by the memory of it,
+    the least recently used entries are evicted once max_bytes is passed, and entries older than ttl_seconds on access.
+    puts are written through, a miss falls through to the store.
+    """
+
+    def __init__(self, store: CacheStore, max_bytes: int, ttl_seconds: float = None) -> None:
+        self.store = store
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # (task_id, cache_file, key) -> (json, size, kept_at), least recently used first
+        self.entries: OrderedDict[tuple[str, str, str], tuple[str, int, float]] = OrderedDict()
+        self.stats: dict[tuple[str, str], CacheFileStats] = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, task_id: str, cache_file: str, key: str) -> str | list[str] | None:
+        entry_key = (task_id, cache_file, key)
+        with self.lock:
+            stats = self.__stats(task_id, cache_file)
+            entry = self.entries.get(entry_key)
+            if entry is not None and self.ttl_seconds is not None and time.time() - entry[2] > self.ttl_seconds:
+                self.__evict(entry_key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(entry_key)
+                stats.hits += 1
+                return json.loads(entry[0])
+            stats.misses += 1
+        value = self.store.get(task_id, cache_file, key)
+        if value is not None:
+            # a put racing with this miss has the newer value, it wins
+            self.__keep(entry_key, json.dumps(value, ensure_ascii=False), replace=False)
+        return value
+
+    def put(self, task_id: str, cache_file: str, key: str, value) -> None:
+        self.store.put(task_id, cache_file, key, value)
+        self.__keep((task_id, cache_file, key), json.dumps(value, ensure_ascii=False), replace=True)
+
+    def get_stats(self) -> dict[str, dict]:
+        """
+        resident entries and bytes, hits and misses per cache file, "task_id/cache_file"
+        """
+        with self.lock:
+            result = {f"{task_id}/{cache_file}": stats.serialize()
+                      for (task_id, cache_file), stats in self.stats.items()}
+            result["total"] = {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
+            return result
+
+    def __keep(self, entry_key: tuple[str, str, str], encoded: str, replace: bool) -> None:
+        size = sys.getsizeof(encoded) + sys.getsizeof(entry_key[2])
+        with self.lock:
+            if entry_key in self.entries:
+                if not replace:
+                    return
+                self.__evict(entry_key)
+            if size > self.max_bytes:
+                return
+            self.entries[entry_key] = (encoded, size, time.time())
+            self.size += size
+            stats = self.__stats(entry_key[0], entry_key[1])
+            stats.entries += 1
+            stats.bytes += size
+            while self.size > self.max_bytes:
+                self.__evict(next(iter(self.entries)))
+
+    def __evict(self, entry_key: tuple[str, str, str]) -> None:
+        """
+        the caller holds the lock
+        """
+        _, size, _ = self.entries.pop(entry_key)
+        self.size -= size
+        stats = self.__stats(entry_key[0], entry_key[1])
+        stats.entries -= 1
+        stats.bytes -= size
+
+    def __stats(self, task_id: str, cache_file: str) -> CacheFileStats:
+        if (task_id, cache_file) not in self.stats:
+            self.stats[(task_id, cache_file)] = CacheFileStats()
+        return self.stats[(task_id, cache_file)]
+
+
+def get_cache_store() -> CacheStore:
+    """
+    the store of the "cache.backend" config, "sqlite" or "json", behind a memory tier of "cache.memory" unless its
+    max_bytes is 0
+    """
+    global store
+    if store is None:
+        with lock:
+            if store is None:
+                config = Config().get_config("cache")
+                backend = config.get("backend", "sqlite")
+                if backend == "sqlite":
+                    backend_store = SqliteCacheStore()
+                elif backend == "json":
+                    backend_store = JsonCacheStore()
+                else:
+                    raise ValueError(f"unknown cache backend: {backend}, should be sqlite or json")
+                memory = config.get("memory", {})
+                if memory.get("max_bytes", 0) > 0:
+                    backend_store = MemoryTier(backend_store, memory["max_bytes"], memory.get("ttl_seconds"))
+                store = backend_store
+    return store
+
+
+def get_cache_stats() -> dict[str, dict]:
+    """
+    stats of the memory tier, empty without one
+    """
+    cache_store = get_cache_store()
+    return cache_store.get_stats() if isinstance(cache_store, MemoryTier) else {}
+
+
+def set_cache_enabled(value: bool) -> None:
+    global enabled
+    enabled = value
+
+
+def get_or_create_cache(task_id: str, cache_file: str, key: str) -> str | list[str] | None:
+    if not enabled:
+        return None
+    return get_cache_store().get(task_id, cache_file, key)
 
 
 def update_and_save_cache(task_id: str, cache_file: str, key: str, value: str) -> None:
-    with lock:
-        file_path = get_file_path(task_id, cache_file)
+    if not enabled:
+        return
+    get_cache_store().put(task_id, cache_file, key, value)
 
-        if task_id not in cache:
-            cache[task_id] = {}
-        if cache_file not in cache[task_id]:
-            cache[task_id][cache_file] = {}
-        cache[task_id][cache_file][key] = value
-        with open(file_path, "w") as f:
-            f.write(json.dumps(cache[task_id][cache_file], indent=4, ensure_ascii=False))
+
+class SingleFlight:
+    """
+    concurrent calls of the same key share one call: the first caller runs it, callers arriving while it runs wait
+    for its result or exception. threads and event loops, any mix of them, share the same calls.
+    """
+
+    # set for the waiters when the running call was cancelled, they run it themselves
+    RETRY = object()
+
+    def __init__(self) -> None:
+        self.calls: dict[tuple, Future] = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: tuple, func: Callable) -> tuple[object, bool]:
+        """
+        result of func, and whether it was shared from another caller
+        """
+        while True:
+            future, leader = self.__join(key)
+            if leader:
+                return self.__run(key, future, func), False
+            result = future.result()
+            if result is not SingleFlight.RETRY:
+                return result, True
+
+    async def do_async(self, key: tuple, func: Callable) -> tuple[object, bool]:
+        """
+        async version of do, func is a coroutine function
+        """
+        while True:
+            future, leader = self.__join(key)
+            if leader:
+                try:
+                    result = await func()
+                except asyncio.CancelledError:
+                    self.__finish(key, future, result=SingleFlight.RETRY)
+                    raise
+                except BaseException as e:
+                    self.__finish(key, future, exception=e)
+                    raise
+                self.__finish(key, future, result=result)
+                return result, False
+            # shielded, a cancelled waiter must not cancel the call of the others
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not SingleFlight.RETRY:
+                return result, True
+
+    def __join(self, key: tuple) -> tuple[Future, bool]:
+        with self.lock:
+            if key in self.calls:
+                return self.calls[key], False
+            future = Future()
+            self.calls[key] = future
+            return future, True
+
+    def __run(self, key: tuple, future: Future, func: Callable):
+        try:
+            result = func()
+        except BaseException as e:
+            self.__finish(key, future, exception=e)
+            raise
+        self.__finish(key, future, result=result)
+        return result
+
+    def __finish(self, key: tuple, future: Future, result=None, exception: BaseException = None) -> None:
+        with self.lock:
+            del self.calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+in_flight = SingleFlight()
+
+
+class ResultCursor:
+    """
+    a cached generator, e.g. a search, being consumed. the results pulled so far and whether the generator ran out
+    are cached, the generator itself is kept open, so a consumer that needs more results continues where the last one
+    stopped instead of starting it again. consumers of the cursor share its results, every result is pulled once.
+
+    a generator started again, in a new process or after its cursor was dropped, yields the cached results first,
+    they are skipped. a generator that raises has failed rather than ran out, it is not marked exhausted and the
+    exception ends only the current consumer.
+    """
+
+    def __init__(self, task_id: str, cache_file: str, key: str) -> None:
+        self.task_id = task_id
+        self.cache_file = cache_file
+        self.key = key
+        state = get_or_create_cache(task_id, cache_file, key) or {}
+        if isinstance(state, list):
+            # cached before cursors, a plain list of results
+            state = {"results": state}
+        self.results: list = state.get("results", [])
+        self.exhausted: bool = state.get("exhausted", False)
+        self.live: Optional[Iterator] = None
+        # results yielded by the live generator
+        self.pulled = 0
+        self.lock = threading.Lock()
+
+    def get(self, index: int, start: Callable[[], Iterator]) -> Optional[dict]:
+        """
+        the serialized result at index, pulled from the generator if needed, None past the last one.
+        start starts the generator
+        """
+        with self.lock:
+            while index >= len(self.results) and not self.exhausted:
+                if not self.__pull(start):
+                    break
+            return self.results[index] if index < len(self.results) else None
+
+    def __pull(self, start: Callable[[], Iterator]) -> bool:
+        """
+        pull one more result, False if there is none
+        """
+        try:
+            if self.live is None:
+                self.live = iter(start() or [])
+                self.pulled = 0
+            r = None
+            while self.pulled <= len(self.results):
+                r = next(self.live, None)
+                if r is None:
+                    break
+                self.pulled += 1
+        except Exception as e:
+            # failed, not ran out, the next consumer that needs more starts it again
+            logger.exception(f"generator for {self.key} failed after {self.pulled} results: {e}")
+            self.live = None
+            return False
+        if r is None:
+            self.exhausted = True
+            self.live = None
+            self.__save()
+            return False
+        logger.debug(f"generator, generating new cache for {self.key}")
+        self.results.append(r.serialize())
+        self.__save()
+        return True
+
+    def __save(self) -> None:
+        update_and_save_cache(self.task_id, self.cache_file, self.key,
+                              {"results": self.results, "exhausted": self.exhausted})
+
+
+# open cursors, least recently used first. a dropped cursor loses its live generator, not its results
+cursors: OrderedDict[tuple[str, str, str], ResultCursor] = OrderedDict()
+max_cursors = 64
+cursors_lock = threading.Lock()
+
+
+def open_cursor(task_id: str, cache_file: str, key: str) -> ResultCursor:
+    with cursors_lock:
+        cursor = cursors.get((task_id, cache_file, key))
+        if cursor is None:
+            cursor = ResultCursor(task_id, cache_file, key)
+            cursors[(task_id, cache_file, key)] = cursor
+            while len(cursors) > max_cursors:
+                cursors.popitem(last=False)
+        cursors.move_to_end((task_id, cache_file, key))
+        return cursor
+
+
+def copy_shared(cache_class: Type[CacheAble], result):
+    """
+    a waiter of a shared call gets its own copy, as if it had read it from the cache
+    """
+    return cache_class.deserialize(cache_class, result.serialize()) if result else result
 
 
 def cache_result(cache_file: str, cache_class: Type[CacheAble],
@@ -80,33 +514,51 @@ def cache_result(cache_file: str, cache_class: Type[CacheAble],
         def decorator_generate(func: Callable) -> Callable:
             def wrapper(*args, **kwargs):
                 task_id = args[1] if len(args) > 0 else kwargs.get("task_id")
-                if not isinstance(task_id, str):
-                    return func(*args, **kwargs)
+                if not isinstance(task_id, str) or not enabled:
+                    try:
+                        yield from func(*args, **kwargs) or []
+                    except Exception as e:
+                        logger.exception(f"generator {func.__name__} failed: {e}")
+                    return
                 # 使用所有的args和kwargs，str，md5, 作为cache的key
                 key = key_gen(*args, **kwargs)
-                r_num = 0
-                result_list = get_or_create_cache(
-                    task_id, cache_file, key) or []
-                if result_list:
-                    for r in result_list:
-                        r_num += 1
-                        logger.debug(f"generator, loading cache for {key}")
-                        yield cache_class.deserialize(cache_class, r)
-
-                # 如果到了这一步，说明没有文件，或者没有找到对应的key，或者key对应的值用完了，执行函数
-                new_num = 0
-                for r in func(*args, **kwargs):
-                    if new_num < r_num:
-                        new_num += 1
-                        continue
-                    logger.debug(f"generator, generating new cache for {key}")
-                    result_list.append(r.serialize())
-                    update_and_save_cache(task_id, cache_file, key, result_list)
-                    yield r
+                cursor = open_cursor(task_id, cache_file, key)
+                index = 0
+                while True:
+                    # 缓存中的结果用完后，只在需要时从生成器继续拉取下一个
+                    r = cursor.get(index, lambda: func(*args, **kwargs))
+                    if r is None:
+                        return
+                    index += 1
+                    yield cache_class.deserialize(cache_class, r)
             return wrapper
         return decorator_generate
     else:
         def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                async def async_wrapper(*args, **kwargs):
+                    task_id = args[1] if len(args) > 0 else kwargs.get("task_id")
+                    if not isinstance(task_id, str):
+                        return await func(*args, **kwargs)
+                    key = key_gen(*args, **kwargs)
+                    result = get_or_create_cache(task_id, cache_file, key)
+                    if result:
+                        return cache_class.deserialize(cache_class, result)
+
+                    async def compute():
+                        # the call of the same key that just finished has cached it
+                        cached = get_or_create_cache(task_id, cache_file, key)
+                        if cached:
+                            return cache_class.deserialize(cache_class, cached)
+                        result = await func(*args, **kwargs)
+                        logger.debug(f"async object, generating new cache for {key}")
+                        if result:
+                            update_and_save_cache(task_id, cache_file, key, result.serialize())
+                        return result
+                    result, shared = await in_flight.do_async((task_id, cache_file, key), compute)
+                    return copy_shared(cache_class, result) if shared else result
+                return async_wrapper
+
             def wrapper(*args, **kwargs):
                 task_id = args[1] if len(args) > 0 else kwargs.get("task_id")
                 if not isinstance(task_id, str):
@@ -115,11 +567,18 @@ def cache_result(cache_file: str, cache_class: Type[CacheAble],
                 result = get_or_create_cache(task_id, cache_file, key)
                 if result:
                     return cache_class.deserialize(cache_class, result)
-                # 如果到了这一步，说明没有文件，或者没有找到对应的key，执行函数
-                result = func(*args, **kwargs)
-                logger.debug(f"object, generating new cache for {key}")
-                if result:
-                    update_and_save_cache(task_id, cache_file, key, result.serialize())
-                return result
+
+                # 如果到了这一步，说明没有文件，或者没有找到对应的key，执行函数，同一个key的并发调用只执行一次
+                def compute():
+                    cached = get_or_create_cache(task_id, cache_file, key)
+                    if cached:
+                        return cache_class.deserialize(cache_class, cached)
+                    result = func(*args, **kwargs)
+                    logger.debug(f"object, generating new cache for {key}")
+                    if result:
+                        update_and_save_cache(task_id, cache_file, key, result.serialize())
+                    return result
+                result, shared = in_flight.do((task_id, cache_file, key), compute)
+                return copy_shared(cache_class, result) if shared else result
             return wrapper
         return decorator
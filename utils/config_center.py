@@ -30,13 +30,13 @@ class Config(metaclass=Singleton):
         """
         set global config
         """
-        self.config['global'][key] = value
+        self.config.setdefault('global', {})[key] = value
     
     def get_global_config(self, key: str):
         """
         get global config
         """
-        return self.config['global'].get(key)
+        return self.config.get('global', {}).get(key)
 
     def get_config(self, key) -> dict:
         """
@@ -0,0 +1,37 @@
+"""
+wall clock deadlines of research tasks.
+
+the pipeline registers the deadline of a task, components that may block for a long time (the selenium waits, for
+example) ask how much time is left, so nothing keeps waiting long after the task has given up.
+"""
+
+from contextvars import ContextVar
+from typing import Optional
+import threading
+import time
+
+lock = threading.Lock()
+deadlines: dict[str, float] = {}
+
+# the max seconds a single crawl may wait for the page, set by CrawlerManager for the crawler it calls
+crawl_timeout: ContextVar[Optional[float]] = ContextVar("crawl_timeout", default=None)
+
+
+def set_deadline(task_id: str, expire_at: float) -> None:
+    with lock:
+        deadlines[task_id] = expire_at
+
+
+def clear_deadline(task_id: str) -> None:
+    with lock:
+        deadlines.pop(task_id, None)
+
+
+def seconds_left(task_id: str) -> Optional[float]:
+    """
+    seconds left before the deadline of the task, None if the task has no deadline
+    """
+    expire_at = deadlines.get(task_id)
+    if expire_at is None:
+        return None
+    return expire_at - time.time()
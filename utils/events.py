@@ -0,0 +1,223 @@
+"""
+structured progress events of research tasks.
+
+the pipeline emits an event at every milestone of a task, callers subscribe with a callback:
+
+    unsubscribe = EventBus().subscribe(lambda event: print(event), task_id)
+
+or consume them as an async iterator, which ends when the task is done or failed:
+
+    async for event in EventBus().stream(task_id):
+        ...
+
+every event carries the seconds since the task started and the tokens the task has used so far. the history of a
+task is kept for retention_seconds after it is done or failed, and only the latest max_finished_tasks finished tasks
+are kept at all.
+"""
+
+from utils.singleton import Singleton
+from utils.config_center import Config
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Optional, AsyncIterator
+import asyncio
+import enum
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventType(enum.Enum):
+    TaskStarted = "task_started"
+    OutlineReady = "outline_ready"
+    QueriesExpanded = "queries_expanded"
+    PageCrawled = "page_crawled"
+    SummaryAccepted = "summary_accepted"
+    SummaryRejected = "summary_rejected"
+    QueryDone = "query_done"
+    BudgetChanged = "budget_changed"
+    ReportChunk = "report_chunk"
+    ReportSection = "report_section"
+    ReportReady = "report_ready"
+    TaskDone = "task_done"
+    TaskFailed = "task_failed"
+
+
+class ResearchEvent:
+
+    def __init__(self, task_id: str, event_type: EventType, timestamp: float, elapsed: float,
+                 tokens: dict[str, int], data: dict) -> None:
+        """
+        Args:
+            task_id (str): the task the event belongs to
+            event_type (EventType): what happened
+            timestamp (float): unix time of the event
+            elapsed (float): seconds since the task started
+            tokens (dict[str, int]): prompt_tokens and completion_tokens used by the task so far
+            data (dict): event specific fields, the sub topic, the url, the queries, ...
+        """
+        self.task_id = task_id
+        self.event_type = event_type
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+        self.tokens = tokens
+        self.data = data
+
+    def serialize(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "event_type": self.event_type.value,
+            "timestamp": self.timestamp,
+            "elapsed": self.elapsed,
+            "tokens": self.tokens,
+            "data": self.data
+        }
+
+    def __str__(self) -> str:
+        return f"task_id: {self.task_id}, event_type: {self.event_type.value}, elapsed: {self.elapsed:.1f}, tokens: {self.tokens}, data: {str(self.data)[:100]}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class TaskProgress:
+
+    def __init__(self, history_size: int) -> None:
+        self.started_at = time.time()
+        self.last_event_at = self.started_at
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.history: deque[ResearchEvent] = deque(maxlen=history_size)
+        # set by TaskDone or TaskFailed
+        self.finished_at: Optional[float] = None
+
+
+class EventBus(metaclass=Singleton):
+
+    def __init__(self, history_size: int = None, retention_seconds: float = None,
+                 max_finished_tasks: int = None) -> None:
+        """
+        Args:
+            history_size (int): events kept per task
+            retention_seconds (float): drop a task this long after it is done or failed
+            max_finished_tasks (int): drop the earliest finished tasks beyond this many
+        """
+        config = Config().get_config("events")
+        self.history_size = history_size or config.get("history_size", 1000)
+        self.retention_seconds = retention_seconds if retention_seconds is not None \
+            else config.get("retention_seconds", 3600)
+        self.max_finished_tasks = max_finished_tasks if max_finished_tasks is not None \
+            else config.get("max_finished_tasks", 100)
+        self.tasks: dict[str, TaskProgress] = {}
+        # (task_id or None for all tasks, callback)
+        self.subscribers: list[tuple[Optional[str], Callable[[ResearchEvent], None]]] = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[ResearchEvent], None], task_id: str = None) -> Callable[[], None]:
+        """
+        call callback on every event of the task, or of all tasks if task_id is None.
+        the callback runs on the thread emitting the event, keep it fast. returns a function to unsubscribe.
+        """
+        subscriber = (task_id, callback)
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+        def unsubscribe() -> None:
+            with self.lock:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+        return unsubscribe
+
+    async def stream(self, task_id: str = None) -> AsyncIterator[ResearchEvent]:
+        """
+        the events as an async iterator. with a task_id, the iterator ends after the task is done or failed.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[ResearchEvent] = asyncio.Queue()
+        unsubscribe = self.subscribe(lambda event: loop.call_soon_threadsafe(queue.put_nowait, event), task_id)
+        try:
+            while True:
+                event = await queue.get()
+                yield event
+                if task_id and event.event_type in [EventType.TaskDone, EventType.TaskFailed]:
+                    return
+        finally:
+            unsubscribe()
+
+    def emit(self, task_id: str, event_type: EventType, **data) -> None:
+        now = time.time()
+        with self.lock:
+            progress = self.__progress(task_id)
+            progress.last_event_at = now
+            event = ResearchEvent(task_id, event_type, now, now - progress.started_at,
+                                  {"prompt_tokens": progress.prompt_tokens,
+                                   "completion_tokens": progress.completion_tokens}, data)
+            # chunks are replayed by the report itself, keep them from pushing milestones out of the history
+            if event_type != EventType.ReportChunk:
+                progress.history.append(event)
+            if event_type in [EventType.TaskDone, EventType.TaskFailed]:
+                progress.finished_at = now
+                self.__evict(now)
+            callbacks = [callback for t, callback in self.subscribers if t is None or t == task_id]
+        logger.debug(f"event: {event}")
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.exception(f"error in event subscriber: {e}")
+
+    def record_tokens(self, task_id: str, prompt_tokens: int, completion_tokens: int) -> None:
+        if task_id is None:
+            return
+        with self.lock:
+            progress = self.__progress(task_id)
+            progress.prompt_tokens += prompt_tokens
+            progress.completion_tokens += completion_tokens
+
+    @contextmanager
+    def track(self, task_id: str, **data):
+        """
+        emit TaskStarted, and TaskFailed if the block raises. TaskDone is emitted by the caller with its results.
+        """
+        with self.lock:
+            self.tasks[task_id] = TaskProgress(self.history_size)
+            self.__evict(time.time())
+        self.emit(task_id, EventType.TaskStarted, **data)
+        try:
+            yield
+        except BaseException as e:
+            self.emit(task_id, EventType.TaskFailed, error=str(e))
+            raise
+
+    def history(self, task_id: str) -> list[ResearchEvent]:
+        with self.lock:
+            progress = self.tasks.get(task_id)
+            return list(progress.history) if progress else []
+
+    def idle_seconds(self) -> dict[str, float]:
+        """
+        seconds since the last event of every task that is neither done nor failed, to find stalled tasks
+        """
+        now = time.time()
+        with self.lock:
+            return {task_id: now - progress.last_event_at for task_id, progress in self.tasks.items()
+                    if progress.finished_at is None}
+
+    def __evict(self, now: float) -> None:
+        # called with the lock held, running tasks are never dropped
+        finished = sorted([(progress.finished_at, task_id) for task_id, progress in self.tasks.items()
+                           if progress.finished_at is not None])
+        expired = [task_id for finished_at, task_id in finished if now - finished_at > self.retention_seconds]
+        kept = [task_id for finished_at, task_id in finished if now - finished_at <= self.retention_seconds]
+        dropped = expired + kept[:max(len(kept) - self.max_finished_tasks, 0)]
+        for task_id in dropped:
+            del self.tasks[task_id]
+        if dropped:
+            logger.debug(f"drop the events of {len(dropped)} finished tasks")
+
+    def __progress(self, task_id: str) -> TaskProgress:
+        if task_id not in self.tasks:
+            self.tasks[task_id] = TaskProgress(self.history_size)
+        return self.tasks[task_id]
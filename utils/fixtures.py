@@ -0,0 +1,114 @@
+"""
+fixture bundles of llm calls, searches and crawls, for deterministic offline runs.
+
+in record mode the llm util, search engine and crawler manager of the pipeline are wrapped, and every call they answer
+is written to the bundle with how long it took. in replay mode stand-ins serve the answers from the bundle, holding the
+same scheduler resources and sleeping the recorded (or configured) latency, so a run needs no openai, duckduckgo or
+chrome and still has the timing shape of the real one.
+
+a bundle is a directory with one jsonl file per kind (llm, search, crawl), every line is {"key": ..., "value": ...},
+a later line of the same key wins. lines are only appended, a bundle can be recorded over several runs.
+"""
+
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FixtureMissing(Exception):
+    """
+    raised in replay mode when a call has no recorded answer
+    """
+    pass
+
+
+class FixtureBundle:
+
+    KINDS = ["llm", "search", "crawl"]
+
+    def __init__(self, path: str, latency: dict = None) -> None:
+        """
+        Args:
+            path (str): the bundle directory
+            latency (dict): injected latency of replayed calls, "scale" multiplies the recorded latency,
+                            "llm", "search" and "crawl" replace it with a fixed number of seconds when set
+        """
+        self.path = path
+        self.latency = latency or {}
+        self.fixtures: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, kind: str, key: str) -> Optional[dict]:
+        with self.lock:
+            return self.__load(kind).get(key)
+
+    def put(self, kind: str, key: str, value: dict) -> None:
+        with self.lock:
+            self.__load(kind)[key] = value
+            with open(self.__file(kind), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+
+    def delay(self, kind: str, recorded: float) -> float:
+        """
+        seconds a replayed call of the kind takes
+        """
+        fixed = self.latency.get(kind)
+        if fixed is not None:
+            return fixed
+        return max(recorded or 0, 0) * self.latency.get("scale", 1.0)
+
+    def sleep(self, kind: str, recorded: float) -> None:
+        seconds = self.delay(kind, recorded)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    async def sleep_async(self, kind: str, recorded: float) -> None:
+        seconds = self.delay(kind, recorded)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def __file(self, kind: str) -> str:
+        return os.path.join(self.path, kind + ".jsonl")
+
+    def __load(self, kind: str) -> dict:
+        """
+        fixtures of the kind, read from the bundle the first time. the caller holds the lock
+        """
+        if kind not in self.fixtures:
+            fixtures = {}
+            if os.path.exists(self.__file(kind)):
+                with open(self.__file(kind), "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # a run killed while writing leaves a broken last line
+                            logger.warning(f"skip broken line in {self.__file(kind)}")
+                            continue
+                        fixtures[record["key"]] = record["value"]
+            logger.info(f"loaded {len(fixtures)} {kind} fixtures from {self.path}")
+            self.fixtures[kind] = fixtures
+        return self.fixtures[kind]
+
+
+def create_fixture_bundle(config: dict) -> Optional[FixtureBundle]:
+    """
+    the bundle of the replay config, None if neither recording nor replaying
+    """
+    if config.get("mode") not in ["record", "replay"]:
+        return None
+    path = config.get("path") or os.path.join(os.path.dirname(os.path.dirname(__file__)), "output", "fixtures")
+    return FixtureBundle(path, config.get("latency", {}))
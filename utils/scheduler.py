@@ -0,0 +1,132 @@
+"""
+one place to decide how much of each scarce resource can be used at the same time.
+
+every stage acquires capacity of a named resource class before touching it, for example:
+
+    with Scheduler().acquire("browser"):
+        driver.get(url)
+
+resource classes are configured in the "scheduler" section of the config file, each with:
+    concurrency: max holders at the same time
+    rate_per_minute: max acquisitions in any 60 seconds window, null means no rate limit
+unknown resource classes are not limited at all.
+the request rate of the llm classes is left to the per model rate_limits of the llm config, so they only set
+concurrency here.
+"""
+
+from utils.config_center import Config
+from utils.singleton import Singleton
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceClass:
+
+    def __init__(self, name: str, concurrency: int = None, rate_per_minute: int = None) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.rate_per_minute = rate_per_minute
+        self.in_use = 0
+        self.acquired_at = deque()
+        self.condition = threading.Condition()
+
+    def try_acquire(self) -> float:
+        """
+        try to take one slot without blocking.
+        return 0 when acquired, otherwise the seconds worth waiting before trying again
+        """
+        with self.condition:
+            return self.__try_acquire_locked()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                wait_seconds = self.__try_acquire_locked()
+                if wait_seconds == 0:
+                    return
+                # wake up on release, or when the rate window moves
+                self.condition.wait(timeout=wait_seconds)
+
+    def release(self) -> None:
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def __try_acquire_locked(self) -> float:
+        if self.concurrency and self.in_use >= self.concurrency:
+            return 1
+        if self.rate_per_minute:
+            now = time.time()
+            while self.acquired_at and self.acquired_at[0] <= now - 60:
+                self.acquired_at.popleft()
+            if len(self.acquired_at) >= self.rate_per_minute:
+                return self.acquired_at[0] + 60 - now
+            self.acquired_at.append(now)
+        self.in_use += 1
+        return 0
+
+    def __str__(self) -> str:
+        return f"{self.name}(concurrency: {self.concurrency}, rate_per_minute: {self.rate_per_minute}, in_use: {self.in_use})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class Scheduler(metaclass=Singleton):
+
+    def __init__(self) -> None:
+        config = Config().get_config("scheduler").get("resources", {})
+        self.resources: dict[str, ResourceClass] = {
+            name: ResourceClass(name, c.get("concurrency"), c.get("rate_per_minute")) for name, c in config.items()
+        }
+        logger.info(f"scheduler resources: {self.resources}")
+
+    def get_concurrency(self, name: str, default: int = None) -> int:
+        """
+        the configured concurrency of a resource class, useful to size pools of the resource
+        """
+        resource = self.resources.get(name)
+        if resource and resource.concurrency:
+            return resource.concurrency
+        return default
+
+    @contextmanager
+    def acquire(self, name: str):
+        resource = self.resources.get(name)
+        if resource is None:
+            yield
+            return
+        start = time.time()
+        resource.acquire()
+        waited = time.time() - start
+        if waited > 1:
+            logger.debug(f"waited {waited:.1f}s for resource {name}")
+        try:
+            yield
+        finally:
+            resource.release()
+
+    @asynccontextmanager
+    async def acquire_async(self, name: str):
+        """
+        same as acquire, but waits on the event loop instead of blocking the thread
+        """
+        resource = self.resources.get(name)
+        if resource is None:
+            yield
+            return
+        while True:
+            wait_seconds = resource.try_acquire()
+            if wait_seconds == 0:
+                break
+            await asyncio.sleep(min(wait_seconds, 0.1))
+        try:
+            yield
+        finally:
+            resource.release()
@@ -40,6 +40,20 @@ def __write_file(task_id: str, func, start_time: int, end_time: int):
 
 
 def time_usage(func):
+    if inspect.iscoroutinefunction(func):
+        async def async_wrapper(*args, **kwargs):
+            task_id = kwargs.get("task_id") if kwargs.get("task_id") else args[1]
+            if not isinstance(task_id, str):
+                return
+            start_time = time.time()
+            result = await func(*args, **kwargs)
+            end_time = time.time()
+
+            __write_file(task_id, func, start_time, end_time)
+            return result
+
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
         task_id = kwargs.get("task_id") if kwargs.get("task_id") else args[1]
         if not isinstance(task_id, str):